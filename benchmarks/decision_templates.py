@@ -0,0 +1,100 @@
+"""Cost of building ScheduleActivityTask decisions.
+
+Compares ``types.Activity.schedule``, which starts from a template built
+once per class, with building every decision from an empty skeleton as
+``schedule`` did before templates. Prints the results as JSON.
+
+Both variants are run with the default JSON codec and with a codec that
+does no work, which isolates the cost of building the decision itself.
+
+Example run:
+
+    $ python benchmarks/decision_templates.py
+
+"""
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from flowser import decisions
+from flowser import serializing
+from flowser import types
+
+
+class NoopCodec(serializing.Codec):
+    name = 'noop'
+    is_json = True
+
+    def dumps(self, obj):
+        return '{}'
+
+    def loads(self, s):
+        return {}
+
+
+serializing.register(NoopCodec())
+
+
+class MultiplyActivity(types.Activity):
+    name = 'MultiplyActivity'
+    version = '1.0.0'
+    task_list = 'MultiplyActivity-1.0.0'
+
+    @classmethod
+    def get_id_from_input(cls, input):
+        return '.'.join([cls.name, input['id']])
+
+
+def schedule_from_skeleton(cls, input, control=None):
+    dec, attrs = decisions.skeleton("ScheduleActivityTask")
+    attrs['activityId'] = cls.get_id_from_input(input)
+    attrs['activityType'] = {
+            'name': cls.name,
+            'version': cls.version}
+    attrs['taskList'] = {'name': cls.task_list}
+    attrs['input'] = serializing.dumps(input, codec=cls.codec)
+    attrs['heartbeatTimeout'] = cls.heartbeat_timeout
+    attrs['scheduleToCloseTimeout'] = cls.schedule_to_close_timeout
+    attrs['scheduleToStartTimeout'] = cls.schedule_to_start_timeout
+    attrs['startToCloseTimeout'] = cls.start_to_close_timeout
+    if control is not None:
+        attrs['control'] = serializing.dumps(control, codec=cls.codec)
+    return dec
+
+
+def fan_out(schedule, inputs):
+    return [schedule(MultiplyActivity, input) for input in inputs]
+
+
+def main(argv):
+    fan_out_size = int(argv[1]) if len(argv) > 1 else 10000
+    inputs = [{'id': str(i), 'operation': ['op', [1, 2]]}
+              for i in range(fan_out_size)]
+    assert (MultiplyActivity.schedule(inputs[0]) ==
+            schedule_from_skeleton(MultiplyActivity, inputs[0]))
+
+    def template(cls, input):
+        return cls.schedule(input)
+
+    results = {'fan_out_size': fan_out_size}
+    for codec in ['json', 'noop']:
+        MultiplyActivity.codec = codec
+        codec_results = results[codec] = {}
+        for name, schedule in [('skeleton', schedule_from_skeleton),
+                               ('template', template)]:
+            seconds = min(timeit.repeat(
+                    lambda: fan_out(schedule, inputs), number=1, repeat=5))
+            codec_results[name] = {
+                    'seconds': seconds,
+                    'us_per_decision': seconds / fan_out_size * 1e6,
+                    }
+        codec_results['speedup'] = (codec_results['skeleton']['seconds'] /
+                                    codec_results['template']['seconds'])
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
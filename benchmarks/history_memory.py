@@ -0,0 +1,124 @@
+"""Memory used by a decision task history.
+
+Compares ``history.History`` with the representation used before it: every
+raw event dict kept by the decision task plus one dict-backed event object
+per raw event.
+
+Example run:
+
+    $ python benchmarks/history_memory.py 20000
+
+Requires Python 3 (tracemalloc).
+"""
+import gc
+import json
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from flowser import events
+from flowser.exceptions import LastPage
+from flowser.history import History
+
+PAGE_SIZE = 1000
+
+
+class DictEvent(object):
+    """Event object as it was before ``__slots__`` and lazy decoding. """
+
+    def __init__(self, result):
+        self.id = result['eventId']
+        self.time_stamp = result['eventTimestamp']
+        self.type = result['eventType']
+        self.attrs = events.attrs(result)
+
+
+def make_pages(n):
+    """Serialized pages of a history with ``n`` events, most recent first.
+
+    Pages are kept serialized so that the raw dicts are only created when a
+    page is "fetched", like with a real connection.
+    """
+    raw = []
+    raw.append({'eventId': 1, 'eventType': 'WorkflowExecutionStarted',
+                'eventTimestamp': 1350000000.0,
+                'workflowExecutionStartedEventAttributes': {
+                    'input': json.dumps({'id': 'x' * 36}),
+                    'childPolicy': 'TERMINATE',
+                    'taskList': {'name': 'ArithmeticWorkflow-1.0.0'},
+                    'workflowType': {'name': 'ArithmeticWorkflow',
+                                     'version': '1.0.0'}}})
+    while len(raw) < n:
+        event_id = len(raw) + 1
+        activity_id = 'MultiplyActivity.%d' % event_id
+        raw.append({'eventId': event_id,
+                    'eventType': 'ActivityTaskScheduled',
+                    'eventTimestamp': 1350000000.0 + event_id,
+                    'activityTaskScheduledEventAttributes': {
+                        'activityId': activity_id,
+                        'activityType': {'name': 'MultiplyActivity',
+                                         'version': '1.0.0'},
+                        'input': json.dumps({'operation': ['op', [1, 2, 3]]}),
+                        'taskList': {'name': 'MultiplyActivity-1.0.0'},
+                        'decisionTaskCompletedEventId': event_id - 1}})
+        raw.append({'eventId': event_id + 1,
+                    'eventType': 'ActivityTaskCompleted',
+                    'eventTimestamp': 1350000001.0 + event_id,
+                    'activityTaskCompletedEventAttributes': {
+                        'result': json.dumps(['op', 6]),
+                        'scheduledEventId': event_id,
+                        'startedEventId': event_id}})
+    raw = raw[:n]
+    raw.reverse()
+    return [json.dumps(raw[i:i + PAGE_SIZE])
+            for i in range(0, len(raw), PAGE_SIZE)]
+
+
+def load_dict_events(pages):
+    raw = []
+    for page in pages:
+        raw.extend(json.loads(page))
+    return raw, [DictEvent(r) for r in raw]
+
+
+def load_history(pages):
+    remaining = list(pages[1:])
+
+    def next_page():
+        if not remaining:
+            raise LastPage
+        return json.loads(remaining.pop(0))
+    history = History(json.loads(pages[0]), next_page)
+    history.filter('ActivityTaskCompleted')
+    return history
+
+
+def measure(func, *args):
+    gc.collect()
+    tracemalloc.start()
+    result = func(*args)
+    gc.collect()
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return size, peak
+
+
+def main(argv):
+    n = int(argv[1]) if len(argv) > 1 else 20000
+    pages = make_pages(n)
+    results = {'events': n}
+    for name, func in [('dict_events', load_dict_events),
+                       ('history', load_history)]:
+        size, peak = measure(func, pages)
+        results[name] = {'bytes': size, 'peak_bytes': peak,
+                         'bytes_per_event': size // n}
+    results['ratio'] = (float(results['history']['bytes']) /
+                        results['dict_events']['bytes'])
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,69 @@
+"""Speed and size of the registered serializing codecs.
+
+Runs every codec available in ``flowser.serializing`` over payload shapes
+typical for activity inputs and results, and prints the results as JSON.
+
+Example run:
+
+    $ python benchmarks/serializing.py
+
+"""
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from flowser import serializing
+
+PAYLOADS = {
+    # Input of an activity scheduled by ArithmeticWorkflow (see tests.py).
+    'activity_input': {
+        'id': '0b7bd2d4-7d4d-4c3e-9cd1-6a4f1b1b3f7e',
+        'operation': ['mult_id', [1, 2, 3]],
+        },
+    # Small result, an [operation id, value] pair.
+    'activity_result': ['mult_id', 6],
+    # Start input of a fan-out workflow.
+    'fan_out_input': {
+        'id': '0b7bd2d4-7d4d-4c3e-9cd1-6a4f1b1b3f7e',
+        'operations': [['op-%d' % i, 'multiply', [i, i + 1, i + 2]]
+                       for i in range(500)],
+        },
+    # Large result with nested records and floats.
+    'records_result': [
+        {'key': 'photos/%08d.jpg' % i, 'size': 1024 * i, 'width': 4000,
+         'height': 3000, 'checksum': '%032x' % i, 'score': i / 7.0,
+         'tags': ['outdoor', 'day']}
+        for i in range(1000)],
+    }
+
+
+def bench(codec, payload, number):
+    encoded = serializing.dumps(payload, codec=codec)
+    dumps_time = min(timeit.repeat(
+            lambda: serializing.dumps(payload, codec=codec),
+            number=number, repeat=3)) / number
+    loads_time = min(timeit.repeat(
+            lambda: serializing.loads(encoded),
+            number=number, repeat=3)) / number
+    return {
+            'bytes': len(encoded),
+            'dumps_us': dumps_time * 1e6,
+            'loads_us': loads_time * 1e6,
+            }
+
+
+def main(argv):
+    number = int(argv[1]) if len(argv) > 1 else 200
+    results = {}
+    for name, payload in sorted(PAYLOADS.items()):
+        results[name] = {}
+        for codec in serializing.available_codecs():
+            results[name][codec] = bench(codec, payload, number)
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,304 @@
+"""Throughput and latency of deciders and activity workers.
+
+Runs workflows against ``fake.FakeConnection``, so only flowser's own
+overhead (and the small cost of the in-memory service) is measured:
+
+* ``arithmetic``: the ``ArithmeticWorkflow`` example from ``tests.py``
+  with ``MultiplyActivity`` and ``SumActivity``, for several worker counts.
+* ``fan_out``: one workflow scheduling many activities with
+  ``Decision.schedule_many``, for several fan-out sizes. Decision latency
+  is also reported by history length, which shows how the cost of a
+  decision task grows with its history.
+
+Latencies are reported as p50/p99 in milliseconds:
+
+* ``decision``: from the poll result to the response (building the
+  history, deciding and responding), with the CPU time of the decider
+  thread in ``decision_cpu``.
+* ``activity_queue`` and ``activity``: from scheduling to start, and from
+  start to completion, taken from the event timestamps.
+* ``workflow``: from start to close.
+
+With ``--memory``, the peak memory traced during each run is reported
+(this slows the runs down). Results are printed as JSON.
+
+Example run:
+
+    $ python benchmarks/throughput.py --workers 1 4 --fan-out 100 1000
+
+Requires Python 3.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from flowser import tasks
+from flowser import types
+from flowser.exceptions import EmptyTaskPollResult
+from flowser.fake import FakeConnection
+
+import tests
+from tests import ArithmeticWorkflow
+from tests import MultiplyActivity
+from tests import SumActivity
+
+# Seconds a poll waits for a task. Short, so that threads stop quickly.
+POLL_TIMEOUT = 0.05
+
+
+@tests.auto_configured
+class FanOutWorkflow(types.Workflow):
+    name = 'FanOutWorkflow'
+
+
+class BenchmarkDomain(tests.TestDomain):
+    name = 'flowser-benchmark'
+    workflow_types = [ArithmeticWorkflow, FanOutWorkflow]
+
+
+def percentiles(values):
+    """p50 and p99 (nearest rank) of ``values`` in milliseconds. """
+    if not values:
+        return {'p50': None, 'p99': None, 'count': 0}
+    values = sorted(values)
+
+    def rank(p):
+        index = max(0, int(round(p / 100.0 * len(values))) - 1)
+        return round(values[index] * 1000, 3)
+    return {'p50': rank(50), 'p99': rank(99), 'count': len(values)}
+
+
+def decide_arithmetic(task):
+    """The decider of ``tests.ArithmeticWorkflowDecider``. """
+    op_to_activity = {'multiply': MultiplyActivity, 'sum': SumActivity}
+    operations = task.start_input['operations']
+    if len(task.filter('DecisionTaskScheduled')) == 1:
+        for op_id, op, input in operations:
+            task.schedule(op_to_activity[op], {
+                'id': task.start_input['id'] + '.' + op_id,
+                'operation': [op_id, input],
+                })
+    else:
+        results = {}
+        for ev in task.filter('ActivityTaskCompleted'):
+            results[ev.attrs['result'][0]] = ev.attrs['result'][1]
+        if set(results) == set(op[0] for op in operations):
+            task.workflow_execution.complete(results)
+            return True
+    task.complete()
+    return False
+
+
+def decide_fan_out(task):
+    n = task.start_input['n']
+    inputs = [{'id': str(i), 'operation': [str(i), [i, 2]]}
+              for i in range(n)]
+    task.schedule_many(MultiplyActivity, inputs)
+    if len(task.filter('ActivityTaskCompleted')) == n:
+        task.workflow_execution.complete(n)
+        return True
+    task.complete()
+    return False
+
+
+class Decider(threading.Thread):
+    """Polls decision tasks and records how long each one takes.
+
+    Polls like ``Domain.decisions``, but stops once ``stop`` is set.
+    """
+
+    def __init__(self, domain, workflow_type, decide, samples, stop,
+                 on_closed):
+        super(Decider, self).__init__()
+        self.daemon = True
+        self.domain = domain
+        self.workflow_type = workflow_type
+        self.decide = decide
+        self.samples = samples
+        self.stop = stop
+        self.on_closed = on_closed
+
+    def run(self):
+        instance = self.workflow_type(self.domain)
+        thread_time = getattr(time, 'thread_time', time.process_time)
+        while not self.stop.is_set():
+            try:
+                result = instance._poll_for_decision_task(reverse_order=True)
+            except EmptyTaskPollResult:
+                continue
+            started, cpu_started = time.time(), thread_time()
+            task = tasks.Decision(result, instance)
+            closed = self.decide(task)
+            self.samples.append((task.started_event_id,
+                                 time.time() - started,
+                                 thread_time() - cpu_started))
+            if closed:
+                self.on_closed()
+
+
+def iter_history(conn, domain, info):
+    execution = info['execution']
+    token = None
+    while True:
+        page = conn.get_workflow_execution_history(
+                domain.name, execution['runId'], execution['workflowId'],
+                maximum_page_size=1000, next_page_token=token)
+        for event in page['events']:
+            yield event
+        token = page.get('nextPageToken')
+        if token is None:
+            return
+
+
+def activity_latencies(conn, domain, infos):
+    queued, handled = [], []
+    for info in infos:
+        scheduled, started = {}, {}
+        for event in iter_history(conn, domain, info):
+            event_type = event['eventType']
+            if event_type == 'ActivityTaskScheduled':
+                scheduled[event['eventId']] = event['eventTimestamp']
+            elif event_type == 'ActivityTaskStarted':
+                attrs = event['activityTaskStartedEventAttributes']
+                queued.append(event['eventTimestamp'] -
+                              scheduled[attrs['scheduledEventId']])
+                started[event['eventId']] = event['eventTimestamp']
+            elif event_type == 'ActivityTaskCompleted':
+                attrs = event['activityTaskCompletedEventAttributes']
+                handled.append(event['eventTimestamp'] -
+                               started[attrs['startedEventId']])
+    return queued, handled
+
+
+def by_history_length(samples, buckets=5):
+    """Decision latency percentiles for ranges of history length. """
+    if not samples:
+        return []
+    longest = max(length for length, _, _ in samples)
+    width = max(1, (longest + buckets - 1) // buckets)
+    rows = []
+    for i in range(buckets):
+        low, high = i * width + 1, (i + 1) * width
+        durations = [d for length, d, _ in samples if low <= length <= high]
+        if durations:
+            row = {'history_length': [low, high]}
+            row.update(percentiles(durations))
+            rows.append(row)
+    return rows
+
+
+def run(workflow_type, decide, inputs, activity_types, workers, deciders,
+        latency, memory):
+    conn = FakeConnection(latency=latency, poll_timeout=POLL_TIMEOUT)
+    domain = BenchmarkDomain(conn)
+    domain.register()
+    workflow = workflow_type(domain)
+
+    samples = []
+    stop = threading.Event()
+    all_closed = threading.Event()
+    closed = [0]
+    lock = threading.Lock()
+
+    def on_closed():
+        with lock:
+            closed[0] += 1
+            if closed[0] == len(inputs):
+                all_closed.set()
+
+    if memory:
+        tracemalloc.start()
+    began = time.time()
+    pool = domain.run_activity_workers(
+            activity_types, tests.handle_arithmetic,
+            pollers=workers, max_in_flight=workers, wait=False)
+    threads = [Decider(domain, workflow_type, decide, samples, stop,
+                       on_closed) for _ in range(deciders)]
+    for thread in threads:
+        thread.start()
+    for result in domain.start_many(workflow_type, inputs):
+        if result.error is not None:
+            raise result.error
+    all_closed.wait()
+    elapsed = time.time() - began
+    stop.set()
+    pool.stop()
+    for thread in threads:
+        thread.join()
+    peak = None
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    infos = list(workflow.iter_closed(start_oldest_date=began - 1))
+    queued, handled = activity_latencies(conn, domain, infos)
+    return {
+            'workers': workers,
+            'deciders': deciders,
+            'workflows': len(inputs),
+            'seconds': round(elapsed, 3),
+            'workflows_per_second': round(len(inputs) / elapsed, 1),
+            'decisions_per_second': round(len(samples) / elapsed, 1),
+            'activities_per_second': round(len(handled) / elapsed, 1),
+            'latency_ms': {
+                'decision': percentiles([d for _, d, _ in samples]),
+                'decision_cpu': percentiles([c for _, _, c in samples]),
+                'activity_queue': percentiles(queued),
+                'activity': percentiles(handled),
+                'workflow': percentiles([i['closeTimestamp'] -
+                                         i['startTimestamp']
+                                         for i in infos]),
+                },
+            'decision_latency_by_history_length':
+                    by_history_length(samples),
+            'peak_memory_bytes': peak,
+            }
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--workflows', type=int, default=200,
+                        help='arithmetic workflows per run')
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=[1, 2, 4, 8],
+                        help='activity pollers (and deciders) per run')
+    parser.add_argument('--fan-out', type=int, nargs='+',
+                        default=[100, 500, 2000],
+                        help='activities per fan-out workflow')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='simulated seconds per API call')
+    parser.add_argument('--memory', action='store_true',
+                        help='trace peak memory (slower)')
+    args = parser.parse_args(argv[1:])
+
+    arithmetic_inputs = [{
+            'id': str(i),
+            'operations': [['mult_id', 'multiply', [1, 2, 3]],
+                           ['sum_id', 'sum', [1, 2, 3, 4]]],
+            } for i in range(args.workflows)]
+    results = {
+            'python': sys.version.split()[0],
+            'latency': args.latency,
+            'arithmetic': [
+                run(ArithmeticWorkflow, decide_arithmetic, arithmetic_inputs,
+                    [MultiplyActivity, SumActivity], workers, workers,
+                    args.latency, args.memory)
+                for workers in args.workers],
+            'fan_out': [],
+            }
+    for n in args.fan_out:
+        result = run(FanOutWorkflow, decide_fan_out, [{'id': '0', 'n': n}],
+                     [MultiplyActivity], 4, 1, args.latency, args.memory)
+        result['activities'] = n
+        results['fan_out'].append(result)
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,137 @@
+# Copyright (c) 2012 Memoto AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""asyncio support (Python 3 only).
+
+The boto connection is blocking, so API calls are run on a thread pool owned
+by the domain and wrapped in asyncio futures. Deciders and activity handlers
+can then share one event loop, and the number of threads is bounded by
+``Domain.async_threads`` instead of growing with the number of task lists.
+
+This module avoids the ``async`` and ``await`` keywords so that the package
+still byte-compiles on Python 2.
+"""
+import collections
+import functools
+import threading
+
+try:
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    asyncio = None
+
+from flowser.exceptions import EmptyTaskPollResult
+from flowser.exceptions import Error
+
+_executor_lock = threading.Lock()
+
+
+def executor(domain):
+    """Get the thread pool used for the domain's API calls.
+
+    The pool is created on first use with ``domain.async_threads`` threads.
+    """
+    if asyncio is None:
+        raise Error('asyncio is not available')
+    with _executor_lock:
+        pool = getattr(domain, '_aio_executor', None)
+        if pool is None:
+            pool = ThreadPoolExecutor(max_workers=domain.async_threads)
+            domain._aio_executor = pool
+    return pool
+
+
+def call(domain, func, *args, **kwargs):
+    """Run a blocking call on the domain's thread pool.
+
+    :returns: An awaitable ``asyncio.Future``.
+    """
+    loop = asyncio.get_event_loop()
+    return loop.run_in_executor(
+            executor(domain), functools.partial(func, *args, **kwargs))
+
+
+class TaskIterator(object):
+    """Asynchronous iterator over tasks of a given type.
+
+    Polls indefinitely, like ``Domain._poll_indefinitely``. Empty poll
+    results are retried without waking up the consumer.
+
+    If the consumer stops waiting (its ``__anext__`` future is cancelled)
+    while a poll is in progress, a task returned by that poll is kept and
+    handed out by the next ``__anext__``, rather than left to time out.
+    """
+
+    def __init__(self, domain, t, method_name, task_class, poll_kwargs=None):
+        """
+        :param domain: A ``domain.Domain`` instance.
+        :param t: Subclass of ``types.Type``.
+        :param method_name: Name of the poll method on ``t``.
+        :param task_class: Class wrapping poll results.
+        """
+        self._domain = domain
+        self._instance = t(domain)
+        self._poll_method = getattr(self._instance, method_name)
+        self._task_class = task_class
+        self._poll_kwargs = poll_kwargs or {}
+        # Poll results that arrived after their consumer stopped waiting.
+        self._unclaimed = collections.deque()
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        if self._unclaimed:
+            self._resolve(future, self._unclaimed.popleft())
+        else:
+            self._poll(future)
+        return future
+
+    def _resolve(self, future, result):
+        """Wrap a poll result, or pass the error on to the consumer. """
+        try:
+            task = self._task_class(result, self._instance)
+        except Exception as exc:
+            future.set_exception(exc)
+        else:
+            future.set_result(task)
+
+    def _poll(self, future):
+        polled = call(self._domain, self._poll_method, **self._poll_kwargs)
+        polled.add_done_callback(functools.partial(self._on_polled, future))
+
+    def _on_polled(self, future, polled):
+        if polled.cancelled():
+            future.cancel()
+            return
+        exc = polled.exception()
+        if future.cancelled():
+            if exc is None:
+                self._unclaimed.append(polled.result())
+            return
+        if isinstance(exc, EmptyTaskPollResult):
+            self._poll(future)
+        elif exc is not None:
+            future.set_exception(exc)
+        else:
+            self._resolve(future, polled.result())
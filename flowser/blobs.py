@@ -0,0 +1,167 @@
+# Copyright (c) 2012 Memoto AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Blob stores.
+
+The purpose is to keep payloads that are too large for the API outside of
+Simple Workflow. ``serializing`` writes such payloads to a blob store under
+their content hash and only sends a reference (a "claim check").
+
+Keys are SHA-256 hex digests of the data, so storing the same data twice is
+a no-op. Keys come from payloads and are checked with ``check_key`` before
+they are used.
+"""
+import collections
+import hashlib
+import os
+import re
+import tempfile
+import threading
+
+from flowser.exceptions import Error
+
+
+# Keys are lowercase SHA-256 hex digests.
+_KEY_RE = re.compile(r'[0-9a-f]{64}\Z')
+
+
+def content_key(data):
+    """Get the key of ``data`` (bytes). """
+    return hashlib.sha256(data).hexdigest()
+
+
+def check_key(key):
+    """Check that ``key`` could be returned by ``content_key``.
+
+    :raises: InvalidBlobKey
+    """
+    if _KEY_RE.match(key) is None:
+        raise InvalidBlobKey(key)
+
+
+class BlobStore(object):
+    """Base class for blob stores.
+
+    Subclasses implement ``exists``, ``put`` and ``get``. All of them must be
+    safe to call from several threads.
+    """
+
+    def exists(self, key):
+        raise NotImplementedError('implement in subclass')
+
+    def put(self, key, data):
+        """Store ``data`` (bytes) under ``key``. """
+        raise NotImplementedError('implement in subclass')
+
+    def get(self, key):
+        """Get data stored under ``key``.
+
+        :raises: BlobNotFound
+        """
+        raise NotImplementedError('implement in subclass')
+
+
+class BlobNotFound(Error):
+    pass
+
+
+class InvalidBlobKey(Error):
+    pass
+
+
+class FileBlobStore(BlobStore):
+    """Blob store in a local directory.
+
+    Blobs are written to a temporary file and renamed into place, so readers
+    never see partial blobs.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, key):
+        check_key(key)
+        return os.path.join(self.directory, key[:2], key)
+
+    def exists(self, key):
+        return os.path.exists(self._path(key))
+
+    def put(self, key, data):
+        path = self._path(key)
+        if os.path.exists(path):
+            return
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent):
+            try:
+                os.makedirs(parent)
+            except OSError:
+                if not os.path.isdir(parent):
+                    raise
+        fd, tmp_path = tempfile.mkstemp(dir=parent)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except IOError:
+            raise BlobNotFound(key)
+
+
+class BlobCache(object):
+    """Thread-safe LRU cache of blobs, bounded by their total size. """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._blobs = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._blobs
+
+    def get(self, key):
+        """Get a cached blob, or None. """
+        with self._lock:
+            data = self._blobs.pop(key, None)
+            if data is not None:
+                self._blobs[key] = data
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._blobs.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._blobs[key] = data
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                evicted_key, evicted = self._blobs.popitem(last=False)
+                self._size -= len(evicted)
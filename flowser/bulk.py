@@ -0,0 +1,111 @@
+# Copyright (c) 2012 Memoto AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Bulk operations on workflow executions.
+
+The purpose is to signal, cancel or terminate many executions quickly and
+safely. Executions are handled concurrently at a bounded rate, and handled
+executions can be recorded in a checkpoint file so that an interrupted run
+can be resumed.
+
+See ``types.Workflow.bulk_signal`` and friends.
+"""
+import collections
+import os
+import threading
+
+from flowser import pool
+from flowser.throttling import TokenBucket
+
+# Outcome of one execution. ``error`` is None on success.
+BulkResult = collections.namedtuple(
+        'BulkResult', ['workflow_id', 'run_id', 'error'])
+
+
+class Checkpoint(object):
+    """File recording handled executions, one per line.
+
+    Executions in the file are skipped when the same checkpoint is used
+    again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._done = set()
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        self._done.add(line)
+        self._file = open(path, 'a')
+
+    @staticmethod
+    def _line(workflow_id, run_id):
+        return '%s %s' % (workflow_id, run_id)
+
+    def __contains__(self, execution):
+        return self._line(execution.workflow_id, execution.run_id) in self._done
+
+    def __len__(self):
+        return len(self._done)
+
+    def add(self, execution):
+        line = self._line(execution.workflow_id, execution.run_id)
+        with self._lock:
+            self._done.add(line)
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def run(executions, action, concurrency=10, rate=None, checkpoint=None):
+    """Call ``action`` on executions concurrently.
+
+    :param executions: Iterable of ``tasks.WorkflowExecution`` instances.
+                       Consumed lazily.
+    :param action: Callable taking a ``tasks.WorkflowExecution``.
+    :param concurrency: Number of concurrent calls.
+    :param rate: Maximum calls per second (optional).
+    :param checkpoint: Path of a checkpoint file (optional).
+    :returns: A generator of ``BulkResult`` tuples, in completion order.
+    """
+    bucket = TokenBucket(rate) if rate else None
+    done = Checkpoint(checkpoint) if checkpoint else None
+
+    def call(execution):
+        if bucket is not None:
+            bucket.acquire()
+        action(execution)
+        if done is not None:
+            done.add(execution)
+
+    if done is not None:
+        executions = (e for e in executions if e not in done)
+    try:
+        for execution, result, exc in pool.imap_unordered(
+                call, executions, concurrency):
+            yield BulkResult(execution.workflow_id, execution.run_id, exc)
+    finally:
+        if done is not None:
+            done.close()
@@ -40,6 +40,9 @@ _decision_types = [
         "StartChildWorkflowExecution",
         ]
 
+# Maximum number of decisions in one RespondDecisionTaskCompleted call.
+MAX_DECISIONS = 100
+
 def _attr_key_name(s):
     return s[0].lower() + s[1:] + 'DecisionAttributes'
 
@@ -58,3 +61,23 @@ def skeleton(decision_type):
     attributes_dict = {}
     decision = {'decisionType': decision_type, attributes_key: attributes_dict}
     return decision, attributes_dict
+
+
+def from_template(decision_type, template):
+    """Decision built from a template of attributes.
+
+    The template and the dicts and lists in it are copied, so decisions
+    built from it may be modified.
+
+    :returns: Same as ``skeleton``.
+    """
+    attributes_key = _attr_key_lookup[decision_type]
+    attributes_dict = {}
+    for key, value in template.items():
+        if isinstance(value, dict):
+            value = dict(value)
+        elif isinstance(value, list):
+            value = list(value)
+        attributes_dict[key] = value
+    decision = {'decisionType': decision_type, attributes_key: attributes_dict}
+    return decision, attributes_dict
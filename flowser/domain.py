@@ -18,13 +18,31 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import collections
+import json
+import os
+import tempfile
+
 from boto.swf.exceptions import SWFDomainAlreadyExistsError
+from boto.swf.exceptions import SWFWorkflowExecutionAlreadyStartedError
 
+from flowser import aio
+from flowser import metrics
+from flowser import pool
 from flowser import tasks
 from flowser.exceptions import Error
 from flowser.exceptions import EmptyTaskPollResult
 
 
+# Outcome of starting one execution with ``Domain.start_many``. ``run_id`` is
+# None if the execution was already started or if starting it failed, in
+# which case ``error`` holds the exception. ``workflow_id`` is None if no id
+# could be generated from the input.
+StartResult = collections.namedtuple(
+        'StartResult',
+        ['input', 'workflow_id', 'run_id', 'already_started', 'error'])
+
+
 class Domain(object):
     """Represents a Simple Workflow domain.
 
@@ -40,6 +58,30 @@ class Domain(object):
     workflow_types = None
     activity_types = None
 
+    # A ``history.HistoryCache`` instance keeping histories between decision
+    # tasks of the same workflow execution (optional).
+    history_cache = None
+
+    # A ``visibility.VisibilityCache`` instance keeping results of
+    # ``types.Workflow.iter_open`` and ``iter_closed`` queries (optional).
+    visibility_cache = None
+
+    # A ``metrics.Instrumentation`` instance receiving counters and timings,
+    # such as a ``metrics.Registry``. The default does nothing.
+    instrumentation = metrics.NOOP
+
+    # A ``profiling.DecisionProfiler`` instance profiling decision tasks
+    # from ``decisions`` (optional).
+    decision_profiler = None
+
+    # A ``tracing.Tracer`` instance recording trace spans of starts,
+    # decision tasks and activity tasks (optional).
+    tracer = None
+
+    # Size of the thread pool running API calls for the asyncio interface.
+    # Every open long poll occupies one thread.
+    async_threads = 100
+
     def __init__(self, conn):
         """
         :param conn: A ``boto.swf`` connection.
@@ -56,6 +98,97 @@ class Domain(object):
         types = (self.workflow_types or []) + (self.activity_types or [])
         [t(self)._register(raise_exists=raise_exists) for t in types]
 
+    def register_missing(self, fingerprint=None, concurrency=10):
+        """Register the domain and the types that are not registered yet.
+
+        Registered types are listed once per kind, and only missing types
+        are registered, concurrently. This takes a few requests instead of
+        one per type.
+
+        If ``fingerprint`` is given, the registered types are recorded in
+        that file, and later calls with the same domain and types return
+        without any requests.
+
+        :param fingerprint: Path of a fingerprint file (optional).
+        :param concurrency: Number of concurrent registrations.
+        :returns: The list of types that were registered.
+        """
+        types = (self.workflow_types or []) + (self.activity_types or [])
+        current = self._registration_fingerprint(types)
+        if fingerprint is not None and \
+                self._read_fingerprint(fingerprint) == current:
+            return []
+
+        try:
+            self.conn.register_domain(self.name, self.retention_period)
+        except SWFDomainAlreadyExistsError:
+            pass
+
+        registered = set()
+        for list_func_name, type_info_key in set(
+                (t._list_func_name, t._type_info_key) for t in types):
+            registered.update(
+                    (list_func_name, name, version) for name, version in
+                    self._list_registered(list_func_name, type_info_key))
+        missing = [t for t in types if
+                   (t._list_func_name, t.name, t.version) not in registered]
+
+        def register(t):
+            t(self)._register()
+        for t, result, exc in pool.imap_unordered(
+                register, missing, concurrency):
+            if exc is not None:
+                raise exc
+
+        if fingerprint is not None:
+            self._write_fingerprint(fingerprint, current)
+        return missing
+
+    def _list_registered(self, list_func_name, type_info_key):
+        """Iterate over (name, version) of registered types of a kind. """
+        list_func = getattr(self.conn, list_func_name)
+        next_page_token = None
+        while True:
+            result = list_func(self.name, 'REGISTERED',
+                               next_page_token=next_page_token)
+            for info in result.get('typeInfos', []):
+                t = info[type_info_key]
+                yield t['name'], t['version']
+            next_page_token = result.get('nextPageToken')
+            if next_page_token is None:
+                return
+
+    def _registration_fingerprint(self, types):
+        return {
+                'domain': self.name,
+                'retention_period': self.retention_period,
+                'types': sorted([t._reg_func_name, t.name, t.version]
+                                for t in types),
+                }
+
+    @staticmethod
+    def _read_fingerprint(path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    @staticmethod
+    def _write_fingerprint(path, fingerprint):
+        # Write to a temporary file and rename it into place, so an
+        # interrupted write never leaves a partial fingerprint.
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(fingerprint, f)
+            os.rename(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
     def start(self, t, input):
         """Start execution.
 
@@ -66,6 +199,39 @@ class Domain(object):
         """
         return t(self)._start(input)
 
+    def start_many(self, t, inputs, concurrency=10):
+        """Start many executions concurrently.
+
+        Executions are started on ``concurrency`` threads, which is also the
+        maximum number of requests in flight. Inputs are consumed lazily.
+        Executions that were already started count as successful.
+
+        :param t: Subclass of ``types.Workflow``.
+        :param inputs: Iterable of inputs.
+        :param concurrency: Number of concurrent requests.
+        :returns: A generator of ``StartResult`` tuples, in completion order.
+        """
+        instance = t(self)
+        static_kwargs = instance._get_static_start_kwargs()
+
+        def start(input):
+            return instance._start(input, static_kwargs=static_kwargs)
+
+        for input, result, exc in pool.imap_unordered(
+                start, inputs, concurrency):
+            try:
+                workflow_id = instance.get_id_from_input(input)
+            except Exception:
+                # The start failed with the same error, see ``exc``.
+                workflow_id = None
+            if exc is None:
+                yield StartResult(input, workflow_id, result['runId'],
+                                  False, None)
+            elif isinstance(exc, SWFWorkflowExecutionAlreadyStartedError):
+                yield StartResult(input, workflow_id, None, True, None)
+            else:
+                yield StartResult(input, workflow_id, None, False, exc)
+
     def decisions(self, t):
         """High-level interface to iterate over decision tasks.
 
@@ -75,7 +241,8 @@ class Domain(object):
         """
         poll_kwargs = {'reverse_order': True}
         return self._poll_indefinitely(
-                t, '_poll_for_decision_task', tasks.Decision, poll_kwargs)
+                t, '_poll_for_decision_task', tasks.Decision, poll_kwargs,
+                profiler=self.decision_profiler)
 
     def activities(self, t):
         """High-level interface to iterate over activity tasks.
@@ -87,7 +254,76 @@ class Domain(object):
         return self._poll_indefinitely(
                 t, '_poll_for_activity_task', tasks.Activity)
 
-    def _poll_indefinitely(self, t, method_name, task_class, poll_kwargs=None):
+    def adecisions(self, t):
+        """Asynchronous interface to iterate over decision tasks.
+
+        Use with ``async for``. Requires Python 3.
+
+        History pages beyond the first one are fetched synchronously when
+        ``Decision.events`` is iterated.
+
+        :param t: Subclass of ``types.Type``.
+        """
+        poll_kwargs = {'reverse_order': True}
+        return aio.TaskIterator(
+                self, t, '_poll_for_decision_task', tasks.Decision,
+                poll_kwargs)
+
+    def aactivities(self, t):
+        """Asynchronous interface to iterate over activity tasks.
+
+        Use with ``async for``. Requires Python 3.
+
+        :param t: Subclass of ``types.Type``.
+        """
+        return aio.TaskIterator(
+                self, t, '_poll_for_activity_task', tasks.Activity)
+
+    def run_activity_workers(self, types, handler, pollers=1,
+                             max_in_flight=None, processes=None,
+                             max_pollers=None, wait=True):
+        """Handle activity tasks concurrently.
+
+        Several poll loops run on threads and hand each task over to a
+        bounded set of handler threads. The handler is called with a
+        ``tasks.Activity`` instance and the task is completed with its return
+        value, or failed if it raises.
+
+        If ``processes`` is given, handlers run in that many worker processes
+        instead. The handler must then be picklable and is called with the
+        task input only. Polling and responding stay in this process.
+
+        :param types: List of ``types.Activity`` subclasses.
+        :param handler: Callable taking a ``tasks.Activity`` (or the task
+                        input if ``processes`` is given).
+        :param pollers: Number of poll loops per activity type.
+        :param max_in_flight: Maximum number of tasks handled at once.
+                              Defaults to 10, or to ``processes`` if given.
+        :param processes: Number of worker processes (optional).
+        :param max_pollers: If given, the number of poll loops per type is
+                            scaled between ``pollers`` and ``max_pollers``
+                            with the task list backlog.
+        :param wait: Block until the pool is stopped.
+        :returns: A ``pool.ActivityWorkerPool`` instance.
+        """
+        if processes is None:
+            if max_in_flight is None:
+                max_in_flight = 10
+            worker_pool = pool.ActivityWorkerPool(
+                    self, types, handler, pollers=pollers,
+                    max_in_flight=max_in_flight, max_pollers=max_pollers)
+        else:
+            worker_pool = pool.ProcessActivityWorkerPool(
+                    self, types, handler, processes=processes,
+                    pollers=pollers, max_in_flight=max_in_flight,
+                    max_pollers=max_pollers)
+        worker_pool.start()
+        if wait:
+            worker_pool.wait()
+        return worker_pool
+
+    def _poll_indefinitely(self, t, method_name, task_class, poll_kwargs=None,
+                           profiler=None):
         instance = t(self)
         poll_method = getattr(instance, method_name)
         kwargs = {}
@@ -98,5 +334,15 @@ class Domain(object):
                 result = poll_method(**kwargs)
             except EmptyTaskPollResult:
                 continue
-            else:
+            if profiler is None:
                 yield task_class(result, instance)
+                continue
+            # The task is handled by the caller between the yield and the
+            # next iteration, on this thread.
+            session = profiler.start()
+            task = None
+            try:
+                task = task_class(result, instance)
+                yield task
+            finally:
+                profiler.stop(session, task)
@@ -81,35 +81,80 @@ def _attr_key_name(s):
 _attr_keys = map(_attr_key_name, _event_types)
 _attr_key_lookup = dict(zip(_event_types, _attr_keys))
 
+# Small integer codes for event types, used by compact history storage.
+_event_type_codes = dict((t, i) for i, t in enumerate(_event_types))
+
 _auto_unserialize_attrs = {
         "ActivityTaskCompleted": ['result'],
         }
 
-def attrs(result):
-    """Get event attributes.
+def raw_attrs(result):
+    """Get event attributes as returned by the API.
 
     :param result: An event structure returned from the API.
     :returns: The attributes dict.
     """
-    event_type = result['eventType']
-    attributes_key = _attr_key_lookup[event_type]
-    ev_attrs = result[attributes_key]
-    for key in _auto_unserialize_attrs.get(event_type, []):
-        value = ev_attrs[key]
+    return result[_attr_key_lookup[result['eventType']]]
+
+
+def attrs(result):
+    """Get event attributes with serialized payloads decoded.
+
+    The event structure is not modified.
+
+    :param result: An event structure returned from the API.
+    :returns: A new attributes dict, or the raw attributes dict if the event
+              type has no payloads to decode.
+    """
+    return _decode_attrs(result['eventType'], raw_attrs(result))
+
+
+def _decode_attrs(event_type, ev_attrs):
+    keys = _auto_unserialize_attrs.get(event_type)
+    if not keys:
+        return ev_attrs
+    ev_attrs = dict(ev_attrs)
+    for key in keys:
         try:
-            ev_attrs[key] = serializing.loads(value)
-        except TypeError:
+            ev_attrs[key] = serializing.loads(ev_attrs[key])
+        except (KeyError, TypeError):
             pass
     return ev_attrs
 
 
 class Event(object):
+    """A history event.
+
+    Payloads such as activity results are decoded the first time ``attrs``
+    is accessed. ``raw_attrs`` holds the attributes as returned by the API.
+    """
+
+    __slots__ = ['id', 'time_stamp', 'type', 'raw_attrs', '_attrs',
+                 '__weakref__']
 
     def __init__(self, result):
         self.id = result['eventId']
         self.time_stamp = result['eventTimestamp']
         self.type = result['eventType']
-        self.attrs = attrs(result)
+        self.raw_attrs = raw_attrs(result)
+        self._attrs = None
+
+    @classmethod
+    def from_fields(cls, event_id, time_stamp, event_type, ev_raw_attrs):
+        """Create an event from already extracted fields. """
+        event = cls.__new__(cls)
+        event.id = event_id
+        event.time_stamp = time_stamp
+        event.type = event_type
+        event.raw_attrs = ev_raw_attrs
+        event._attrs = None
+        return event
+
+    @property
+    def attrs(self):
+        if self._attrs is None:
+            self._attrs = _decode_attrs(self.type, self.raw_attrs)
+        return self._attrs
 
     def __repr__(self):
         return "<Event id(%s) type(%s) time_stamp(%s)>" % (
@@ -0,0 +1,847 @@
+# Copyright (c) 2012 Memoto AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""In-memory Simple Workflow service.
+
+The purpose is to run, measure and profile flowser without AWS.
+``FakeConnection`` implements the ``boto.swf`` connection methods used by
+flowser and keeps all state in memory. Pass it to ``Domain`` instead of a
+connection::
+
+    domain = MyDomain(FakeConnection(latency=0.02))
+    domain.register()
+
+Decision tasks are scheduled when executions start, and when activity
+tasks, timers and child executions close, signals arrive or cancellation
+is requested. Histories are paginated like the service does.
+
+Simulated latency and throttling can be configured. Throttled calls raise
+``SWFResponseError`` with a ``ThrottlingException`` code, as the service
+does.
+
+Timeouts, child policies and continue-as-new are not simulated.
+"""
+import collections
+import functools
+import threading
+import time
+import uuid
+
+from boto.exception import SWFResponseError
+from boto.swf.exceptions import SWFDomainAlreadyExistsError
+from boto.swf.exceptions import SWFTypeAlreadyExistsError
+from boto.swf.exceptions import SWFWorkflowExecutionAlreadyStartedError
+
+from flowser.decisions import _attr_key_lookup as _decision_attr_keys
+from flowser.events import _attr_key_lookup as _event_attr_keys
+from flowser.throttling import TokenBucket
+
+# Default and maximum page size of the service.
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def _fault(error_class, fault, message):
+    return error_class(400, 'Bad Request', {
+            '__type': 'com.amazonaws.swf.base.model#' + fault,
+            'message': message,
+            })
+
+
+def _api(method):
+    """Decorator of API methods, applying throttling and latency. """
+    name = method.__name__
+
+    @functools.wraps(method)
+    def call(self, *args, **kwargs):
+        self._before_call(name)
+        return method(self, *args, **kwargs)
+    return call
+
+
+class _Execution(object):
+    """State of one workflow execution. """
+
+    def __init__(self, domain, workflow_id, workflow_type, task_list,
+                 tag_list, parent=None, parent_initiated_event_id=None):
+        self.domain = domain
+        self.workflow_id = workflow_id
+        self.run_id = uuid.uuid4().hex
+        self.workflow_type = workflow_type
+        self.task_list = task_list
+        self.tag_list = tag_list or []
+        self.parent = parent
+        self.parent_initiated_event_id = parent_initiated_event_id
+        self.start_timestamp = time.time()
+        self.close_timestamp = None
+        self.close_status = None
+        self.cancel_requested = False
+        self.events = []
+        # None, 'scheduled' or 'started'.
+        self.decision_state = None
+        self.decision_scheduled_event_id = None
+        self.decision_started_event_id = None
+        self.decision_again = False
+        self.previous_started_event_id = 0
+        self.open_activity_ids = set()
+        # Child workflow id -> (initiated event id, started event id).
+        self.children = {}
+
+    @property
+    def is_open(self):
+        return self.close_status is None
+
+    @property
+    def execution(self):
+        return {'workflowId': self.workflow_id, 'runId': self.run_id}
+
+    def add_event(self, event_type, **attrs):
+        event_id = len(self.events) + 1
+        # Like the service, leave out attributes without a value.
+        attrs = dict((k, v) for k, v in attrs.items() if v is not None)
+        self.events.append({
+                'eventId': event_id,
+                'eventTimestamp': time.time(),
+                'eventType': event_type,
+                _event_attr_keys[event_type]: attrs,
+                })
+        return event_id
+
+    def info(self):
+        info = {
+                'execution': self.execution,
+                'workflowType': self.workflow_type,
+                'startTimestamp': self.start_timestamp,
+                'executionStatus': 'OPEN' if self.is_open else 'CLOSED',
+                'cancelRequested': self.cancel_requested,
+                'tagList': self.tag_list,
+                }
+        if not self.is_open:
+            info['closeTimestamp'] = self.close_timestamp
+            info['closeStatus'] = self.close_status
+        if self.parent is not None:
+            info['parent'] = self.parent.execution
+        return info
+
+
+class FakeConnection(object):
+    """In-memory stand-in for a ``boto.swf`` connection.
+
+    All methods are thread-safe. Long polls wait up to ``poll_timeout``
+    seconds for a task.
+    """
+
+    def __init__(self, latency=0.0, rates=None, poll_timeout=60.0,
+                 page_size=DEFAULT_PAGE_SIZE):
+        """
+        :param latency: Seconds added to every call, or a dict mapping
+                        method names to seconds.
+        :param rates: Dict mapping method names to a rate (calls per
+                      second) or a ``(rate, burst)`` tuple. Calls over the
+                      rate are throttled.
+        :param poll_timeout: Seconds a poll waits before returning an
+                             empty result.
+        :param page_size: Default page size of histories and lists.
+        """
+        self.latency = latency
+        self.poll_timeout = poll_timeout
+        self.page_size = page_size
+        self._buckets = {}
+        for name, rate in (rates or {}).items():
+            if isinstance(rate, tuple):
+                self._buckets[name] = TokenBucket(*rate)
+            else:
+                self._buckets[name] = TokenBucket(rate)
+        # Calls and throttled calls by method name.
+        self.calls = collections.defaultdict(int)
+        self.throttled = collections.defaultdict(int)
+
+        self._cond = threading.Condition()
+        # Domain name -> retention period.
+        self._domains = {}
+        # (domain, list method name, name, version) -> registration dict.
+        self._types = {}
+        # Run id -> _Execution.
+        self._executions = {}
+        # (domain, workflow id) -> open _Execution.
+        self._open = {}
+        # (domain, task list) -> deque of _Execution.
+        self._decision_queues = collections.defaultdict(collections.deque)
+        # (domain, task list) -> deque of activity task dicts.
+        self._activity_queues = collections.defaultdict(collections.deque)
+        # Task token -> (_Execution, task dict or None).
+        self._tokens = {}
+
+    def _before_call(self, name):
+        with self._cond:
+            self.calls[name] += 1
+        bucket = self._buckets.get(name)
+        if bucket is not None and not bucket.try_acquire():
+            with self._cond:
+                self.throttled[name] += 1
+            raise _fault(SWFResponseError, 'ThrottlingException',
+                         'Rate exceeded')
+        if isinstance(self.latency, dict):
+            latency = self.latency.get(name, 0)
+        else:
+            latency = self.latency
+        if latency:
+            time.sleep(latency)
+
+    def _check_domain(self, domain):
+        if domain not in self._domains:
+            raise _fault(SWFResponseError, 'UnknownResourceFault',
+                         'Unknown domain: %s' % domain)
+
+    def _get_execution(self, domain, workflow_id, run_id=None):
+        self._check_domain(domain)
+        if run_id is None:
+            execution = self._open.get((domain, workflow_id))
+        else:
+            execution = self._executions.get(run_id)
+        if execution is None or execution.domain != domain or \
+                execution.workflow_id != workflow_id:
+            raise _fault(SWFResponseError, 'UnknownResourceFault',
+                         'Unknown execution: %s' % workflow_id)
+        return execution
+
+    def _get_open_execution(self, domain, workflow_id, run_id=None):
+        execution = self._get_execution(domain, workflow_id, run_id)
+        if not execution.is_open:
+            raise _fault(SWFResponseError, 'UnknownResourceFault',
+                         'Execution is closed: %s' % workflow_id)
+        return execution
+
+    def _pop_token(self, task_token):
+        entry = self._tokens.pop(task_token, None)
+        if entry is None or not entry[0].is_open:
+            raise _fault(SWFResponseError, 'UnknownResourceFault',
+                         'Unknown task token')
+        return entry
+
+    # Registration.
+
+    @_api
+    def register_domain(self, name, workflow_execution_retention_period_in_days,
+                        description=None):
+        with self._cond:
+            if name in self._domains:
+                raise _fault(SWFDomainAlreadyExistsError,
+                             'DomainAlreadyExistsFault', name)
+            self._domains[name] = workflow_execution_retention_period_in_days
+        return {}
+
+    def _register_type(self, list_func_name, domain, name, version, **kwargs):
+        with self._cond:
+            self._check_domain(domain)
+            key = (domain, list_func_name, name, version)
+            if key in self._types:
+                raise _fault(SWFTypeAlreadyExistsError,
+                             'TypeAlreadyExistsFault', name)
+            self._types[key] = kwargs
+        return {}
+
+    @_api
+    def register_activity_type(self, domain, name, version, task_list=None,
+                               **kwargs):
+        return self._register_type('list_activity_types', domain, name,
+                                   version, task_list=task_list)
+
+    @_api
+    def register_workflow_type(self, domain, name, version, task_list=None,
+                               **kwargs):
+        return self._register_type('list_workflow_types', domain, name,
+                                   version, task_list=task_list)
+
+    def _list_types(self, list_func_name, type_key, domain,
+                    registration_status, name=None, maximum_page_size=None,
+                    next_page_token=None, reverse_order=None):
+        with self._cond:
+            self._check_domain(domain)
+            infos = []
+            if registration_status == 'REGISTERED':
+                for d, f, n, v in sorted(self._types):
+                    if d == domain and f == list_func_name and \
+                            name in (None, n):
+                        infos.append({
+                                type_key: {'name': n, 'version': v},
+                                'status': 'REGISTERED',
+                                })
+        if reverse_order:
+            infos.reverse()
+        return self._page(infos, 'typeInfos', maximum_page_size,
+                          next_page_token)
+
+    @_api
+    def list_activity_types(self, domain, registration_status, **kwargs):
+        return self._list_types('list_activity_types', 'activityType',
+                                domain, registration_status, **kwargs)
+
+    @_api
+    def list_workflow_types(self, domain, registration_status, **kwargs):
+        return self._list_types('list_workflow_types', 'workflowType',
+                                domain, registration_status, **kwargs)
+
+    def _page(self, items, key, maximum_page_size, next_page_token):
+        size = min(maximum_page_size or self.page_size, MAX_PAGE_SIZE)
+        offset = int(next_page_token or 0)
+        result = {key: items[offset:offset + size]}
+        if offset + size < len(items):
+            result['nextPageToken'] = str(offset + size)
+        return result
+
+    def _registered_task_list(self, domain, list_func_name, t):
+        registration = self._types.get(
+                (domain, list_func_name, t['name'], t['version']))
+        if registration is None:
+            return None, False
+        return registration.get('task_list'), True
+
+    # Executions.
+
+    def _start(self, domain, workflow_id, workflow_type, task_list,
+               input=None, tag_list=None, child_policy=None,
+               execution_start_to_close_timeout=None,
+               task_start_to_close_timeout=None, parent=None,
+               parent_initiated_event_id=None):
+        """Start an execution. Called with the lock held. """
+        if (domain, workflow_id) in self._open:
+            raise _fault(SWFWorkflowExecutionAlreadyStartedError,
+                         'WorkflowExecutionAlreadyStartedFault', workflow_id)
+        default_task_list, registered = self._registered_task_list(
+                domain, 'list_workflow_types', workflow_type)
+        if not registered:
+            raise _fault(SWFResponseError, 'UnknownResourceFault',
+                         'Unknown type: %s' % workflow_type['name'])
+        task_list = task_list or default_task_list
+        if task_list is None:
+            raise _fault(SWFResponseError, 'DefaultUndefinedFault',
+                         'No task list')
+        execution = _Execution(domain, workflow_id, workflow_type, task_list,
+                               tag_list, parent, parent_initiated_event_id)
+        attrs = {
+                'workflowType': workflow_type,
+                'taskList': {'name': task_list},
+                'childPolicy': child_policy,
+                'executionStartToCloseTimeout':
+                        execution_start_to_close_timeout,
+                'taskStartToCloseTimeout': task_start_to_close_timeout,
+                'tagList': execution.tag_list,
+                }
+        if input is not None:
+            attrs['input'] = input
+        if parent is not None:
+            attrs['parentWorkflowExecution'] = parent.execution
+            attrs['parentInitiatedEventId'] = parent_initiated_event_id
+        execution.add_event('WorkflowExecutionStarted', **attrs)
+        self._executions[execution.run_id] = execution
+        self._open[(domain, workflow_id)] = execution
+        self._schedule_decision(execution)
+        return execution
+
+    @_api
+    def start_workflow_execution(self, domain, workflow_id, workflow_name,
+                                 workflow_version, task_list=None,
+                                 child_policy=None,
+                                 execution_start_to_close_timeout=None,
+                                 input=None, tag_list=None,
+                                 task_start_to_close_timeout=None):
+        with self._cond:
+            self._check_domain(domain)
+            execution = self._start(
+                    domain, workflow_id,
+                    {'name': workflow_name, 'version': workflow_version},
+                    task_list, input=input, tag_list=tag_list,
+                    child_policy=child_policy,
+                    execution_start_to_close_timeout=\
+                            execution_start_to_close_timeout,
+                    task_start_to_close_timeout=task_start_to_close_timeout)
+            return {'runId': execution.run_id}
+
+    @_api
+    def signal_workflow_execution(self, domain, signal_name, workflow_id,
+                                  input=None, run_id=None):
+        with self._cond:
+            execution = self._get_open_execution(domain, workflow_id, run_id)
+            attrs = {'signalName': signal_name}
+            if input is not None:
+                attrs['input'] = input
+            execution.add_event('WorkflowExecutionSignaled', **attrs)
+            self._schedule_decision(execution)
+        return {}
+
+    @_api
+    def request_cancel_workflow_execution(self, domain, workflow_id,
+                                          run_id=None):
+        with self._cond:
+            execution = self._get_open_execution(domain, workflow_id, run_id)
+            if not execution.cancel_requested:
+                execution.cancel_requested = True
+                execution.add_event('WorkflowExecutionCancelRequested')
+                self._schedule_decision(execution)
+        return {}
+
+    @_api
+    def terminate_workflow_execution(self, domain, workflow_id,
+                                     child_policy=None, details=None,
+                                     reason=None, run_id=None):
+        with self._cond:
+            execution = self._get_open_execution(domain, workflow_id, run_id)
+            execution.add_event('WorkflowExecutionTerminated',
+                                childPolicy=child_policy, details=details,
+                                reason=reason, cause='OPERATOR_INITIATED')
+            self._close(execution, 'TERMINATED')
+        return {}
+
+    @_api
+    def describe_workflow_execution(self, domain, run_id, workflow_id):
+        with self._cond:
+            execution = self._get_execution(domain, workflow_id, run_id)
+            return {
+                    'executionInfo': execution.info(),
+                    'openCounts': {
+                            'openActivityTasks':
+                                    len(execution.open_activity_ids),
+                            'openDecisionTasks':
+                                    int(execution.decision_state is not None),
+                            'openChildWorkflowExecutions': len([
+                                    1 for w in execution.children
+                                    if (domain, w) in self._open]),
+                            'openTimers': 0,
+                            },
+                    }
+
+    def _list_executions(self, domain, is_open, oldest_date, latest_date,
+                         close_oldest_date=None, close_latest_date=None,
+                         close_status=None, tag=None, workflow_id=None,
+                         workflow_name=None, workflow_version=None,
+                         maximum_page_size=None, next_page_token=None,
+                         reverse_order=None):
+        with self._cond:
+            self._check_domain(domain)
+            matching = []
+            for execution in self._executions.values():
+                if execution.domain != domain or \
+                        execution.is_open != is_open:
+                    continue
+                if oldest_date is not None and \
+                        execution.start_timestamp < oldest_date:
+                    continue
+                if latest_date is not None and \
+                        execution.start_timestamp > latest_date:
+                    continue
+                if close_oldest_date is not None and \
+                        execution.close_timestamp < close_oldest_date:
+                    continue
+                if close_latest_date is not None and \
+                        execution.close_timestamp > close_latest_date:
+                    continue
+                if close_status not in (None, execution.close_status):
+                    continue
+                if tag is not None and tag not in execution.tag_list:
+                    continue
+                if workflow_id not in (None, execution.workflow_id):
+                    continue
+                if workflow_name not in (None,
+                                         execution.workflow_type['name']):
+                    continue
+                if workflow_version not in (
+                        None, execution.workflow_type['version']):
+                    continue
+                matching.append(execution)
+            # Newest first, unless reversed.
+            matching.sort(key=lambda e: e.start_timestamp,
+                          reverse=not reverse_order)
+            infos = [execution.info() for execution in matching]
+        return self._page(infos, 'executionInfos', maximum_page_size,
+                          next_page_token)
+
+    @_api
+    def list_open_workflow_executions(self, domain, oldest_date,
+                                      latest_date=None, **kwargs):
+        return self._list_executions(domain, True, oldest_date, latest_date,
+                                     **kwargs)
+
+    @_api
+    def list_closed_workflow_executions(self, domain, start_latest_date=None,
+                                        start_oldest_date=None, **kwargs):
+        return self._list_executions(domain, False, start_oldest_date,
+                                     start_latest_date, **kwargs)
+
+    # Histories.
+
+    def _history_page(self, execution, length, offset, maximum_page_size,
+                      reverse_order, token_prefix):
+        """Page of the first ``length`` events. Called with the lock held. """
+        size = min(maximum_page_size or self.page_size, MAX_PAGE_SIZE)
+        end = min(offset + size, length)
+        if reverse_order:
+            events = execution.events[length - end:length - offset][::-1]
+        else:
+            events = execution.events[offset:end]
+        result = {'events': events}
+        if end < length:
+            result['nextPageToken'] = '%s/%d/%d' % (token_prefix, length, end)
+        return result
+
+    @staticmethod
+    def _parse_page_token(next_page_token):
+        prefix, length, offset = next_page_token.rsplit('/', 2)
+        return prefix, int(length), int(offset)
+
+    @_api
+    def get_workflow_execution_history(self, domain, run_id, workflow_id,
+                                       maximum_page_size=None,
+                                       next_page_token=None,
+                                       reverse_order=None):
+        with self._cond:
+            execution = self._get_execution(domain, workflow_id, run_id)
+            length, offset = len(execution.events), 0
+            if next_page_token is not None:
+                _, length, offset = self._parse_page_token(next_page_token)
+            return self._history_page(execution, length, offset,
+                                      maximum_page_size, reverse_order,
+                                      run_id)
+
+    # Decision tasks.
+
+    def _schedule_decision(self, execution):
+        """Schedule a decision task. Called with the lock held. """
+        if not execution.is_open:
+            return
+        if execution.decision_state == 'started':
+            execution.decision_again = True
+            return
+        if execution.decision_state == 'scheduled':
+            return
+        execution.decision_state = 'scheduled'
+        execution.decision_scheduled_event_id = execution.add_event(
+                'DecisionTaskScheduled',
+                taskList={'name': execution.task_list})
+        self._decision_queues[(execution.domain, execution.task_list)] \
+                .append(execution)
+        self._cond.notify_all()
+
+    def _wait_for_task(self, queue):
+        """Pop an item from ``queue``, waiting up to ``poll_timeout``.
+
+        Called with the lock held. Items of closed executions are dropped.
+        """
+        deadline = time.time() + self.poll_timeout
+        while True:
+            while queue:
+                item = queue.popleft()
+                execution = item if isinstance(item, _Execution) \
+                        else item['execution']
+                if execution.is_open:
+                    return item
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            self._cond.wait(remaining)
+
+    @_api
+    def poll_for_decision_task(self, domain, task_list, identity=None,
+                               maximum_page_size=None, next_page_token=None,
+                               reverse_order=None):
+        with self._cond:
+            self._check_domain(domain)
+            if next_page_token is not None:
+                # Further pages of a task's history.
+                task_token, length, offset = self._parse_page_token(
+                        next_page_token)
+                entry = self._tokens.get(task_token)
+                if entry is None:
+                    raise _fault(SWFResponseError, 'UnknownResourceFault',
+                                 'Unknown page token')
+                execution = entry[0]
+            else:
+                execution = self._wait_for_task(
+                        self._decision_queues[(domain, task_list)])
+                if execution is None:
+                    return {'previousStartedEventId': 0,
+                            'startedEventId': 0}
+                execution.decision_state = 'started'
+                execution.decision_started_event_id = execution.add_event(
+                        'DecisionTaskStarted', identity=identity,
+                        scheduledEventId=\
+                                execution.decision_scheduled_event_id)
+                task_token = uuid.uuid4().hex
+                self._tokens[task_token] = (execution, None)
+                length, offset = len(execution.events), 0
+            result = self._history_page(execution, length, offset,
+                                        maximum_page_size, reverse_order,
+                                        task_token)
+            result.update({
+                    'taskToken': task_token,
+                    'startedEventId': execution.decision_started_event_id,
+                    'previousStartedEventId':
+                            execution.previous_started_event_id,
+                    'workflowExecution': execution.execution,
+                    'workflowType': execution.workflow_type,
+                    })
+            return result
+
+    @_api
+    def count_pending_decision_tasks(self, domain, task_list):
+        with self._cond:
+            self._check_domain(domain)
+            queue = self._decision_queues[(domain, task_list)]
+            return {'count': len([e for e in queue if e.is_open]),
+                    'truncated': False}
+
+    @_api
+    def respond_decision_task_completed(self, task_token, decisions=None,
+                                        execution_context=None):
+        with self._cond:
+            execution, _ = self._pop_token(task_token)
+            completed_id = execution.add_event(
+                    'DecisionTaskCompleted',
+                    executionContext=execution_context,
+                    scheduledEventId=execution.decision_scheduled_event_id,
+                    startedEventId=execution.decision_started_event_id)
+            execution.previous_started_event_id = \
+                    execution.decision_started_event_id
+            execution.decision_state = None
+            for decision in decisions or []:
+                if not execution.is_open:
+                    break
+                self._apply_decision(execution, decision, completed_id)
+            if execution.decision_again:
+                execution.decision_again = False
+                self._schedule_decision(execution)
+        return {}
+
+    def _apply_decision(self, execution, decision, completed_id):
+        decision_type = decision['decisionType']
+        attrs = decision.get(_decision_attr_keys[decision_type], {})
+        handler = getattr(self, '_decide_' + decision_type, None)
+        if handler is None:
+            raise _fault(SWFResponseError, 'ValidationException',
+                         'Unsupported decision: %s' % decision_type)
+        handler(execution, attrs, completed_id)
+
+    def _decide_ScheduleActivityTask(self, execution, attrs, completed_id):
+        activity_type = attrs['activityType']
+        activity_id = attrs['activityId']
+        task_list = attrs.get('taskList', {}).get('name')
+        default_task_list, registered = self._registered_task_list(
+                execution.domain, 'list_activity_types', activity_type)
+        cause = None
+        if not registered:
+            cause = 'ACTIVITY_TYPE_DOES_NOT_EXIST'
+        elif activity_id in execution.open_activity_ids:
+            cause = 'ACTIVITY_ID_ALREADY_IN_USE'
+        elif (task_list or default_task_list) is None:
+            cause = 'DEFAULT_TASK_LIST_UNDEFINED'
+        if cause is not None:
+            execution.add_event(
+                    'ScheduleActivityTaskFailed', activityId=activity_id,
+                    activityType=activity_type, cause=cause,
+                    decisionTaskCompletedEventId=completed_id)
+            self._schedule_decision(execution)
+            return
+        task_list = task_list or default_task_list
+        event_attrs = dict(attrs)
+        event_attrs['taskList'] = {'name': task_list}
+        event_attrs['decisionTaskCompletedEventId'] = completed_id
+        scheduled_id = execution.add_event('ActivityTaskScheduled',
+                                           **event_attrs)
+        execution.open_activity_ids.add(activity_id)
+        self._activity_queues[(execution.domain, task_list)].append({
+                'execution': execution,
+                'activityId': activity_id,
+                'activityType': activity_type,
+                'input': attrs.get('input'),
+                'scheduledEventId': scheduled_id,
+                })
+        self._cond.notify_all()
+
+    def _decide_RecordMarker(self, execution, attrs, completed_id):
+        execution.add_event('MarkerRecorded', markerName=attrs['markerName'],
+                            details=attrs.get('details'),
+                            decisionTaskCompletedEventId=completed_id)
+
+    def _decide_StartTimer(self, execution, attrs, completed_id):
+        started_id = execution.add_event(
+                'TimerStarted', timerId=attrs['timerId'],
+                startToFireTimeout=attrs['startToFireTimeout'],
+                control=attrs.get('control'),
+                decisionTaskCompletedEventId=completed_id)
+
+        def fire():
+            with self._cond:
+                if execution.is_open:
+                    execution.add_event('TimerFired',
+                                        timerId=attrs['timerId'],
+                                        startedEventId=started_id)
+                    self._schedule_decision(execution)
+        timer = threading.Timer(float(attrs['startToFireTimeout']), fire)
+        timer.daemon = True
+        timer.start()
+
+    def _decide_CompleteWorkflowExecution(self, execution, attrs,
+                                          completed_id):
+        execution.add_event('WorkflowExecutionCompleted',
+                            result=attrs.get('result'),
+                            decisionTaskCompletedEventId=completed_id)
+        self._close(execution, 'COMPLETED', result=attrs.get('result'))
+
+    def _decide_FailWorkflowExecution(self, execution, attrs, completed_id):
+        execution.add_event('WorkflowExecutionFailed',
+                            reason=attrs.get('reason'),
+                            details=attrs.get('details'),
+                            decisionTaskCompletedEventId=completed_id)
+        self._close(execution, 'FAILED', reason=attrs.get('reason'),
+                    details=attrs.get('details'))
+
+    def _decide_CancelWorkflowExecution(self, execution, attrs,
+                                        completed_id):
+        execution.add_event('WorkflowExecutionCanceled',
+                            details=attrs.get('details'),
+                            decisionTaskCompletedEventId=completed_id)
+        self._close(execution, 'CANCELED', details=attrs.get('details'))
+
+    def _decide_StartChildWorkflowExecution(self, execution, attrs,
+                                            completed_id):
+        workflow_id = attrs['workflowId']
+        event_attrs = dict(attrs)
+        event_attrs['decisionTaskCompletedEventId'] = completed_id
+        initiated_id = execution.add_event(
+                'StartChildWorkflowExecutionInitiated', **event_attrs)
+        try:
+            child = self._start(
+                    execution.domain, workflow_id, attrs['workflowType'],
+                    attrs.get('taskList', {}).get('name'),
+                    input=attrs.get('input'), tag_list=attrs.get('tagList'),
+                    child_policy=attrs.get('childPolicy'),
+                    execution_start_to_close_timeout=attrs.get(
+                            'executionStartToCloseTimeout'),
+                    task_start_to_close_timeout=attrs.get(
+                            'taskStartToCloseTimeout'),
+                    parent=execution, parent_initiated_event_id=initiated_id)
+        except SWFResponseError as exc:
+            if isinstance(exc, SWFWorkflowExecutionAlreadyStartedError):
+                cause = 'WORKFLOW_ALREADY_RUNNING'
+            else:
+                cause = 'WORKFLOW_TYPE_DOES_NOT_EXIST'
+            execution.add_event(
+                    'StartChildWorkflowExecutionFailed',
+                    workflowId=workflow_id,
+                    workflowType=attrs['workflowType'], cause=cause,
+                    control=attrs.get('control'),
+                    initiatedEventId=initiated_id,
+                    decisionTaskCompletedEventId=completed_id)
+        else:
+            started_id = execution.add_event(
+                    'ChildWorkflowExecutionStarted',
+                    workflowExecution=child.execution,
+                    workflowType=child.workflow_type,
+                    initiatedEventId=initiated_id)
+            execution.children[workflow_id] = (initiated_id, started_id)
+        self._schedule_decision(execution)
+
+    def _close(self, execution, close_status, **attrs):
+        """Close an execution. Called with the lock held. """
+        execution.close_status = close_status
+        execution.close_timestamp = time.time()
+        self._open.pop((execution.domain, execution.workflow_id), None)
+        for token, (e, _) in list(self._tokens.items()):
+            if e is execution:
+                del self._tokens[token]
+        parent = execution.parent
+        if parent is not None and parent.is_open:
+            initiated_id, started_id = parent.children[execution.workflow_id]
+            event_type = 'ChildWorkflowExecution' + \
+                    close_status.capitalize()
+            parent.add_event(event_type,
+                             workflowExecution=execution.execution,
+                             workflowType=execution.workflow_type,
+                             initiatedEventId=initiated_id,
+                             startedEventId=started_id, **attrs)
+            self._schedule_decision(parent)
+        self._cond.notify_all()
+
+    # Activity tasks.
+
+    @_api
+    def poll_for_activity_task(self, domain, task_list, identity=None):
+        with self._cond:
+            self._check_domain(domain)
+            task = self._wait_for_task(
+                    self._activity_queues[(domain, task_list)])
+            if task is None:
+                return {'startedEventId': 0}
+            execution = task['execution']
+            started_id = execution.add_event(
+                    'ActivityTaskStarted', identity=identity,
+                    scheduledEventId=task['scheduledEventId'])
+            task_token = uuid.uuid4().hex
+            task['startedEventId'] = started_id
+            self._tokens[task_token] = (execution, task)
+            result = {
+                    'activityId': task['activityId'],
+                    'activityType': task['activityType'],
+                    'startedEventId': started_id,
+                    'taskToken': task_token,
+                    'workflowExecution': execution.execution,
+                    }
+            if task['input'] is not None:
+                result['input'] = task['input']
+            return result
+
+    @_api
+    def count_pending_activity_tasks(self, domain, task_list):
+        with self._cond:
+            self._check_domain(domain)
+            queue = self._activity_queues[(domain, task_list)]
+            return {'count': len([t for t in queue
+                                  if t['execution'].is_open]),
+                    'truncated': False}
+
+    def _close_activity(self, task_token, event_type, **attrs):
+        with self._cond:
+            execution, task = self._pop_token(task_token)
+            if task is None:
+                raise _fault(SWFResponseError, 'UnknownResourceFault',
+                             'Not an activity task token')
+            execution.open_activity_ids.discard(task['activityId'])
+            execution.add_event(event_type,
+                                scheduledEventId=task['scheduledEventId'],
+                                startedEventId=task['startedEventId'],
+                                **attrs)
+            self._schedule_decision(execution)
+        return {}
+
+    @_api
+    def respond_activity_task_completed(self, task_token, result=None):
+        return self._close_activity(task_token, 'ActivityTaskCompleted',
+                                    result=result)
+
+    @_api
+    def respond_activity_task_failed(self, task_token, details=None,
+                                     reason=None):
+        return self._close_activity(task_token, 'ActivityTaskFailed',
+                                    details=details, reason=reason)
+
+    @_api
+    def respond_activity_task_canceled(self, task_token, details=None):
+        return self._close_activity(task_token, 'ActivityTaskCanceled',
+                                    details=details)
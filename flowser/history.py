@@ -0,0 +1,604 @@
+# Copyright (c) 2012 Memoto AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Workflow execution history.
+
+The purpose is to parse every history event once and to make lookups cheap.
+
+Events are kept in reverse order (most recent first), as returned by the API
+with ``reverse_order=True``. Pages are only fetched when a lookup cannot be
+answered from the events loaded so far.
+
+Complete histories may be kept in a ``HistoryCache`` between decision tasks
+of the same workflow execution. The next decision task then only fetches the
+pages with events that are new since.
+
+A ``PagePrefetcher`` may fetch pages ahead on a background thread while
+earlier pages are being processed.
+
+``StreamingHistory`` is a single pass alternative to ``History`` that drops
+every page once it has been iterated over. Only a summary chosen by the
+caller is kept, so memory use does not grow with the history length.
+"""
+from array import array
+import collections
+import threading
+import weakref
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from flowser.events import Event
+from flowser.events import _attr_key_lookup
+from flowser.events import _event_type_codes
+from flowser.events import _event_types
+from flowser.exceptions import Error
+from flowser.exceptions import LastPage
+
+_child_workflow_event_types = set([
+        "StartChildWorkflowExecutionInitiated",
+        "StartChildWorkflowExecutionFailed",
+        "ChildWorkflowExecutionStarted",
+        "ChildWorkflowExecutionCompleted",
+        "ChildWorkflowExecutionFailed",
+        "ChildWorkflowExecutionTimedOut",
+        "ChildWorkflowExecutionCanceled",
+        "ChildWorkflowExecutionTerminated",
+        ])
+
+
+def _child_workflow_id(ev_attrs):
+    if 'workflowId' in ev_attrs:
+        return ev_attrs['workflowId']
+    return ev_attrs['workflowExecution']['workflowId']
+
+
+class History(object):
+    """Indexed event history of a decision task.
+
+    Events are indexed by type, by event id, by marker name and by the
+    activity, timer and child workflow ids they refer to.
+
+    Storage is columnar: event ids, type codes and timestamps are kept in
+    arrays and only the attributes dict of each raw event is retained.
+    ``events.Event`` objects are created on access. An event stays the same
+    object (with its decoded payloads) for as long as it is referenced.
+
+    The attributes dicts are kept as returned by the API, since they are
+    the ``raw_attrs`` of events and payloads are decoded from them on
+    access. Only the envelope of each raw event is dropped, which saves
+    about a third of the memory of a history rather than most of it.
+    """
+
+    def __init__(self, events, next_page=None, base=None):
+        """
+        :param events: Raw events of the first page (most recent first).
+        :param next_page: Callable returning the raw events of the next page
+                          or raising ``LastPage``. If omitted, ``events`` is
+                          the complete history.
+        :param base: A complete ``History`` of the same workflow execution
+                     from an earlier decision task (optional). Paging stops
+                     when the events in ``base`` are reached.
+        """
+        self._next_page = next_page
+        self._complete = next_page is None
+        self._base = base
+        self._ids = array('l')
+        self._type_codes = array('B')
+        self._time_stamps = array('d')
+        self._attrs = []
+        self._live_events = weakref.WeakValueDictionary()
+        self._by_type = {}
+        self._by_activity_id = {}
+        self._by_scheduled_event_id = {}
+        self._by_timer_id = {}
+        self._by_marker_name = {}
+        self._by_child_workflow_id = {}
+        self._add_page(events)
+
+    def __iter__(self):
+        """Iterate over all events, fetching pages as needed. """
+        i = 0
+        while True:
+            while i < len(self._ids):
+                yield self._event(i)
+                i += 1
+            if not self._load_page():
+                return
+
+    def __len__(self):
+        """Number of events loaded so far. """
+        return len(self._ids)
+
+    @property
+    def complete(self):
+        """True if all pages have been loaded. """
+        return self._complete
+
+    @property
+    def newest_id(self):
+        """Id of the most recent event, or 0 if there are no events. """
+        if self._ids:
+            return self._ids[0]
+        return 0
+
+    @property
+    def oldest_id(self):
+        """Id of the oldest event loaded so far, or None. """
+        if self._ids:
+            return self._ids[-1]
+        return None
+
+    def _event(self, pos):
+        event = self._live_events.get(pos)
+        if event is None:
+            event = Event.from_fields(
+                    self._ids[pos], self._time_stamps[pos],
+                    _event_types[self._type_codes[pos]], self._attrs[pos])
+            self._live_events[pos] = event
+        return event
+
+    def _events(self, positions):
+        return [self._event(pos) for pos in positions]
+
+    def _load_page(self):
+        """Load the next page. Returns False if there are no more pages. """
+        if self._complete:
+            return False
+        try:
+            events = self._next_page()
+        except LastPage:
+            self._set_complete()
+            return False
+        self._add_page(events)
+        return True
+
+    def _load_all(self):
+        while self._load_page():
+            pass
+
+    def _add_page(self, events):
+        base = self._base
+        for result in events:
+            event_id = result['eventId']
+            if base is not None and event_id <= base.newest_id:
+                self._add_base()
+                return
+            event_type = result['eventType']
+            self._add(event_id, _event_type_codes[event_type],
+                      result['eventTimestamp'],
+                      result[_attr_key_lookup[event_type]])
+        if base is not None and self.oldest_id == base.newest_id + 1:
+            self._add_base()
+
+    def _add_base(self):
+        """Add the events of the base history and stop paging. """
+        base = self._base
+        for pos in range(len(base._ids)):
+            self._add(base._ids[pos], base._type_codes[pos],
+                      base._time_stamps[pos], base._attrs[pos])
+        self._base = None
+        self._set_complete()
+
+    def _set_complete(self):
+        # The pager is typically a bound method of the decision task. Drop
+        # it, so that cached histories do not keep old tasks alive.
+        self._complete = True
+        self._next_page = None
+
+    def _add(self, event_id, type_code, time_stamp, ev_attrs):
+        pos = len(self._ids)
+        self._ids.append(event_id)
+        self._type_codes.append(type_code)
+        self._time_stamps.append(time_stamp)
+        self._attrs.append(ev_attrs)
+        if type_code not in self._by_type:
+            self._by_type[type_code] = array('l')
+        self._by_type[type_code].append(pos)
+        event_type = _event_types[type_code]
+        if event_type in _child_workflow_event_types:
+            index, key = self._by_child_workflow_id, _child_workflow_id(ev_attrs)
+        elif 'activityId' in ev_attrs:
+            index, key = self._by_activity_id, ev_attrs['activityId']
+        elif 'scheduledEventId' in ev_attrs and event_type.startswith('Activity'):
+            index, key = self._by_scheduled_event_id, ev_attrs['scheduledEventId']
+        elif 'timerId' in ev_attrs:
+            index, key = self._by_timer_id, ev_attrs['timerId']
+        elif 'markerName' in ev_attrs:
+            index, key = self._by_marker_name, ev_attrs['markerName']
+        else:
+            return
+        index.setdefault(key, []).append(pos)
+
+    def _position(self, event_id):
+        """Get position of a loaded event, or None.
+
+        Event ids are consecutive in a history, so the position can usually
+        be computed. Otherwise fall back to a binary search, ids being in
+        descending order.
+        """
+        ids = self._ids
+        pos = self.newest_id - event_id
+        if 0 <= pos < len(ids) and ids[pos] == event_id:
+            return pos
+        low, high = 0, len(ids)
+        while low < high:
+            mid = (low + high) // 2
+            if ids[mid] > event_id:
+                low = mid + 1
+            else:
+                high = mid
+        if low < len(ids) and ids[low] == event_id:
+            return low
+        return None
+
+    def most_recent(self, event_type):
+        """Get the most recent event of a type, or None. """
+        code = _event_type_codes[event_type]
+        while code not in self._by_type:
+            if not self._load_page():
+                return None
+        return self._event(self._by_type[code][0])
+
+    def filter(self, event_type):
+        """Get all events of a type (most recent first). """
+        self._load_all()
+        code = _event_type_codes[event_type]
+        return self._events(self._by_type.get(code, []))
+
+    def get(self, event_id):
+        """Get event by id, or None. """
+        while True:
+            pos = self._position(event_id)
+            if pos is not None:
+                return self._event(pos)
+            oldest = self.oldest_id
+            if oldest is not None and oldest < event_id:
+                return None
+            if not self._load_page():
+                return None
+
+    def for_activity(self, activity_id):
+        """Get all events of activity tasks with the given activity id.
+
+        Events referring to the activity by its scheduled event id
+        (started, completed, failed, ...) are included.
+        """
+        self._load_all()
+        positions = list(self._by_activity_id.get(activity_id, []))
+        scheduled_code = _event_type_codes['ActivityTaskScheduled']
+        for pos in list(positions):
+            if self._type_codes[pos] != scheduled_code:
+                continue
+            positions.extend(
+                    self._by_scheduled_event_id.get(self._ids[pos], []))
+        return self._events(sorted(positions))
+
+    def for_timer(self, timer_id):
+        """Get all events of the timer with the given id. """
+        self._load_all()
+        return self._events(self._by_timer_id.get(timer_id, []))
+
+    def for_marker(self, marker_name):
+        """Get all events of markers with the given name. """
+        self._load_all()
+        return self._events(self._by_marker_name.get(marker_name, []))
+
+    def for_child_workflow(self, workflow_id):
+        """Get all events of the child workflow with the given id. """
+        self._load_all()
+        return self._events(self._by_child_workflow_id.get(workflow_id, []))
+
+
+class LatestEvents(object):
+    """History summary keeping the most recent event of every type.
+
+    This is enough for ``most_recent`` lookups and for ``start_input``.
+    """
+
+    def __init__(self):
+        self.events = {}
+
+    def update(self, event):
+        """Called with every event, most recent first. """
+        if event.type not in self.events:
+            self.events[event.type] = event
+
+    def most_recent(self, event_type):
+        return self.events.get(event_type)
+
+
+class StreamingHistory(object):
+    """Single pass event history with bounded memory use.
+
+    Only the current page is kept. Every event is passed to ``summary``
+    before it is handed out, and ``most_recent`` is answered from the summary
+    when possible.
+
+    Events can only be iterated over once. Iterating again continues where
+    the previous iteration stopped.
+    """
+
+    def __init__(self, events, next_page=None, summary=None):
+        """
+        :param events: Raw events of the first page (most recent first).
+        :param next_page: Callable returning the raw events of the next page
+                          or raising ``LastPage``.
+        :param summary: Object with an ``update`` method taking an event,
+                        and optionally a ``most_recent`` method taking an
+                        event type. Defaults to ``LatestEvents``.
+        """
+        self._next_page = next_page
+        self._complete = next_page is None
+        self._page = events
+        self._pos = 0
+        self.consumed = 0
+        if summary is None:
+            summary = LatestEvents()
+        self.summary = summary
+
+    def __iter__(self):
+        while True:
+            while self._pos < len(self._page):
+                event = Event(self._page[self._pos])
+                self._pos += 1
+                self.consumed += 1
+                self.summary.update(event)
+                yield event
+            if not self._load_page():
+                return
+
+    @property
+    def complete(self):
+        """True if all pages have been loaded. """
+        return self._complete
+
+    def _load_page(self):
+        if self._complete:
+            return False
+        try:
+            events = self._next_page()
+        except LastPage:
+            self._complete = True
+            self._page, self._pos = [], 0
+            return False
+        self._page, self._pos = events, 0
+        return True
+
+    def most_recent(self, event_type):
+        """Get the most recent event of a type, or None.
+
+        Events are consumed until one of the type is found, unless the
+        summary already has it.
+        """
+        summary_lookup = getattr(self.summary, 'most_recent', None)
+        if summary_lookup is not None:
+            event = summary_lookup(event_type)
+            if event is not None:
+                return event
+        for event in self:
+            if event.type == event_type:
+                return event
+        return None
+
+    def filter(self, event_type):
+        """Get all events of a type (most recent first).
+
+        This consumes all events and is only possible before any event has
+        been consumed.
+        """
+        if self.consumed:
+            raise Error('history already consumed')
+        return [event for event in self if event.type == event_type]
+
+
+class HistoryCache(object):
+    """LRU cache of complete histories, keyed by workflow execution.
+
+    A history is put into the cache when its decision task completes and is
+    taken out of it when the next decision task of the same workflow
+    execution starts. An entry also carries a ``state`` dict that deciders
+    may use to keep state derived from the events they have seen, and the
+    started event id of the decision task that put it there.
+
+    The cache is bounded by the total number of events it holds.
+    """
+
+    def __init__(self, max_events=100000):
+        """
+        :param max_events: Maximum total number of events in the cache.
+        """
+        self.max_events = max_events
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def pop(self, key):
+        """Take an entry out of the cache.
+
+        :param key: A ``(workflow_id, run_id)`` tuple.
+        :returns: A ``(history, state, started_event_id)`` tuple or None.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._size -= len(entry[0])
+            return entry
+
+    def put(self, key, history, state, started_event_id=None):
+        """Put a complete history into the cache.
+
+        Incomplete histories are ignored since older pages cannot be fetched
+        once the decision task is done.
+
+        :param started_event_id: Started event id of the decision task
+                                 ``state`` was derived in.
+        """
+        if not history.complete or len(history) > self.max_events:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old[0])
+            self._entries[key] = (history, state, started_event_id)
+            self._size += len(history)
+            while self._size > self.max_events:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted[0])
+
+
+class PagePrefetcher(object):
+    """Fetches history pages ahead on a background thread.
+
+    At most ``max_pages`` pages are buffered. Fetching starts as soon as the
+    prefetcher is created. The thread stops after ``limit`` pages, when the
+    owner is garbage collected, or when the buffer has been full for
+    ``max_idle`` seconds. Pages after that are fetched by ``next_page``
+    itself.
+    """
+
+    # Seconds between checks for ``close`` while the buffer is full.
+    _close_check_interval = 1
+
+    # Seconds the thread waits for the consumer while the buffer is full.
+    max_idle = 300
+
+    def __init__(self, fetch, next_page_token, max_pages, limit=None,
+                 owner=None):
+        """
+        :param fetch: Callable taking a page token and returning a tuple of
+                      the raw events of the page and the next page token.
+                      If ``owner`` is given, it is called with the owner and
+                      the page token.
+        :param next_page_token: Token of the first page to fetch.
+        :param max_pages: Maximum number of pages fetched ahead.
+        :param limit: Maximum number of pages fetched on the thread
+                      (optional).
+        :param owner: Object the pages are fetched for (optional). Only a
+                      weak reference is kept, so that the thread does not
+                      keep it alive.
+        """
+        self._fetch = fetch
+        self._owner = weakref.ref(owner) if owner is not None else None
+        self._limit = limit
+        self._buffer = queue.Queue(maxsize=max_pages)
+        self._closed = threading.Event()
+        # Token of the first page not fetched by the thread.
+        self._resume_token = None
+        self._thread = threading.Thread(
+                target=self._run, args=(next_page_token,),
+                name='flowser-prefetch')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _fetch_args(self):
+        """Arguments to pass before the token, or None to stop. """
+        if self._closed.is_set():
+            return None
+        if self._owner is None:
+            return ()
+        owner = self._owner()
+        if owner is None:
+            return None
+        return (owner,)
+
+    def _run(self, token):
+        fetched = 0
+        while token is not None:
+            if self._limit is not None and fetched >= self._limit:
+                self._resume_token = token
+                return
+            args = self._fetch_args()
+            if args is None:
+                return
+            try:
+                events, next_token = self._fetch(*(args + (token,)))
+            except Exception as exc:
+                self._put((None, None, exc))
+                return
+            # Do not keep the owner alive while waiting for the consumer.
+            del args
+            fetched += 1
+            if not self._put((events, next_token, None)):
+                self._resume_token = token
+                return
+            token = next_token
+        self._put((None, None, LastPage()))
+
+    def _put(self, item):
+        """Buffer an item. Returns False if fetching is to stop. """
+        waited = 0
+        while not self._closed.is_set():
+            if self._owner is not None and self._owner() is None:
+                return False
+            try:
+                self._buffer.put(item, timeout=self._close_check_interval)
+            except queue.Full:
+                waited += self._close_check_interval
+                if waited >= self.max_idle:
+                    return False
+                continue
+            return True
+        return False
+
+    def next_page(self):
+        """Get the next page.
+
+        :returns: A tuple of the raw events and the next page token.
+        :raises: LastPage, or any error raised when fetching the page.
+        """
+        while True:
+            try:
+                item = self._buffer.get(timeout=self._close_check_interval)
+                break
+            except queue.Empty:
+                if self._thread.is_alive() or not self._buffer.empty():
+                    continue
+                return self._fetch_resumed()
+        events, token, exc = item
+        if exc is not None:
+            self._put((None, None, exc))
+            raise exc
+        return events, token
+
+    def _fetch_resumed(self):
+        """Fetch the next page after the thread stopped. """
+        token = self._resume_token
+        if token is None:
+            raise LastPage
+        args = self._fetch_args()
+        if args is None:
+            raise LastPage
+        events, self._resume_token = self._fetch(*(args + (token,)))
+        return events, self._resume_token
+
+    def close(self):
+        """Stop fetching pages. """
+        self._closed.set()
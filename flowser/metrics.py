@@ -0,0 +1,260 @@
+# Copyright (c) 2012 Memoto AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Instrumentation.
+
+The purpose is to see where time goes when throughput drops. flowser
+reports to the ``instrumentation`` of the domain, which by default does
+nothing. Set it to a ``Registry`` to collect metrics, and serve them to
+Prometheus::
+
+    class MyDomain(Domain):
+        instrumentation = metrics.Registry()
+
+    MyDomain.instrumentation.serve(9100)
+
+Metrics reported by flowser:
+
+* ``flowser_polls_total`` (counter; ``task``, ``type``, ``result``): polls
+  for decision and activity tasks. ``result`` is ``task`` or ``empty``.
+* ``flowser_poll_seconds`` (histogram; ``task``, ``type``): poll latency.
+* ``flowser_history_pages_total`` (counter; ``type``): history pages
+  fetched after the first one.
+* ``flowser_decision_history_pages`` (histogram; ``type``): history pages
+  fetched per decision task, after the first one.
+* ``flowser_request_seconds`` (histogram; ``call``, ``type``): latency of
+  starts and ``respond_*`` calls.
+* ``flowser_decision_seconds`` (histogram; ``type``): decision task
+  handling, from poll result to response.
+* ``flowser_activity_seconds`` (histogram; ``type``, ``outcome``):
+  activity task handling, from poll result to response.
+"""
+import bisect
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler
+    from http.server import HTTPServer
+
+# Histogram buckets, in seconds.
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0,
+                   30.0, 60.0)
+
+# Buckets of histograms counting pages.
+PAGE_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+class _NoopTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_noop_timer = _NoopTimer()
+
+
+class Instrumentation(object):
+    """Instrumentation interface. This implementation does nothing.
+
+    Subclasses override ``count`` and ``observe``. ``timer`` is implemented
+    with ``observe``.
+    """
+
+    #: False for instrumentation that does nothing, which lets callers skip
+    #: the work of measuring.
+    enabled = False
+
+    def count(self, name, value=1, **labels):
+        """Add ``value`` to a counter. """
+
+    def observe(self, name, value, **labels):
+        """Add an observation to a histogram. """
+
+    def timer(self, name, **labels):
+        """Context manager observing the seconds spent in its block. """
+        if not self.enabled:
+            return _noop_timer
+        return _Timer(self, name, labels)
+
+
+NOOP = Instrumentation()
+
+
+class _Timer(object):
+
+    def __init__(self, instrumentation, name, labels):
+        self._instrumentation = instrumentation
+        self._name = name
+        self._labels = labels
+
+    def __enter__(self):
+        self._started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._instrumentation.observe(
+                self._name, time.time() - self._started, **self._labels)
+        return False
+
+
+class _Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+            .replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, _escape(v)) for k, v in labels)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Registry(Instrumentation):
+    """Thread-safe store of counters and histograms.
+
+    Metrics are rendered in the Prometheus text format by ``render``, and
+    served over HTTP by ``serve``.
+    """
+
+    enabled = True
+
+    def __init__(self, buckets=None):
+        """
+        :param buckets: Dict mapping histogram names to bucket upper
+                        bounds. Other histograms use ``DEFAULT_BUCKETS``.
+        """
+        self.buckets = {'flowser_decision_history_pages': PAGE_BUCKETS}
+        self.buckets.update(buckets or {})
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = _Histogram(self.buckets.get(name,
+                                                        DEFAULT_BUCKETS))
+                self._histograms[key] = histogram
+            histogram.observe(value)
+
+    def counter_value(self, name, **labels):
+        """Current value of a counter (zero if it does not exist). """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            return self._counters.get(key, 0)
+
+    def histogram_count(self, name, **labels):
+        """Number of observations of a histogram. """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            return histogram.count if histogram is not None else 0
+
+    def render(self):
+        """Metrics in the Prometheus text exposition format. """
+        lines = []
+        with self._lock:
+            typed = set()
+            for (name, labels), value in sorted(self._counters.items()):
+                if name not in typed:
+                    lines.append('# TYPE %s counter' % name)
+                    typed.add(name)
+                lines.append('%s%s %s' % (name, _format_labels(labels),
+                                          _format_value(value)))
+            for (name, labels), histogram in sorted(
+                    self._histograms.items()):
+                if name not in typed:
+                    lines.append('# TYPE %s histogram' % name)
+                    typed.add(name)
+                cumulative = 0
+                bounds = list(histogram.buckets) + [float('inf')]
+                for bound, count in zip(bounds, histogram.counts):
+                    cumulative += count
+                    bucket_labels = labels + (('le', _format_value(bound)),)
+                    lines.append('%s_bucket%s %d' % (
+                            name, _format_labels(bucket_labels), cumulative))
+                lines.append('%s_sum%s %s' % (name, _format_labels(labels),
+                                              _format_value(histogram.sum)))
+                lines.append('%s_count%s %d' % (name, _format_labels(labels),
+                                                histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, address='127.0.0.1'):
+        """Serve metrics over HTTP on a background thread.
+
+        :param port: Port to listen on. Zero picks a free port.
+        :param address: Address to listen on. Defaults to local
+                        connections only.
+        :returns: The server. Its ``server_port`` is the port listened on,
+                  and ``shutdown`` stops it.
+        """
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer((address, port), Handler)
+        thread = threading.Thread(target=server.serve_forever,
+                                  name='flowser-metrics')
+        thread.daemon = True
+        thread.start()
+        return server
@@ -0,0 +1,589 @@
+# Copyright (c) 2012 Memoto AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Worker pools.
+
+The purpose is to keep many tasks in flight in one process. Poll loops run on
+their own threads and hand tasks over to a bounded set of handler threads.
+A task list is only polled when there is a free handler slot, so no task is
+ever claimed from Simple Workflow without something ready to work on it.
+"""
+import collections
+import logging
+import multiprocessing
+import threading
+import time
+import traceback
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from flowser import serializing
+from flowser import tasks
+from flowser.exceptions import EmptyTaskPollResult
+
+log = logging.getLogger(__name__)
+
+# Limits of the "reason" and "details" parameters of
+# RespondActivityTaskFailed.
+MAX_REASON_LENGTH = 256
+MAX_DETAILS_LENGTH = 32768
+
+# Seconds a handler thread waits for a task before checking whether the
+# pool has stopped.
+_HANDLER_IDLE_CHECK = 0.5
+
+
+class FairSemaphore(object):
+    """Semaphore granting permits in the order they were requested.
+
+    ``threading.Semaphore`` lets a releasing thread take the permit right
+    back. Pollers of an idle task list would then keep the slots to
+    themselves while pollers of a busy list wait.
+    """
+
+    def __init__(self, value):
+        self._value = value
+        self._waiters = collections.deque()
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            ticket = object()
+            self._waiters.append(ticket)
+            while self._waiters[0] is not ticket or self._value == 0:
+                self._cond.wait()
+            self._waiters.popleft()
+            self._value -= 1
+            # The next waiter may be able to proceed too.
+            self._cond.notify_all()
+
+    def release(self):
+        with self._cond:
+            self._value += 1
+            self._cond.notify_all()
+
+
+def imap_unordered(func, iterable, concurrency):
+    """Call ``func`` on every item on ``concurrency`` threads.
+
+    Items are taken from ``iterable`` lazily and at most ``concurrency``
+    items are in flight (being handled or handled but not yet consumed) at
+    any time.
+
+    :returns: A generator of ``(item, result, exception)`` tuples in
+              completion order. ``exception`` is None if ``func`` returned.
+    """
+    if concurrency < 1:
+        raise ValueError("concurrency must be positive")
+    slots = threading.BoundedSemaphore(concurrency)
+    inputs = queue.Queue()
+    outputs = queue.Queue()
+    stopped = threading.Event()
+    done = object()
+    feed_failed = object()
+
+    def feed():
+        try:
+            for item in iterable:
+                slots.acquire()
+                if stopped.is_set():
+                    break
+                inputs.put(item)
+        except Exception as exc:
+            outputs.put((feed_failed, None, exc))
+        finally:
+            for i in range(concurrency):
+                inputs.put(done)
+
+    def work():
+        while True:
+            item = inputs.get()
+            if item is done:
+                outputs.put(done)
+                return
+            try:
+                outputs.put((item, func(item), None))
+            except Exception as exc:
+                outputs.put((item, None, exc))
+
+    threads = [threading.Thread(target=feed, name='flowser-feeder')]
+    threads.extend(threading.Thread(target=work, name='flowser-worker-%d' % i)
+                   for i in range(concurrency))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    def results():
+        finished = 0
+        try:
+            while finished < concurrency:
+                output = outputs.get()
+                if output is done:
+                    finished += 1
+                    continue
+                if output[0] is feed_failed:
+                    raise output[2]
+                slots.release()
+                yield output
+        finally:
+            stopped.set()
+            # Unblock the feeder if it waits for a slot.
+            try:
+                slots.release()
+            except ValueError:
+                pass
+    return results()
+
+
+class Poller(threading.Thread):
+    """Polls for tasks of one type and dispatches them.
+
+    A free slot is acquired from ``slots`` before every poll. The dispatch
+    callable takes ownership of the slot for non-empty poll results.
+    """
+
+    def __init__(self, domain, t, method_name, task_class, dispatch, slots,
+                 poll_kwargs=None, stats=None):
+        """
+        :param domain: A ``domain.Domain`` instance.
+        :param t: Subclass of ``types.Type``.
+        :param method_name: Name of the poll method on ``t``.
+        :param task_class: Class wrapping poll results.
+        :param dispatch: Callable taking a task instance.
+        :param slots: A semaphore bounding the number of tasks in flight.
+        :param stats: A ``PollStats`` instance (optional).
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.name = 'flowser-poller-%s' % t.name
+        self._domain = domain
+        self._t = t
+        self._method_name = method_name
+        self._task_class = task_class
+        self._dispatch = dispatch
+        self._slots = slots
+        self._poll_kwargs = poll_kwargs or {}
+        self._stats = stats
+        self._stopped = threading.Event()
+
+    def stop(self):
+        """Stop polling. A poll in progress is allowed to finish. """
+        self._stopped.set()
+
+    @property
+    def stopped(self):
+        return self._stopped.is_set()
+
+    def run(self):
+        instance = self._t(self._domain)
+        poll_method = getattr(instance, self._method_name)
+        while not self.stopped:
+            self._slots.acquire()
+            if self.stopped:
+                self._slots.release()
+                break
+            try:
+                result = poll_method(**self._poll_kwargs)
+            except EmptyTaskPollResult:
+                self._slots.release()
+                if self._stats is not None:
+                    self._stats.record_poll(empty=True)
+                continue
+            except Exception:
+                self._slots.release()
+                log.exception("poll failed for %s", self._t.name)
+                self._stopped.wait(1)
+                continue
+            if self._stats is not None:
+                self._stats.record_poll(empty=False)
+            try:
+                task = self._task_class(result, instance)
+            except Exception:
+                self._slots.release()
+                log.exception("could not handle poll result for %s",
+                              self._t.name)
+                continue
+            self._dispatch(task)
+
+
+def _decode_and_call(handler, raw_input):
+    """Decode task input and call handler. Runs in worker processes. """
+    input = None
+    if raw_input is not None:
+        input = serializing.loads(raw_input)
+    return handler(input)
+
+
+class PollStats(object):
+    """Thread-safe poll counters for one type.
+
+    Counters are reset every time ``snapshot`` is called, so a snapshot
+    describes the period since the previous one.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._polls = 0
+        self._empty_polls = 0
+        self._since = time.time()
+
+    def record_poll(self, empty):
+        with self._lock:
+            self._polls += 1
+            if empty:
+                self._empty_polls += 1
+
+    def snapshot(self):
+        """Get and reset counters.
+
+        :returns: A dict with ``polls``, ``empty_polls``, ``empty_ratio``
+                  and ``seconds`` (length of the period).
+        """
+        with self._lock:
+            now = time.time()
+            polls, empty_polls = self._polls, self._empty_polls
+            seconds = now - self._since
+            self._polls = self._empty_polls = 0
+            self._since = now
+        empty_ratio = float(empty_polls) / polls if polls else 0.0
+        return {
+                'polls': polls,
+                'empty_polls': empty_polls,
+                'empty_ratio': empty_ratio,
+                'seconds': seconds,
+                }
+
+
+class PollSupervisor(threading.Thread):
+    """Scales the number of poll loops for one type with its backlog.
+
+    Every ``interval`` seconds the number of pending tasks is counted and the
+    number of poll loops is set to the backlog, bounded by ``min_pollers``
+    and ``max_pollers``. Poll loops are removed one at a time, and only while
+    most polls come back empty, so that short gaps between bursts do not
+    tear down pollers.
+
+    The latest report is available as ``report``.
+    """
+
+    # Remove a poller only when at least this share of polls were empty.
+    scale_down_empty_ratio = 0.5
+
+    def __init__(self, domain, t, count_method_name, start_poller,
+                 min_pollers=1, max_pollers=10, interval=10):
+        """
+        :param domain: A ``domain.Domain`` instance.
+        :param t: Subclass of ``types.Type``.
+        :param count_method_name: Name of the pending task count method
+                                  on ``t``.
+        :param start_poller: Callable taking a ``PollStats`` instance. It
+                             must start and return a ``Poller``.
+        :param min_pollers: Minimum number of poll loops.
+        :param max_pollers: Maximum number of poll loops.
+        :param interval: Seconds between backlog checks.
+        """
+        if not 1 <= min_pollers <= max_pollers:
+            raise ValueError("need 1 <= min_pollers <= max_pollers")
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.name = 'flowser-supervisor-%s' % t.name
+        self._t = t
+        self._count_method = getattr(t(domain), count_method_name)
+        self._start_poller = start_poller
+        self.min_pollers = min_pollers
+        self.max_pollers = max_pollers
+        self.interval = interval
+        self.stats = PollStats()
+        self.report = None
+        self._pollers = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    @property
+    def pollers(self):
+        """Number of poll loops that have not been told to stop. """
+        return len(self._pollers)
+
+    def stop(self):
+        """Stop supervising and stop all poll loops. """
+        with self._lock:
+            self._stopped.set()
+            for poller in self._pollers:
+                poller.stop()
+
+    def start(self):
+        self._scale_to(self.min_pollers)
+        threading.Thread.start(self)
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                backlog = self._count_method()
+            except Exception:
+                log.exception("could not count pending tasks for %s",
+                              self._t.name)
+                continue
+            self.check(backlog)
+
+    def check(self, backlog):
+        """Scale poll loops given the current backlog. """
+        report = self.stats.snapshot()
+        report['backlog'] = backlog
+        target = max(self.min_pollers, min(self.max_pollers, backlog))
+        if target < self.pollers:
+            if report['empty_ratio'] >= self.scale_down_empty_ratio:
+                target = self.pollers - 1
+            else:
+                target = self.pollers
+        self._scale_to(target)
+        report['pollers'] = self.pollers
+        self.report = report
+        log.debug("%s: %r", self._t.name, report)
+
+    def _scale_to(self, target):
+        with self._lock:
+            if self._stopped.is_set():
+                return
+            while self.pollers < target:
+                self._pollers.append(self._start_poller(self.stats))
+            while self.pollers > target:
+                self._pollers.pop().stop()
+
+
+class ActivityWorkerPool(object):
+    """Runs activity handlers concurrently in one process.
+
+    Every activity type gets ``pollers`` poll loops. At most ``max_in_flight``
+    tasks are handled at the same time, over all types. If ``max_pollers``
+    is set, the number of poll loops per type is scaled between ``pollers``
+    and ``max_pollers`` depending on the backlog of the task list (see
+    ``PollSupervisor``).
+
+    The handler is called with a ``tasks.Activity`` instance. Its return
+    value is used to complete the task. If it raises, the task is failed
+    with the exception as reason and the traceback as details.
+    """
+
+    def __init__(self, domain, types, handler, pollers=1, max_in_flight=10,
+                 max_pollers=None):
+        """
+        :param domain: A ``domain.Domain`` instance.
+        :param types: List of ``types.Activity`` subclasses.
+        :param handler: Callable taking a ``tasks.Activity``.
+        :param pollers: Number of poll loops per activity type.
+        :param max_in_flight: Maximum number of tasks handled at once.
+        :param max_pollers: Maximum number of poll loops per activity type
+                            (optional).
+        """
+        if pollers < 1 or max_in_flight < 1:
+            raise ValueError("pollers and max_in_flight must be positive")
+        self._domain = domain
+        self._types = list(types)
+        self._handler = handler
+        self._pollers_per_type = pollers
+        self._max_pollers = max_pollers
+        self._max_in_flight = max_in_flight
+        self._slots = FairSemaphore(max_in_flight)
+        self._queue = queue.Queue()
+        self._pollers = []
+        self._pollers_lock = threading.Lock()
+        self._handler_threads = []
+        self.supervisors = {}
+
+    def start(self):
+        """Start handler threads and poll loops. """
+        for t in self._types:
+            if self._max_pollers is None:
+                for i in range(self._pollers_per_type):
+                    self._start_poller(t)
+            else:
+                self._start_supervisor(t)
+        for i in range(self._max_in_flight):
+            thread = threading.Thread(target=self._handle_forever,
+                                      name='flowser-handler-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self._handler_threads.append(thread)
+        return self
+
+    def _start_poller(self, t, stats=None):
+        poller = Poller(self._domain, t, '_poll_for_activity_task',
+                        tasks.Activity, self._queue.put, self._slots,
+                        stats=stats)
+        poller.start()
+        with self._pollers_lock:
+            # Drop poll loops that were stopped (by a supervisor scaling
+            # down) and have exited.
+            self._pollers = [p for p in self._pollers if p.is_alive()]
+            self._pollers.append(poller)
+        return poller
+
+    def _start_supervisor(self, t):
+        def start_poller(stats):
+            return self._start_poller(t, stats)
+        supervisor = PollSupervisor(
+                self._domain, t, '_count_pending_activity_tasks',
+                start_poller, min_pollers=self._pollers_per_type,
+                max_pollers=self._max_pollers)
+        supervisor.start()
+        self.supervisors[t.name] = supervisor
+        return supervisor
+
+    def stop(self):
+        """Stop polling and let handlers finish tasks in flight.
+
+        Poll loops exit when their current long poll returns, which may take
+        up to a minute. Tasks returned by those polls are still handled.
+        """
+        for supervisor in self.supervisors.values():
+            supervisor.stop()
+        for poller in self._pollers:
+            poller.stop()
+
+    def wait(self):
+        """Block until the pool is stopped.
+
+        A ``KeyboardInterrupt`` stops the pool before it is re-raised.
+        """
+        try:
+            for thread in self._pollers + self._handler_threads:
+                while thread.is_alive():
+                    thread.join(1)
+        except KeyboardInterrupt:
+            self.stop()
+            raise
+
+    def _polling(self):
+        return any(poller.is_alive() for poller in self._pollers)
+
+    def _handle_forever(self):
+        while True:
+            try:
+                task = self._queue.get(timeout=_HANDLER_IDLE_CHECK)
+            except queue.Empty:
+                if self._polling():
+                    continue
+                break
+            try:
+                self._handle(task)
+            finally:
+                self._slots.release()
+
+    def _call_handler(self, task):
+        return self._handler(task)
+
+    def _handle(self, task):
+        try:
+            result = self._call_handler(task)
+        except Exception as exc:
+            self._fail(task, exc)
+        else:
+            self._respond(task.complete, result)
+
+    def _fail(self, task, exc):
+        reason = ("%s: %s" % (exc.__class__.__name__, exc))
+        details = traceback.format_exc()
+        self._respond(task.fail,
+                      details=details[-MAX_DETAILS_LENGTH:],
+                      reason=reason[:MAX_REASON_LENGTH])
+
+    def _respond(self, method, *args, **kwargs):
+        try:
+            method(*args, **kwargs)
+        except Exception:
+            log.exception("could not respond to activity task")
+
+
+class ProcessActivityWorkerPool(ActivityWorkerPool):
+    """Runs activity handlers in a pool of worker processes.
+
+    Polling and responding stay in the parent process, so the connection is
+    never pickled. Only the serialized task input is sent to a worker
+    process, where it is decoded, and only the handler's return value is
+    sent back. This sidesteps the GIL for CPU-bound handlers.
+
+    The handler must be picklable (for example a module level function) and
+    is called with the task input rather than a ``tasks.Activity``.
+
+    The worker processes exit once the pool is stopped and the tasks in
+    flight are handled. They are terminated if ``wait`` is interrupted.
+    """
+
+    def __init__(self, domain, types, handler, processes=None, pollers=1,
+                 max_in_flight=None, max_pollers=None):
+        """
+        :param processes: Number of worker processes. Defaults to the number
+                          of CPUs.
+        :param max_in_flight: Defaults to the number of worker processes.
+
+        See ``ActivityWorkerPool`` for the other parameters.
+        """
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if max_in_flight is None:
+            max_in_flight = processes
+        super(ProcessActivityWorkerPool, self).__init__(
+                domain, types, handler, pollers=pollers,
+                max_in_flight=max_in_flight, max_pollers=max_pollers)
+        self._processes = processes
+        self._process_pool = None
+        self._process_pool_lock = threading.Lock()
+
+    def start(self):
+        self._process_pool = multiprocessing.Pool(self._processes)
+        return super(ProcessActivityWorkerPool, self).start()
+
+    def stop(self):
+        super(ProcessActivityWorkerPool, self).stop()
+        closer = threading.Thread(target=self._close_when_idle,
+                                  name='flowser-process-pool-closer')
+        closer.daemon = True
+        closer.start()
+
+    def wait(self):
+        try:
+            super(ProcessActivityWorkerPool, self).wait()
+        except BaseException:
+            self._close_process_pool(terminate=True)
+            raise
+        self._close_process_pool()
+
+    def _close_when_idle(self):
+        for thread in self._pollers + self._handler_threads:
+            thread.join()
+        self._close_process_pool()
+
+    def _close_process_pool(self, terminate=False):
+        with self._process_pool_lock:
+            process_pool, self._process_pool = self._process_pool, None
+        if process_pool is None:
+            return
+        if terminate:
+            process_pool.terminate()
+        else:
+            process_pool.close()
+        process_pool.join()
+
+    def _call_handler(self, task):
+        return self._process_pool.apply(
+                _decode_and_call, (self._handler, task.raw_input))
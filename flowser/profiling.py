@@ -0,0 +1,184 @@
+# Copyright (c) 2012 Memoto AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Sampling profiler for decision tasks.
+
+The purpose is to find out why some decision tasks are slow, in production
+and without profiling every task. Set ``Domain.decision_profiler``::
+
+    class MyDomain(Domain):
+        decision_profiler = profiling.DecisionProfiler(
+                '/var/tmp/flowser-profiles', sample_rate=0.01,
+                slow_threshold=5)
+
+Decision tasks from ``Domain.decisions`` are then profiled from the poll
+result until the decider asks for the next task. A background thread
+samples the stack of the decider thread every ``interval`` seconds, which
+keeps the overhead low and independent of the code being profiled.
+
+Profiles of a random sample of tasks, and of tasks slower than
+``slow_threshold`` seconds, are written as collapsed stacks (one
+``frame;frame;frame count`` line per stack, as read by flame graph tools)
+with a JSON file of metadata next to them. File names are tagged with the
+workflow type, the run id and the history length.
+"""
+import collections
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    label = '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+                            frame.f_lineno)
+    return label.replace(';', ':')
+
+
+def collapse(frame, max_depth=100):
+    """Collapsed stack of ``frame``, outermost frame first. """
+    labels = []
+    while frame is not None and len(labels) < max_depth:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    labels.reverse()
+    return ';'.join(labels)
+
+
+class _Session(object):
+
+    def __init__(self, thread_id, sampled):
+        self.thread_id = thread_id
+        self.sampled = sampled
+        self.started = time.time()
+        self.stacks = collections.Counter()
+
+
+class DecisionProfiler(object):
+    """Samples the stacks of threads handling decision tasks. """
+
+    def __init__(self, directory, sample_rate=0.0, slow_threshold=None,
+                 interval=0.005, max_depth=100):
+        """
+        :param directory: Directory profiles are written to. Created if
+                          missing.
+        :param sample_rate: Fraction of tasks whose profile is written.
+        :param slow_threshold: Seconds after which the profile of a task is
+                               written regardless of ``sample_rate``
+                               (optional). With a threshold, every task is
+                               sampled.
+        :param interval: Seconds between stack samples.
+        :param max_depth: Maximum number of frames per stack.
+        """
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.interval = interval
+        self.max_depth = max_depth
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._active = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start profiling the calling thread.
+
+        :returns: A session to pass to ``stop``, or None if the task is
+                  not profiled.
+        """
+        sampled = random.random() < self.sample_rate
+        if not sampled and self.slow_threshold is None:
+            return None
+        session = _Session(threading.current_thread().ident, sampled)
+        with self._lock:
+            self._sessions[session.thread_id] = session
+            if self._thread is None:
+                self._thread = threading.Thread(
+                        target=self._sample_forever, name='flowser-profiler')
+                self._thread.daemon = True
+                self._thread.start()
+            self._active.set()
+        return session
+
+    def stop(self, session, task):
+        """Stop profiling and write the profile if it is to be kept.
+
+        :param session: Result of ``start``.
+        :param task: The ``tasks.Decision`` that was handled.
+        :returns: Path of the written profile, or None.
+        """
+        if session is None:
+            return None
+        with self._lock:
+            self._sessions.pop(session.thread_id, None)
+            if not self._sessions:
+                self._active.clear()
+        duration = time.time() - session.started
+        slow = self.slow_threshold is not None and \
+                duration >= self.slow_threshold
+        if not (session.sampled or slow) or task is None:
+            return None
+        return self._write(session, task, duration, slow)
+
+    def _sample_forever(self):
+        while True:
+            self._active.wait()
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, session in self._sessions.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        session.stacks[collapse(frame, self.max_depth)] += 1
+            del frames
+
+    def _write(self, session, task, duration, slow):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                if not os.path.isdir(self.directory):
+                    raise
+        workflow_type = task.workflow_type.name
+        run_id = task.workflow_execution.run_id
+        history_length = task.started_event_id
+        base = os.path.join(self.directory, '%s-%s-%s-%d-%d' % (
+                time.strftime('%Y%m%dT%H%M%S', time.gmtime(session.started)),
+                workflow_type.replace(os.sep, '_'), run_id, history_length,
+                os.getpid()))
+        with open(base + '.collapsed', 'w') as f:
+            for stack, count in sorted(session.stacks.items()):
+                f.write('%s %d\n' % (stack, count))
+        with open(base + '.json', 'w') as f:
+            json.dump({
+                    'workflow_type': workflow_type,
+                    'workflow_id': task.workflow_execution.workflow_id,
+                    'run_id': run_id,
+                    'history_length': history_length,
+                    'started': session.started,
+                    'duration': duration,
+                    'samples': sum(session.stacks.values()),
+                    'interval': self.interval,
+                    'reason': 'slow' if slow else 'sampled',
+                    }, f, indent=2, sort_keys=True)
+        return base + '.collapsed'
@@ -23,9 +23,282 @@
 The purpose is to serialize and unserialize inputs and outputs to and from
 workflows and tasks.
 
-Now, this is just a facade for the standard `json` module.
+Payloads are serialized with a codec from a registry. JSON codecs (the
+standard ``json`` module, and ``simplejson`` and ``ujson`` if installed)
+write plain JSON, which is what earlier versions wrote. Other codecs (such
+as ``msgpack``, if installed) prefix their output with a header naming the
+codec, so that ``loads`` can decode mixed histories.
+
+Types choose a codec with their ``codec`` property. Otherwise
+``default_codec`` is used.
+
+Payloads longer than ``compress_threshold`` characters are compressed with
+``compression`` (``zlib``, or ``lz4`` if installed) and put in an envelope
+with a header naming the compressor. Compression is disabled by default.
+
+If ``blob_store`` is set (see ``flowser.blobs``), payloads that are still
+longer than ``blob_threshold`` characters are written to the store under
+their content hash, and only a reference is returned. References are
+resolved by ``loads``, through a local cache (``blob_cache``).
+
+``add_trace_context`` puts a payload in an envelope carrying a trace
+context (see ``flowser.tracing``). ``loads`` skips the envelope. The
+payload is compressed or offloaded if the envelope makes it too long.
 """
+import base64
 import json
+import zlib
+
+from flowser import blobs
+
+# Prefix of payloads with a header. It can never start a JSON document.
+HEADER_PREFIX = '#fl1:'
+
+# Name of the codec used when none is given.
+default_codec = 'json'
+
+# Compress payloads longer than this (in characters). None disables
+# compression.
+compress_threshold = None
+
+# Name of the compressor used for payloads above the threshold.
+compression = 'zlib'
+
+# A ``blobs.BlobStore`` for payloads longer than ``blob_threshold``
+# characters. None disables offloading.
+blob_store = None
+blob_threshold = 32 * 1024
+
+# Cache of blobs read from or written to ``blob_store``.
+blob_cache = blobs.BlobCache()
+
+# Header name of blob references.
+_BLOB_REF = 'blob'
+
+# Header name of trace context envelopes.
+_TRACE = 'trace'
+
+_codecs = {}
+_compressors = {}
+
+
+class Codec(object):
+    """Base class for codecs.
+
+    Subclasses set ``name`` and implement ``dumps`` and ``loads``. Codecs
+    writing plain JSON set ``is_json`` so that no header is written.
+    """
+
+    name = None
+    is_json = False
+
+    def dumps(self, obj):
+        raise NotImplementedError('implement in subclass')
+
+    def loads(self, s):
+        raise NotImplementedError('implement in subclass')
+
+
+class JSONCodec(Codec):
+    """Codec for modules with the interface of the ``json`` module. """
+
+    is_json = True
+
+    def __init__(self, name, module):
+        self.name = name
+        self._module = module
+
+    def dumps(self, obj):
+        return self._module.dumps(obj)
+
+    def loads(self, s):
+        return self._module.loads(s)
+
+
+class MsgpackCodec(Codec):
+    """msgpack, base64 encoded to fit in API strings. """
+
+    name = 'msgpack'
+
+    def __init__(self, module):
+        self._module = module
+
+    def dumps(self, obj):
+        packed = self._module.packb(obj, use_bin_type=True)
+        return base64.b64encode(packed).decode('ascii')
+
+    def loads(self, s):
+        return self._module.unpackb(base64.b64decode(s), raw=False)
+
+
+class Compressor(object):
+    """Compressor for payload envelopes.
+
+    ``compress`` and ``decompress`` take and return bytes.
+    """
+
+    def __init__(self, name, compress, decompress):
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+
+
+def register_compressor(compressor):
+    """Register a compressor under its name. """
+    _compressors[compressor.name] = compressor
+
+
+def _header(name):
+    return HEADER_PREFIX + name + ':'
+
+
+def _compress(data):
+    """Put data in a compressed envelope if that makes it shorter. """
+    compressor = _compressors[compression]
+    compressed = compressor.compress(data.encode('utf-8'))
+    envelope = (_header(compressor.name) +
+                base64.b64encode(compressed).decode('ascii'))
+    if len(envelope) < len(data):
+        return envelope
+    return data
+
+
+def _offload(data):
+    """Write data to the blob store and get a reference to it. """
+    encoded = data.encode('utf-8')
+    key = blobs.content_key(encoded)
+    if key not in blob_cache:
+        blob_store.put(key, encoded)
+        blob_cache.put(key, encoded)
+    return _header(_BLOB_REF) + key
+
+
+def _fetch(key):
+    blobs.check_key(key)
+    encoded = blob_cache.get(key)
+    if encoded is None:
+        encoded = blob_store.get(key)
+        blob_cache.put(key, encoded)
+    return encoded.decode('utf-8')
+
+
+def _shrink(data, overhead=0):
+    """Compress or offload data that is too long.
+
+    :param overhead: Number of characters that will be added to the data.
+    """
+    if compress_threshold is not None and \
+            len(data) + overhead > compress_threshold:
+        data = _compress(data)
+    if blob_store is not None and len(data) + overhead > blob_threshold:
+        data = _offload(data)
+    return data
+
+
+def add_trace_context(data, context):
+    """Put a serialized payload in an envelope carrying a trace context.
+
+    :param data: Serialized payload.
+    :param context: Trace context (see ``tracing.Span.context``).
+    """
+    if get_trace_context(data) is not None:
+        data = data[len(_header(_TRACE)):].partition(':')[2]
+    header = _header(_TRACE) + context + ':'
+    return header + _shrink(data, len(header))
+
+
+def get_trace_context(data):
+    """Get the trace context of a serialized payload, or None. """
+    header = _header(_TRACE)
+    if data is None or not data.startswith(header):
+        return None
+    return data[len(header):].partition(':')[0]
+
+
+def register(codec):
+    """Register a codec under its name. """
+    _codecs[codec.name] = codec
+
+
+def get_codec(name=None):
+    """Get a registered codec by name (defaults to ``default_codec``). """
+    return _codecs[name or default_codec]
+
+
+def available_codecs():
+    """Get names of registered codecs. """
+    return sorted(_codecs)
+
+
+def dumps(obj, codec=None):
+    """Serialize ``obj``.
+
+    :param codec: Codec name. Defaults to ``default_codec``.
+    """
+    c = get_codec(codec)
+    data = c.dumps(obj)
+    if not c.is_json:
+        data = _header(c.name) + data
+    return _shrink(data)
+
+
+def loads(s):
+    """Unserialize a payload written by ``dumps`` with any codec.
+
+    Plain JSON is decoded with ``default_codec`` if it is a JSON codec, or
+    with the standard ``json`` module otherwise.
+    """
+    try:
+        has_header = s.startswith(HEADER_PREFIX)
+    except AttributeError:
+        raise TypeError('cannot unserialize %r' % (s,))
+    if has_header:
+        name, _, data = s[len(HEADER_PREFIX):].partition(':')
+        if name == _BLOB_REF:
+            return loads(_fetch(data))
+        if name == _TRACE:
+            return loads(data.partition(':')[2])
+        if name in _compressors:
+            compressed = base64.b64decode(data)
+            inner = _compressors[name].decompress(compressed)
+            return loads(inner.decode('utf-8'))
+        return _codecs[name].loads(data)
+    c = get_codec()
+    if not c.is_json:
+        c = _codecs['json']
+    return c.loads(s)
+
+
+register(JSONCodec('json', json))
+
+try:
+    import simplejson
+except ImportError:
+    pass
+else:
+    register(JSONCodec('simplejson', simplejson))
+
+try:
+    import ujson
+except ImportError:
+    pass
+else:
+    register(JSONCodec('ujson', ujson))
+
+try:
+    import msgpack
+except ImportError:
+    pass
+else:
+    register(MsgpackCodec(msgpack))
+
+
+register_compressor(Compressor('zlib', zlib.compress, zlib.decompress))
 
-dumps = json.dumps
-loads = json.loads
+try:
+    import lz4.frame
+except ImportError:
+    pass
+else:
+    register_compressor(
+            Compressor('lz4', lz4.frame.compress, lz4.frame.decompress))
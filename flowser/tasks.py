@@ -18,10 +18,23 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import time
+
+from flowser import aio
 from flowser import serializing
 from flowser import decisions
-from flowser.events import Event
+from flowser import tracing
+from flowser.exceptions import Error
 from flowser.exceptions import LastPage
+from flowser.history import History
+from flowser.history import PagePrefetcher
+from flowser.history import StreamingHistory
+
+# Decisions whose control carries the trace context of the decision task.
+_traced_decision_types = frozenset([
+        'ScheduleActivityTask',
+        'StartChildWorkflowExecution',
+        ])
 
 
 class WorkflowExecution(object):
@@ -48,22 +61,31 @@ class WorkflowExecution(object):
         This can only be called from a decision task.
         """
         dec, attrs = decisions.skeleton("CompleteWorkflowExecution")
-        attrs['result'] = serializing.dumps(result)
+        attrs['result'] = serializing.dumps(result, codec=self._caller.codec)
         self._caller._decisions.append(dec)
         self._caller.complete(context=context)
 
+    def acomplete(self, result, context=None):
+        """Asynchronous version of ``complete``. """
+        return aio.call(self._domain, self.complete, result, context=context)
+
     def request_cancel(self):
-        self._domain.conn.request_cancel(self._domain.name, self.workflow_id, 
-                                         run_id=self.run_id)
+        self._domain.conn.request_cancel_workflow_execution(
+                self._domain.name, self.workflow_id, run_id=self.run_id)
 
     def signal(self, name, input=None):
         serialized_input = None
         if input is not None:
-            serialized_input = serializing.dumps(input)
+            serialized_input = serializing.dumps(
+                    input, codec=self._caller.codec)
         self._domain.conn.signal_workflow_execution(
                 self._domain.name, name, self.workflow_id, 
                 input=serialized_input, run_id=self.run_id)
 
+    def asignal(self, name, input=None):
+        """Asynchronous version of ``signal``. """
+        return aio.call(self._domain, self.signal, name, input=input)
+
     def terminate(self, details=None, reason=None):
         self._terminate('TERMINATE', details, reason)
 
@@ -137,11 +159,15 @@ class Decision(object):
         :param result: Result structure from the API. 
         :param caller: Caller object (subclass of ``types.Type``).
         """
+        self._received = time.time()
+        self._pages_fetched = 0
+        self._span = tracing.NULL_SPAN
         self._decisions = []
+        self._fan_out_progress = {}
         self._caller = caller
         self._domain = caller._domain
+        self.codec = caller.codec
 
-        self._events = result['events']
         self.next_page_token = self._get_next_page_token(result)
         self.previous_started_event_id = result['previousStartedEventId']
         self.started_event_id = result['startedEventId']
@@ -150,6 +176,52 @@ class Decision(object):
                 result['workflowExecution'], self)
         self.workflow_type = WorkflowType(result['workflowType'])
 
+        # State derived from the history by the decider. It is kept between
+        # decision tasks of the same execution if the domain has a history
+        # cache. ``warm`` tells whether it was restored from the cache.
+        self.state = {}
+        self.warm = False
+        next_page = self._next_page
+        if self.next_page_token is None:
+            next_page = None
+        self._prefetcher = None
+        self._streaming = getattr(caller, 'streaming_history', False)
+        base = None
+        if self._streaming:
+            summary_factory = getattr(caller, 'history_summary', None)
+            summary = summary_factory() if summary_factory else None
+            self.history = StreamingHistory(
+                    result['events'], next_page, summary=summary)
+        else:
+            cache = self._domain.history_cache
+            if cache is not None:
+                cached = cache.pop(self._cache_key)
+                if cached is not None:
+                    base, state, started_event_id = cached
+                    # The state is stale if another decider handled a
+                    # decision task of the execution since. The history is
+                    # still a valid prefix.
+                    if started_event_id == self.previous_started_event_id:
+                        self.state = state
+                        self.warm = True
+            self.history = History(result['events'], next_page, base=base)
+
+        if self._domain.tracer is not None:
+            self._start_span()
+
+        # Fetch further pages in the background if the workflow type asks
+        # for it and they are needed. With a cached history, only the pages
+        # between the first page and the cached events are fetched ahead.
+        prefetch_pages = getattr(caller, 'history_prefetch_pages', 0)
+        limit = None
+        if base is not None and result['events']:
+            missing = self.history.oldest_id - base.newest_id - 1
+            page_size = len(result['events'])
+            limit = (missing + page_size - 1) // page_size
+        if prefetch_pages and not self.history.complete and limit != 0:
+            self._prefetcher = PagePrefetcher(
+                    Decision._fetch_page, self.next_page_token,
+                    prefetch_pages, limit=limit, owner=self)
 
     def __repr__(self):
         return "<Decision workflow_type(%s) %s>" % (
@@ -158,45 +230,176 @@ class Decision(object):
     def _get_next_page_token(self, result):
         return result.get('nextPageToken', None)
 
+    @property
+    def _cache_key(self):
+        return (self.workflow_execution.workflow_id,
+                self.workflow_execution.run_id)
+
     @property
     def events(self):
-        # First go through what we got. This list may have been extended
-        # from previous calls. After that, fetch new pages until no more are
-        # available.
-        for r in self._events:
-            yield Event(r)
-        try:
-            while True:
-                for r in self._next_page():
-                    yield Event(r)
-        except LastPage:
-            raise StopIteration
+        """Iterate over history events (most recent first).
+
+        Pages are fetched when needed. Events are parsed once and indexed,
+        see ``history.History``. If the workflow type has
+        ``streaming_history`` set, events can only be iterated over once,
+        see ``history.StreamingHistory``.
+        """
+        return iter(self.history)
 
     def _next_page(self):
         """Get next page of history events.
 
-        This method updates ``self.next_page_token`` and extends 
-        ``self._events`` behind the curtains.
+        This method updates ``self.next_page_token`` behind the curtains.
 
         :raises: LastPage
         """
+        if self._prefetcher is not None:
+            events, self.next_page_token = self._prefetcher.next_page()
+            return events
         if self.next_page_token is None:
             raise LastPage
-        next_result = self._caller._poll_for_decision_task(
-                next_page_token=self.next_page_token,
-                reverse_order=True)
-        self.next_page_token = self._get_next_page_token(next_result)
-        self._events.extend(next_result['events'])
-        return next_result['events']
+        events, self.next_page_token = self._fetch_page(self.next_page_token)
+        return events
+
+    def _fetch_page(self, next_page_token):
+        self._pages_fetched += 1
+        with self._span.child('poll_for_decision_task',
+                              page=self._pages_fetched):
+            next_result = self._caller._poll_for_decision_task(
+                    next_page_token=next_page_token,
+                    reverse_order=True)
+        return next_result['events'], self._get_next_page_token(next_result)
+
+    def _start_span(self):
+        """Start the span of this task.
+
+        The span starts when the task was scheduled and has a
+        ``decision.queue`` child covering the wait for a decider. Its parent
+        is the root span of the execution (see
+        ``tracing.execution_context``). The first decision task of a child
+        workflow links its span to the parent execution, and root spans of
+        children started since the previous decision task are recorded.
+        Streaming histories are not searched, since that would consume
+        them.
+        """
+        execution = self.workflow_execution
+        attributes = {
+                'workflow_id': execution.workflow_id,
+                'run_id': execution.run_id,
+                'workflow_type': self.workflow_type.name,
+                'started_event_id': self.started_event_id,
+                }
+        scheduled, started = None, None
+        if not self._streaming:
+            started = self.history.get(self.started_event_id)
+            if started is not None:
+                scheduled = self.history.get(
+                        started.raw_attrs['scheduledEventId'])
+        self._span = self._domain.tracer.start_span(
+                'decision',
+                parent=tracing.execution_context(execution.workflow_id,
+                                                 execution.run_id),
+                start=scheduled.time_stamp if scheduled else self._received,
+                **attributes)
+        if scheduled is not None:
+            queue = self._span.child('decision.queue',
+                                     start=scheduled.time_stamp)
+            queue.finish(started.time_stamp)
+        if not self._streaming:
+            if self.previous_started_event_id == 0:
+                self._link_to_parent()
+            self._record_child_spans()
+
+    def _link_to_parent(self):
+        """Link the span of a first decision task to the parent, if any. """
+        started = self.history.most_recent('WorkflowExecutionStarted')
+        if started is None:
+            return
+        parent = started.raw_attrs.get('parentWorkflowExecution')
+        if parent is None:
+            return
+        self._span.set(
+                parent_workflow_id=parent['workflowId'],
+                parent_run_id=parent['runId'],
+                parent_initiated_event_id=
+                        started.raw_attrs.get('parentInitiatedEventId'),
+                link=tracing.execution_context(parent['workflowId'],
+                                               parent['runId']))
+
+    def _record_child_spans(self):
+        """Record root spans of children started since the last task.
+
+        A root span has the ids of the trace of the child (see
+        ``tracing.execution_context``). Its ``link`` attribute is the trace
+        context in the control of the decision that started the child, or
+        the context of this execution if the decision had no control.
+        """
+        tracer = self._domain.tracer
+        execution = self.workflow_execution
+        for event in self.history:
+            if event.id <= self.previous_started_event_id:
+                break
+            if event.type != 'ChildWorkflowExecutionStarted':
+                continue
+            child = event.raw_attrs['workflowExecution']
+            initiated = self.history.get(event.raw_attrs['initiatedEventId'])
+            link = None
+            if initiated is not None:
+                link = serializing.get_trace_context(
+                        initiated.raw_attrs.get('control'))
+            if link is None:
+                link = tracing.execution_context(execution.workflow_id,
+                                                 execution.run_id)
+            span = tracer.start_span(
+                    'child_workflow_execution', start=event.time_stamp,
+                    workflow_id=child['workflowId'], run_id=child['runId'],
+                    parent_workflow_id=execution.workflow_id,
+                    parent_run_id=execution.run_id, link=link)
+            span.set_context(tracing.execution_context(child['workflowId'],
+                                                       child['runId']))
+            span.finish(event.time_stamp)
+
+    def _add_trace_context(self):
+        """Pass the context of this task on in the control of decisions.
+
+        Activities and children scheduled without control are left as they
+        are.
+        """
+        context = self._span.context
+        for dec in self._decisions:
+            decision_type = dec['decisionType']
+            if decision_type not in _traced_decision_types:
+                continue
+            attrs = dec[decisions._attr_key_lookup[decision_type]]
+            if attrs.get('control') is not None:
+                attrs['control'] = serializing.add_trace_context(
+                        attrs['control'], context)
+
+    def _close_prefetcher(self):
+        if self._prefetcher is not None:
+            self._prefetcher.close()
+
+    @property
+    def new_events(self):
+        """Iterate over events added since the previous decision task.
+
+        Deciders keeping derived state in ``self.state`` only need to replay
+        these events. If the state was not restored from the history cache
+        (``warm`` is False, for instance after an eviction, on another
+        worker, or when another worker handled the previous decision task),
+        ``state`` is empty and all events are iterated over, so
+        that it is rebuilt from scratch.
+        """
+        for event in self.history:
+            if self.warm and event.id <= self.previous_started_event_id:
+                return
+            yield event
 
     def most_recent(self, event_type):
-        for event in self.events:
-            if event.type == event_type:
-                return event
-        return None
+        return self.history.most_recent(event_type)
 
     def filter(self, event_type):
-        return filter(lambda ev: ev.type == event_type, self.events)
+        return self.history.filter(event_type)
 
     @property
     def start_input(self):
@@ -208,7 +411,7 @@ class Decision(object):
         """
         if not hasattr(self, '_start_input'):
             started_event = self.most_recent('WorkflowExecutionStarted')
-            input_attr = started_event.attrs['input']
+            input_attr = started_event.raw_attrs['input']
             self._start_input = serializing.loads(input_attr)
         return self._start_input
 
@@ -221,6 +424,19 @@ class Decision(object):
         self._decisions.append(dec)
         return self
 
+    def start_timer(self, timer_id, start_to_fire_timeout, control=None):
+        """Adds a StartTimer decision.
+
+        :param start_to_fire_timeout: Seconds until the timer fires.
+        """
+        dec, attrs = decisions.skeleton("StartTimer")
+        attrs['timerId'] = timer_id
+        attrs['startToFireTimeout'] = str(start_to_fire_timeout)
+        if control is not None:
+            attrs['control'] = serializing.dumps(control, codec=self.codec)
+        self._decisions.append(dec)
+        return self
+
     def schedule(self, activity_type, *args, **kwargs):
         """Schedule activity. 
 
@@ -245,23 +461,143 @@ class Decision(object):
         self._decisions.append(dec)
         return self
 
+    def schedule_many(self, activity_type, inputs, key=None, control=None):
+        """Schedule one activity per input, over several decision tasks.
+
+        Only as many activities are scheduled as fit in this decision task
+        (see ``decisions.MAX_DECISIONS``). Progress is recorded in a marker
+        and a zero second timer makes sure there is a next decision task.
+        Call this method with the same inputs in every decision task until
+        it returns True. Inputs scheduled in earlier decision tasks are
+        skipped.
+
+        :param activity_type: Subclass of ``types.Activity``.
+        :param inputs: Sequence of inputs. Its order must not change between
+                       decision tasks.
+        :param key: Name of this fan-out, unique within the workflow
+                    execution. Defaults to the activity type name.
+        :param control: Control data for every scheduled activity.
+        :returns: True if all inputs have been scheduled.
+        """
+        if key is None:
+            key = activity_type.name
+        return self._fan_out(activity_type.schedule, inputs, key, control)
+
+    def start_children_many(self, workflow_type, inputs, key=None,
+                            control=None):
+        """Start one child workflow per input, over several decision tasks.
+
+        See ``schedule_many``.
+
+        :param workflow_type: Subclass of ``types.Workflow``.
+        :returns: True if all children have been started.
+        """
+        if key is None:
+            key = workflow_type.name
+        return self._fan_out(workflow_type.start_child, inputs, key, control)
+
+    def _fan_out_marker_name(self, key):
+        return 'flowser.fan_out.%s' % key
+
+    def _fan_out_done(self, marker_name):
+        """Number of inputs handled by earlier calls for a fan-out. """
+        if marker_name in self._fan_out_progress:
+            return self._fan_out_progress[marker_name]
+        for_marker = getattr(self.history, 'for_marker', None)
+        if for_marker is None:
+            raise Error('fan-out needs an indexed history')
+        markers = for_marker(marker_name)
+        if not markers:
+            return 0
+        details = serializing.loads(markers[0].raw_attrs['details'])
+        return details['done']
+
+    def _fan_out(self, build, inputs, key, control):
+        marker_name = self._fan_out_marker_name(key)
+        inputs = list(inputs)
+        done = self._fan_out_done(marker_name)
+        if done >= len(inputs):
+            return True
+
+        # Leave room for the marker and the timer.
+        room = decisions.MAX_DECISIONS - len(self._decisions) - 2
+        if room <= 0:
+            return False
+        chunk = inputs[done:done + room]
+        self._decisions.extend([build(input, control=control)
+                                for input in chunk])
+        done += len(chunk)
+        self._fan_out_progress[marker_name] = done
+        self.mark(marker_name, serializing.dumps(
+                {'done': done, 'total': len(inputs)}))
+        if done < len(inputs):
+            self.start_timer('%s.%d' % (marker_name, done), 0)
+            return False
+        return True
+
     def complete(self, context=None):
         execution_context = None
         if context is not None:
-            execution_context = serializing.dumps(context)
-        self._domain.conn.respond_decision_task_completed(
-                self.task_token, decisions=self._decisions,
-                execution_context=execution_context)
+            execution_context = serializing.dumps(context, codec=self.codec)
+        if self._span.context is not None:
+            self._add_trace_context()
+        started = time.time()
+        try:
+            with self._span.child('respond_decision_task_completed'):
+                self._domain.conn.respond_decision_task_completed(
+                        self.task_token, decisions=self._decisions,
+                        execution_context=execution_context)
+        finally:
+            self._close_prefetcher()
+        self._responded('respond_decision_task_completed', started)
+        cache = self._domain.history_cache
+        if cache is not None and not self._streaming:
+            cache.put(self._cache_key, self.history, self.state,
+                      self.started_event_id)
 
     def fail(self, details=None, reason=None):
-        self._domain.conn.respond_decision_task_failed(
-                self.task_token, details=details, reason=reason)
+        started = time.time()
+        try:
+            with self._span.child('respond_decision_task_failed'):
+                self._domain.conn.respond_decision_task_failed(
+                        self.task_token, details=details, reason=reason)
+        finally:
+            self._close_prefetcher()
+        self._span.set(error='failed')
+        self._responded('respond_decision_task_failed', started)
+
+    def _responded(self, call, started):
+        self._span.set(pages=self._pages_fetched)
+        self._span.finish()
+        instrumentation = self._domain.instrumentation
+        if not instrumentation.enabled:
+            return
+        now = time.time()
+        name = self.workflow_type.name
+        instrumentation.observe('flowser_request_seconds', now - started,
+                                call=call, type=name)
+        instrumentation.observe('flowser_decision_seconds',
+                                now - self._received, type=name)
+        instrumentation.observe('flowser_decision_history_pages',
+                                self._pages_fetched, type=name)
+
+    def acomplete(self, context=None):
+        """Asynchronous version of ``complete``. """
+        return aio.call(self._domain, self.complete, context=context)
+
+    def afail(self, details=None, reason=None):
+        """Asynchronous version of ``fail``. """
+        return aio.call(self._domain, self.fail, details=details,
+                        reason=reason)
 
 
 class Activity(object):
     """Wrapper for "PollForActivityTask" results.
 
     See http://docs.amazonwebservices.com/amazonswf/latest/apireference/API_PollForActivityTask.html.
+
+    The input is decoded the first time ``input`` is accessed. ``raw_input``
+    holds the serialized input.
     """
 
     def __init__(self, result, caller):
@@ -269,32 +605,87 @@ class Activity(object):
         :param result: Result structure from the API. 
         :param domain: A domain instance (optional). Needed for responses.
         """
+        self._received = time.time()
         self._caller = caller
         self._domain = caller._domain
+        self.codec = caller.codec
 
         self.activity_id = result['activityId']
         self.activity_type = ActivityType(result['activityType'])
-        self.input = serializing.loads(result['input'])
+        self.raw_input = result.get('input')
         self.started_event_id = result['startedEventId']
         self.task_token = result['taskToken']
         self.workflow_execution = WorkflowExecution(
                 result['workflowExecution'], self)
+        self._span = tracing.start_span(
+                self._domain.tracer, 'activity',
+                parent=tracing.execution_context(
+                        self.workflow_execution.workflow_id,
+                        self.workflow_execution.run_id),
+                start=self._received,
+                workflow_id=self.workflow_execution.workflow_id,
+                run_id=self.workflow_execution.run_id,
+                activity_id=self.activity_id,
+                activity_type=self.activity_type.name)
 
     def __repr__(self):
         return "<Activity activity_type(%s) %s>" % (
                 self.activity_type, self.workflow_execution)
 
+    @property
+    def input(self):
+        if not hasattr(self, '_input'):
+            self._input = None
+            if self.raw_input is not None:
+                self._input = serializing.loads(self.raw_input)
+        return self._input
+
     def complete(self, result=None):
         serialized_result = None
         if result is not None:
-            serialized_result = serializing.dumps(result)
-        return self._domain.conn.respond_activity_task_completed(
-                self.task_token, result=serialized_result)
+            serialized_result = serializing.dumps(result, codec=self.codec)
+        started = time.time()
+        with self._span.child('respond_activity_task_completed'):
+            response = self._domain.conn.respond_activity_task_completed(
+                    self.task_token, result=serialized_result)
+        self._responded('respond_activity_task_completed', 'completed',
+                        started)
+        return response
 
     def fail(self, details=None, reason=None):
-        self._domain.conn.respond_activity_task_failed(
-                self.task_token, details=details, reason=reason)
+        started = time.time()
+        with self._span.child('respond_activity_task_failed'):
+            self._domain.conn.respond_activity_task_failed(
+                    self.task_token, details=details, reason=reason)
+        self._responded('respond_activity_task_failed', 'failed', started)
+
+    def _responded(self, call, outcome, started):
+        self._span.set(outcome=outcome)
+        self._span.finish()
+        instrumentation = self._domain.instrumentation
+        if not instrumentation.enabled:
+            return
+        now = time.time()
+        name = self.activity_type.name
+        instrumentation.observe('flowser_request_seconds', now - started,
+                                call=call, type=name)
+        instrumentation.observe('flowser_activity_seconds',
+                                now - self._received, type=name,
+                                outcome=outcome)
+
+    def acomplete(self, result=None):
+        """Asynchronous version of ``complete``. """
+        return aio.call(self._domain, self.complete, result)
+
+    def afail(self, details=None, reason=None):
+        """Asynchronous version of ``fail``. """
+        return aio.call(self._domain, self.fail, details=details,
+                        reason=reason)
 
     def cancel(self, details=None):
-        self._domain.conn.respond_activity_task_canceled(
-                self.task_token, details=details)
+        started = time.time()
+        with self._span.child('respond_activity_task_canceled'):
+            self._domain.conn.respond_activity_task_canceled(
+                    self.task_token, details=details)
+        self._responded('respond_activity_task_canceled', 'canceled',
+                        started)
@@ -0,0 +1,194 @@
+# Copyright (c) 2012 Memoto AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Client side rate limiting.
+
+The purpose is to stay under the API's request rates and to recover from
+throttling without retry storms.
+
+``ThrottledConnection`` wraps a ``boto.swf`` connection. Pass it to
+``Domain`` instead of the connection itself::
+
+    conn = ThrottledConnection(boto.connect_swf(), rates={
+        'start_workflow_execution': (100, 200),
+        'signal_workflow_execution': (50, 100),
+        })
+    domain = MyDomain(conn)
+
+All threads using the domain share the wrapper and thereby its rate limits.
+"""
+import random
+import threading
+import time
+
+from boto.exception import SWFResponseError
+
+# Error codes of throttled requests.
+THROTTLING_ERROR_CODES = frozenset(['ThrottlingException'])
+
+
+def is_throttling_error(exc):
+    """True if ``exc`` is an API error caused by throttling. """
+    if not isinstance(exc, SWFResponseError):
+        return False
+    code = getattr(exc, 'error_code', None)
+    if code is None and isinstance(exc.body, dict):
+        code = exc.body.get('__type', '').split('#')[-1]
+    return code in THROTTLING_ERROR_CODES
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket.
+
+    Tokens are added at ``rate`` per second, up to ``burst`` tokens.
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        :param rate: Tokens added per second.
+        :param burst: Bucket size. Defaults to ``rate`` (at least one).
+        """
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(rate, 1))
+        self._tokens = self.burst
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = max(0.0, now - self._updated)
+        self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """Take a token, waiting for one if the bucket is empty.
+
+        :returns: Seconds spent waiting.
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill(time.time())
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    def try_acquire(self):
+        """Take a token if there is one.
+
+        :returns: True if a token was taken.
+        """
+        with self._lock:
+            self._refill(time.time())
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+
+class ThrottledConnection(object):
+    """Rate limiting and retrying wrapper of a ``boto.swf`` connection.
+
+    Calls to methods with a configured rate wait for a token from the
+    method's bucket. Calls failing with a throttling error are retried with
+    jittered exponential backoff, at most ``max_retries`` times.
+
+    Counters are kept in ``metrics``: calls, waits for a token, throttled
+    calls, retries, and calls that were still throttled after all retries,
+    each by method name.
+    """
+
+    def __init__(self, conn, rates=None, max_retries=5, base_delay=0.1,
+                 max_delay=20.0):
+        """
+        :param conn: A ``boto.swf`` connection.
+        :param rates: Dict mapping method names (such as
+                      ``'start_workflow_execution'``) to a rate or to a
+                      ``(rate, burst)`` tuple.
+        :param max_retries: Retries of throttled calls.
+        :param base_delay: Backoff before the first retry, in seconds.
+        :param max_delay: Maximum backoff, in seconds.
+        """
+        self._conn = conn
+        self._buckets = {}
+        for name, rate in (rates or {}).items():
+            if isinstance(rate, tuple):
+                self._buckets[name] = TokenBucket(*rate)
+            else:
+                self._buckets[name] = TokenBucket(rate)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.metrics = {
+                'calls': {},
+                'waited': {},
+                'throttled': {},
+                'retried': {},
+                'gave_up': {},
+                }
+        self._metrics_lock = threading.Lock()
+
+    def __getattr__(self, name):
+        attr = getattr(self._conn, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        wrapped = self._wrap(name, attr)
+        # Cache the wrapper, so __getattr__ is only called once per name.
+        self.__dict__[name] = wrapped
+        return wrapped
+
+    def _count(self, counter, name):
+        with self._metrics_lock:
+            counts = self.metrics[counter]
+            counts[name] = counts.get(name, 0) + 1
+
+    def backoff(self, attempt):
+        """Seconds to wait before retry number ``attempt`` (from zero). """
+        ceiling = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return random.uniform(0, ceiling)
+
+    def _wrap(self, name, method):
+        bucket = self._buckets.get(name)
+
+        def call(*args, **kwargs):
+            attempt = 0
+            while True:
+                if bucket is not None and bucket.acquire():
+                    self._count('waited', name)
+                self._count('calls', name)
+                try:
+                    return method(*args, **kwargs)
+                except SWFResponseError as exc:
+                    if not is_throttling_error(exc):
+                        raise
+                    self._count('throttled', name)
+                    if attempt >= self.max_retries:
+                        self._count('gave_up', name)
+                        raise
+                self._count('retried', name)
+                time.sleep(self.backoff(attempt))
+                attempt += 1
+        call.__name__ = name
+        call.__doc__ = method.__doc__
+        return call
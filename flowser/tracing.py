@@ -0,0 +1,264 @@
+# Copyright (c) 2012 Memoto AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Trace spans of workflow executions.
+
+The purpose is to see the critical path of a workflow execution: how much
+of it is spent waiting in task lists, deciding, running activities and
+fetching history. Set ``Domain.tracer``::
+
+    class MyDomain(Domain):
+        tracer = tracing.Tracer(
+                tracing.JSONLinesExporter('/var/tmp/flowser-spans.jsonl'))
+
+Spans recorded by flowser, with the ``workflow_id`` and ``run_id`` of the
+execution in their attributes:
+
+* ``start_workflow_execution``: ``Domain.start``. This is the root of the
+  trace of the execution.
+* ``child_workflow_execution``: the root of the trace of a child workflow,
+  recorded by the first decision task of the parent that sees the child
+  started. Its ``link`` attribute is the context of the decision task
+  that started the child, and ``parent_workflow_id`` and ``parent_run_id``
+  name the parent execution.
+* ``decision``: a decision task, from the poll result to the response.
+  ``decision.queue`` spans the time from scheduling to start of the task,
+  taken from the ``eventTimestamp`` of its history events.
+* ``activity``: an activity task, from the poll result to the response.
+* ``poll_for_decision_task`` (history pages after the first one) and
+  ``respond_*``: API calls made while handling a task.
+
+The trace context of a span is ``<trace id>-<span id>``. Every execution
+has a trace of its own, whose ids are derived from its workflow id and run
+id (see ``execution_context``), so decision and activity tasks join it
+without any payload carrying the context. The start span of an execution
+is the root of that trace.
+
+The control of activities and child workflows scheduled by a decision task
+carries the context of the decision task (see
+``serializing.add_trace_context``), so the history records which decision
+task scheduled them. It is read back for the ``link`` of child root spans.
+Control is only changed if it was given, and decoding it is not affected.
+Inputs and execution contexts are never changed.
+
+The span of the first decision task of a child workflow also has the
+``parent_workflow_id`` and ``parent_run_id`` attributes, and its ``link`` is
+the context of the root span of the parent execution.
+"""
+import hashlib
+import json
+import random
+import threading
+import time
+
+# Separator of trace and span ids in trace contexts.
+_SEPARATOR = '-'
+
+
+def _new_id(bits):
+    return '%0*x' % (bits // 4, random.getrandbits(bits))
+
+
+def parse_context(context):
+    """Split a trace context in a trace id and a span id.
+
+    :returns: A ``(trace_id, span_id)`` tuple, or ``(None, None)`` if
+              ``context`` is not a trace context.
+    """
+    if not context:
+        return None, None
+    trace_id, _, span_id = context.partition(_SEPARATOR)
+    if not trace_id or not span_id:
+        return None, None
+    return trace_id, span_id
+
+
+def execution_context(workflow_id, run_id):
+    """Get the trace context of the root span of an execution. """
+    key = (workflow_id + '\0' + run_id).encode('utf-8')
+    digest = hashlib.sha256(key).hexdigest()
+    return digest[:32] + _SEPARATOR + digest[32:48]
+
+
+class Span(object):
+    """A timed operation in a trace.
+
+    Spans are context managers. Leaving the block finishes the span, and
+    records the exception type in the ``error`` attribute if one was raised.
+    """
+
+    def __init__(self, tracer, name, trace_id, parent_id=None, start=None,
+                 attributes=None):
+        self._tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = _new_id(64)
+        self.parent_id = parent_id
+        self.start = start if start is not None else time.time()
+        self.end = None
+        self.attributes = dict(attributes or {})
+
+    def __repr__(self):
+        return "<Span %s %s>" % (self.name, self.context)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is not None:
+            self.attributes['error'] = exc_type.__name__
+        self.finish()
+        return False
+
+    @property
+    def context(self):
+        """Trace context to pass to spans in other processes. """
+        return self.trace_id + _SEPARATOR + self.span_id
+
+    def set(self, **attributes):
+        """Set attributes. """
+        self.attributes.update(attributes)
+
+    def set_context(self, context):
+        """Take the trace id and span id of a trace context.
+
+        Must be called before child spans are started.
+        """
+        self.trace_id, self.span_id = parse_context(context)
+
+    def child(self, name, start=None, **attributes):
+        """Start a child span. """
+        return self._tracer.start_span(name, parent=self, start=start,
+                                       **attributes)
+
+    def finish(self, end=None):
+        """End the span and export it. Later calls do nothing. """
+        if self.end is not None:
+            return
+        self.end = end if end is not None else time.time()
+        self._tracer.exporter.export(self.to_dict())
+
+    def to_dict(self):
+        return {
+                'trace_id': self.trace_id,
+                'span_id': self.span_id,
+                'parent_id': self.parent_id,
+                'name': self.name,
+                'start': self.start,
+                'end': self.end,
+                'duration': self.end - self.start
+                        if self.end is not None else None,
+                'attributes': self.attributes,
+                }
+
+
+class _NullSpan(object):
+    """Span of a domain without tracer. Records nothing. """
+
+    context = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+    def set_context(self, context):
+        pass
+
+    def child(self, name, start=None, **attributes):
+        return self
+
+    def finish(self, end=None):
+        pass
+
+NULL_SPAN = _NullSpan()
+
+
+class Tracer(object):
+    """Creates spans and hands finished ones to an exporter. """
+
+    def __init__(self, exporter):
+        """
+        :param exporter: Object with an ``export(record)`` method, called
+                         with the ``Span.to_dict`` of every finished span.
+        """
+        self.exporter = exporter
+
+    def start_span(self, name, parent=None, start=None, **attributes):
+        """Start a span.
+
+        :param parent: Parent ``Span``, or the trace context of a span in
+                       another process. Without a parent, a new trace is
+                       started.
+        :param start: Start time (defaults to now).
+        """
+        if isinstance(parent, Span):
+            trace_id, parent_id = parent.trace_id, parent.span_id
+        else:
+            trace_id, parent_id = parse_context(parent)
+        if trace_id is None:
+            trace_id = _new_id(128)
+        return Span(self, name, trace_id, parent_id, start, attributes)
+
+
+def start_span(tracer, name, parent=None, start=None, **attributes):
+    """Start a span with ``tracer``, or get ``NULL_SPAN`` if it is None. """
+    if tracer is None:
+        return NULL_SPAN
+    return tracer.start_span(name, parent=parent, start=start, **attributes)
+
+
+class JSONLinesExporter(object):
+    """Appends spans to a file, one JSON object per line.
+
+    The file is opened in append mode and flushed after every span, so it
+    can be followed while workers are running.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
+
+    def export(self, record):
+        line = json.dumps(record, sort_keys=True) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class MemoryExporter(object):
+    """Keeps spans in a list, for tests and interactive use. """
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def export(self, record):
+        with self._lock:
+            self.spans.append(record)
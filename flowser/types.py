@@ -22,7 +22,11 @@ import time
 
 from boto.swf.exceptions import SWFTypeAlreadyExistsError
 
+from flowser import bulk
 from flowser import serializing
+from flowser import tasks
+from flowser import tracing
+from flowser import visibility
 from flowser.exceptions import Error
 from flowser.exceptions import EmptyTaskPollResult
 from flowser import decisions
@@ -38,6 +42,11 @@ def _raise_if_empty_poll_result(result):
     return result
 
 
+def _count_poll(instrumentation, task, name, result):
+    instrumentation.count('flowser_polls_total', task=task, type=name,
+                          result='task' if 'taskToken' in result else 'empty')
+
+
 class Type(object):
     """Base class for Simple Workflow types (activities, workflows).
 
@@ -49,6 +58,15 @@ class Type(object):
     # the connection object (as returned by boto.connect_swf).
     _reg_func_name = None
 
+    # Override this in a subclass to the name of the connection method
+    # listing registered types, and the key of the type in its results.
+    _list_func_name = None
+    _type_info_key = None
+
+    # Name of the ``serializing`` codec used for inputs, results and control
+    # data. Defaults to ``serializing.default_codec``.
+    codec = None
+
     def __init__(self, domain):
         for needed_prop in ['name', 'task_list', 'version']:
             if not hasattr(self, needed_prop):
@@ -86,8 +104,12 @@ class Type(object):
 
         :raises: EmptyTaskPollResult
         """
-        result = self._conn.poll_for_activity_task(
-                self._domain.name, self.task_list, identity)
+        instrumentation = self._domain.instrumentation
+        with instrumentation.timer('flowser_poll_seconds',
+                                   task='activity', type=self.name):
+            result = self._conn.poll_for_activity_task(
+                    self._domain.name, self.task_list, identity)
+        _count_poll(instrumentation, 'activity', self.name, result)
         return _raise_if_empty_poll_result(result)
 
     def _poll_for_decision_task(self, identity=None, maximum_page_size=None, 
@@ -98,11 +120,28 @@ class Type(object):
 
         :raises: EmptyTaskPollResult
         """
-        result = self._conn.poll_for_decision_task( 
-                self._domain.name, self.task_list, identity, maximum_page_size, 
-                next_page_token, reverse_order)
+        instrumentation = self._domain.instrumentation
+        if next_page_token is not None:
+            # A further history page of a decision task.
+            instrumentation.count('flowser_history_pages_total',
+                                  type=self.name)
+            return self._conn.poll_for_decision_task(
+                    self._domain.name, self.task_list, identity,
+                    maximum_page_size, next_page_token, reverse_order)
+        with instrumentation.timer('flowser_poll_seconds',
+                                   task='decision', type=self.name):
+            result = self._conn.poll_for_decision_task( 
+                    self._domain.name, self.task_list, identity,
+                    maximum_page_size, next_page_token, reverse_order)
+        _count_poll(instrumentation, 'decision', self.name, result)
         return _raise_if_empty_poll_result(result)
 
+    def _count_pending_activity_tasks(self):
+        """Get the approximate number of tasks in the task list. """
+        result = self._conn.count_pending_activity_tasks(
+                self._domain.name, self.task_list)
+        return result['count']
+
 
 class Activity(Type):
     """Base class for activity types. 
@@ -112,28 +151,43 @@ class Activity(Type):
     """
 
     _reg_func_name = 'register_activity_type'
+    _list_func_name = 'list_activity_types'
+    _type_info_key = 'activityType'
 
     heartbeat_timeout = str(ONE_HOUR)
     schedule_to_close_timeout = str(ONE_HOUR)
     schedule_to_start_timeout = str(ONE_HOUR)
     start_to_close_timeout = str(ONE_HOUR)
 
+    @classmethod
+    def _get_schedule_template(cls):
+        """Get static ScheduleActivityTask attributes.
+
+        The template is built once per class and copied for every
+        decision (see ``decisions.from_template``).
+        """
+        template = cls.__dict__.get('_schedule_template')
+        if template is None:
+            template = {
+                    'activityType': {'name': cls.name, 'version': cls.version},
+                    'taskList': {'name': cls.task_list},
+                    'heartbeatTimeout': cls.heartbeat_timeout,
+                    'scheduleToCloseTimeout': cls.schedule_to_close_timeout,
+                    'scheduleToStartTimeout': cls.schedule_to_start_timeout,
+                    'startToCloseTimeout': cls.start_to_close_timeout,
+                    }
+            cls._schedule_template = template
+        return template
+
     @classmethod
     def schedule(cls, input, control=None):
         "Called from subclasses' ``schedule`` class method. "
-        dec, attrs = decisions.skeleton("ScheduleActivityTask")
+        dec, attrs = decisions.from_template(
+                "ScheduleActivityTask", cls._get_schedule_template())
         attrs['activityId'] = cls.get_id_from_input(input)
-        attrs['activityType'] = {
-                'name': cls.name,
-                'version': cls.version}
-        attrs['taskList'] = {'name': cls.task_list}
-        attrs['input'] = serializing.dumps(input)
-        attrs['heartbeatTimeout'] = cls.heartbeat_timeout
-        attrs['scheduleToCloseTimeout'] = cls.schedule_to_close_timeout
-        attrs['scheduleToStartTimeout'] = cls.schedule_to_start_timeout
-        attrs['startToCloseTimeout'] = cls.start_to_close_timeout
+        attrs['input'] = serializing.dumps(input, codec=cls.codec)
         if control is not None:
-            attrs['control'] = serializing.dumps(control)
+            attrs['control'] = serializing.dumps(control, codec=cls.codec)
         return dec
 
 
@@ -145,6 +199,8 @@ class Workflow(Type):
     """
 
     _reg_func_name = 'register_workflow_type'
+    _list_func_name = 'list_workflow_types'
+    _type_info_key = 'workflowType'
 
     # These may be overridden in subclasses.
     execution_start_to_close_timeout = '600'
@@ -153,6 +209,16 @@ class Workflow(Type):
     default_filter_tag = None
     default_tag_list = None
 
+    # Number of history pages decision tasks fetch ahead on a background
+    # thread. Zero disables read-ahead.
+    history_prefetch_pages = 0
+
+    # If set, decision tasks drop history pages once iterated over and only
+    # keep a summary. ``history_summary`` is the summary class, defaulting
+    # to ``history.LatestEvents``.
+    streaming_history = False
+    history_summary = None
+
     def _get_static_start_kwargs(self):
         "Get start execeution arguments that never change. "
         return {
@@ -168,6 +234,19 @@ class Workflow(Type):
                 'task_list': self.task_list,
                 }
 
+    @classmethod
+    def _get_child_start_template(cls):
+        """Get static StartChildWorkflowExecution attributes.
+
+        The template is built once per class and copied for every
+        decision (see ``decisions.from_template``).
+        """
+        template = cls.__dict__.get('_child_start_template')
+        if template is None:
+            template = cls._get_static_child_start_attrs()
+            cls._child_start_template = template
+        return template
+
     @classmethod
     def _get_static_child_start_attrs(cls):
         attrs = {}
@@ -206,17 +285,151 @@ class Workflow(Type):
                 workflow_name=self.name,
                 tag=self.default_filter_tag)
 
-    def _start(self, input):
+    def _iter_executions(self, method_name, date_names, latest_date,
+                         oldest_date, shards, use_cache=True):
+        # Defaulted dates are left out of the cache key, so that repeated
+        # queries relative to now hit the cache until the entry expires.
+        key = (method_name, self._domain.name, self.name,
+               self.default_filter_tag, oldest_date, latest_date)
+        if latest_date is None:
+            latest_date = time.time()
+        if oldest_date is None:
+            oldest_date = latest_date - ONE_DAY
+        method = getattr(self._conn, method_name)
+        oldest_name, latest_name = date_names
+
+        def fetch(oldest, latest, next_page_token):
+            kwargs = {oldest_name: oldest, latest_name: latest}
+            return method(self._domain.name,
+                          workflow_name=self.name,
+                          tag=self.default_filter_tag,
+                          next_page_token=next_page_token,
+                          **kwargs)
+
+        windows = visibility.shard_windows(oldest_date, latest_date, shards)
+        cache = self._domain.visibility_cache if use_cache else None
+        return visibility.iter_cached(
+                cache, key,
+                visibility.iter_windows(fetch, windows))
+
+    def iter_open(self, latest_date=None, oldest_date=None, shards=1):
+        """Iterate over open executions of this type, newest first.
+
+        All result pages are followed. The time range is split into
+        ``shards`` windows whose pages are fetched in parallel, which
+        speeds up scans of long ranges.
+
+        Results are cached if the domain has a ``visibility_cache``. Queries
+        with default dates are cached like any other, so results may be up
+        to the cache TTL old.
+
+        :param latest_date: End of the start time range (seconds since the
+                            epoch). Defaults to now.
+        :param oldest_date: Start of the range. Defaults to a day before
+                            ``latest_date``.
+        :param shards: Number of windows queried in parallel.
+        :returns: A generator of execution info dicts (see
+                  ListOpenWorkflowExecutions).
+        """
+        return self._iter_executions(
+                'list_open_workflow_executions',
+                ('oldest_date', 'latest_date'),
+                latest_date, oldest_date, shards)
+
+    def iter_closed(self, start_latest_date=None, start_oldest_date=None,
+                    shards=1):
+        """Iterate over closed executions of this type, newest first.
+
+        See ``iter_open``.
+        """
+        return self._iter_executions(
+                'list_closed_workflow_executions',
+                ('start_oldest_date', 'start_latest_date'),
+                start_latest_date, start_oldest_date, shards)
+
+    def _open_executions(self, predicate, latest_date, oldest_date):
+        # Bulk operations need fresh results, so the cache is bypassed.
+        infos = self._iter_executions(
+                'list_open_workflow_executions',
+                ('oldest_date', 'latest_date'),
+                latest_date, oldest_date, 1, use_cache=False)
+        for info in infos:
+            if predicate is None or predicate(info):
+                yield tasks.WorkflowExecution(info['execution'], self)
+
+    def _bulk(self, action, predicate=None, latest_date=None,
+              oldest_date=None, concurrency=10, rate=None, checkpoint=None):
+        executions = self._open_executions(
+                predicate, latest_date, oldest_date)
+        return bulk.run(executions, action, concurrency=concurrency,
+                        rate=rate, checkpoint=checkpoint)
+
+    def bulk_signal(self, name, input=None, predicate=None, **options):
+        """Signal open executions concurrently.
+
+        Open executions of this type started between ``oldest_date`` and
+        ``latest_date`` (default: the last day) are listed page by page.
+
+        :param name: Signal name.
+        :param input: Signal input (optional).
+        :param predicate: Callable taking an execution info dict (see
+                          ListOpenWorkflowExecutions). Only executions for
+                          which it returns True are signaled (optional).
+        :param options: ``latest_date``, ``oldest_date``, ``concurrency``,
+                        ``rate`` (calls per second) and ``checkpoint``
+                        (path of a file recording handled executions, so
+                        that an interrupted run can be resumed).
+        :returns: A generator of ``bulk.BulkResult`` tuples.
+        """
+        def signal(execution):
+            execution.signal(name, input=input)
+        return self._bulk(signal, predicate, **options)
+
+    def bulk_request_cancel(self, predicate=None, **options):
+        """Request cancellation of open executions concurrently.
+
+        See ``bulk_signal``.
+        """
+        def request_cancel(execution):
+            execution.request_cancel()
+        return self._bulk(request_cancel, predicate, **options)
+
+    def bulk_terminate(self, details=None, reason=None, predicate=None,
+                       **options):
+        """Terminate open executions concurrently.
+
+        See ``bulk_signal``.
+        """
+        def terminate(execution):
+            execution.terminate(details=details, reason=reason)
+        return self._bulk(terminate, predicate, **options)
+
+    def _start(self, input, static_kwargs=None):
         """Start workflow execution. 
 
         ``input`` is serialized and a workflow id is generated from it
         using ``get_id_from_input``.
 
+        :param static_kwargs: Result of ``_get_static_start_kwargs``, for
+                              callers starting many executions.
         """
-        kwargs = self._get_static_start_kwargs()
+        if static_kwargs is None:
+            kwargs = self._get_static_start_kwargs()
+        else:
+            kwargs = dict(static_kwargs)
         kwargs['workflow_id'] = self.get_id_from_input(input)
-        kwargs['input'] = serializing.dumps(input)
-        return self._conn.start_workflow_execution(**kwargs)
+        kwargs['input'] = serializing.dumps(input, codec=self.codec)
+        span = tracing.start_span(
+                self._domain.tracer, 'start_workflow_execution',
+                workflow_id=kwargs['workflow_id'], workflow_type=self.name)
+        with span, self._domain.instrumentation.timer(
+                'flowser_request_seconds', call='start_workflow_execution',
+                type=self.name):
+            result = self._conn.start_workflow_execution(**kwargs)
+            span.set(run_id=result['runId'])
+            span.set_context(tracing.execution_context(
+                    kwargs['workflow_id'], result['runId']))
+        return result
 
     @classmethod
     def start_child(cls, input, control=None):
@@ -226,11 +439,12 @@ class Workflow(Type):
         using ``get_id_from_input``.
 
         """
-        dec, attrs = decisions.skeleton("StartChildWorkflowExecution")
-        attrs.update(cls._get_static_child_start_attrs())
+        dec, attrs = decisions.from_template(
+                "StartChildWorkflowExecution",
+                cls._get_child_start_template())
         attrs['workflowId'] = cls.get_id_from_input(input)
-        attrs['input'] = serializing.dumps(input)
+        attrs['input'] = serializing.dumps(input, codec=cls.codec)
         if control is not None:
-            attrs['control'] = serializing.dumps(control)
+            attrs['control'] = serializing.dumps(control, codec=cls.codec)
         return dec
 
@@ -0,0 +1,163 @@
+# Copyright (c) 2012 Memoto AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Visibility queries.
+
+The purpose is to scan long time ranges of workflow executions quickly.
+A range is split into shards, the pages of all shards are fetched in
+parallel, and executions are yielded newest first, as the API returns them
+for a single query.
+
+See ``types.Workflow.iter_open`` and ``types.Workflow.iter_closed``.
+"""
+import collections
+import math
+import threading
+import time
+
+from flowser.exceptions import LastPage
+from flowser.history import PagePrefetcher
+
+# Pages fetched ahead per shard.
+PAGES_AHEAD = 2
+
+# Token of the first page, which has no token.
+_FIRST_PAGE = object()
+
+# Timestamps have millisecond resolution. Shard boundaries are whole
+# milliseconds, and a boundary belongs to the newer shard only, so that
+# executions on it are returned once.
+_RESOLUTION = 0.001
+
+
+def shard_windows(oldest_date, latest_date, shards):
+    """Split a time range into adjacent windows, newest first.
+
+    :param oldest_date: Start of the range (seconds since the epoch).
+    :param latest_date: End of the range (seconds since the epoch).
+    :param shards: Number of windows.
+    :returns: A list of ``(oldest_date, latest_date)`` tuples.
+    """
+    shards = max(1, int(shards))
+    step = (latest_date - oldest_date) / float(shards)
+    if step <= 2 * _RESOLUTION:
+        return [(oldest_date, latest_date)]
+    # Boundaries in whole milliseconds, newest first.
+    boundaries = [int(math.floor((latest_date - i * step) * 1000))
+                  for i in range(1, shards)]
+    windows = []
+    latest = latest_date
+    for boundary in boundaries:
+        windows.append((boundary / 1000.0, latest))
+        latest = (boundary - 1) / 1000.0
+    windows.append((oldest_date, latest))
+    return windows
+
+
+def iter_windows(fetch, windows):
+    """Iterate over execution infos of windows, fetched in parallel.
+
+    :param fetch: Callable taking ``oldest_date``, ``latest_date`` and a
+                  page token (None for the first page) and returning a
+                  ``List*WorkflowExecutions`` result.
+    :param windows: List of ``(oldest_date, latest_date)`` tuples, newest
+                    first.
+    :returns: A generator of execution info dicts.
+    """
+    def page_fetcher(oldest, latest):
+        def fetch_page(token):
+            if token is _FIRST_PAGE:
+                token = None
+            result = fetch(oldest, latest, token)
+            return (result.get('executionInfos', []),
+                    result.get('nextPageToken'))
+        return fetch_page
+
+    prefetchers = [PagePrefetcher(page_fetcher(oldest, latest),
+                                  _FIRST_PAGE, PAGES_AHEAD)
+                   for oldest, latest in windows]
+    try:
+        for prefetcher in prefetchers:
+            while True:
+                try:
+                    infos, token = prefetcher.next_page()
+                except LastPage:
+                    break
+                for info in infos:
+                    yield info
+    finally:
+        for prefetcher in prefetchers:
+            prefetcher.close()
+
+
+class VisibilityCache(object):
+    """Thread-safe cache of visibility query results.
+
+    Results are kept for ``ttl`` seconds, which suits dashboards repeating
+    the same queries. At most ``max_entries`` results are kept.
+    """
+
+    def __init__(self, ttl=10.0, max_entries=128):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._results = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Get a cached list of execution infos, or None. """
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is not None and entry[0] > time.time():
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._results[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, infos):
+        with self._lock:
+            self._results.pop(key, None)
+            self._results[key] = (time.time() + self.ttl, infos)
+            while len(self._results) > self.max_entries:
+                self._results.popitem(last=False)
+
+
+def iter_cached(cache, key, infos):
+    """Iterate over ``infos``, caching them once exhausted.
+
+    :param cache: A ``VisibilityCache``, or None.
+    """
+    if cache is None:
+        for info in infos:
+            yield info
+        return
+    cached = cache.get(key)
+    if cached is not None:
+        for info in cached:
+            yield info
+        return
+    seen = []
+    for info in infos:
+        seen.append(info)
+        yield info
+    cache.put(key, seen)
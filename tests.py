@@ -27,16 +27,50 @@ Example run:
     $ FLOWSER_TEST_DOMAIN=flowser python tests.py
 
 """
+import gc
+import json
 import os
 import unittest
 from uuid import uuid4
 import threading
 import logging
 import sys
+import shutil
+from functools import reduce
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
+import tempfile
+import time
 
 import boto
+from boto.exception import SWFResponseError
+from boto.swf.exceptions import SWFWorkflowExecutionAlreadyStartedError
 
 import flowser
+import flowser.aio
+import flowser.blobs
+import flowser.metrics
+from flowser.fake import FakeConnection
+from flowser.throttling import ThrottledConnection
+from flowser.throttling import is_throttling_error
+from flowser.decisions import _attr_key_lookup as decision_attr_keys
+from flowser.events import _attr_key_lookup
+from flowser.exceptions import LastPage
+from flowser.history import History
+from flowser.history import HistoryCache
+from flowser.history import PagePrefetcher
+from flowser.history import StreamingHistory
+from flowser.pool import FairSemaphore
+from flowser.pool import ActivityWorkerPool
+from flowser.pool import Poller
+from flowser.pool import PollSupervisor
+from flowser.profiling import DecisionProfiler
+from flowser.tracing import MemoryExporter
+from flowser.tracing import execution_context
+from flowser.tracing import Tracer
+from flowser.visibility import VisibilityCache
 
 TEST_DOMAIN = os.environ.get('FLOWSER_TEST_DOMAIN', None)
 if_environment = unittest.skipIf(not TEST_DOMAIN, 'FLOWSER_TEST_DOMAIN unset')
@@ -148,6 +182,19 @@ class SumWorker(WorkerThread):
         task.complete([op[0], sum(op[1])])
 
 
+def handle_arithmetic(task):
+    op = task.input['operation']
+    if task.activity_type.name == MultiplyActivity.name:
+        return [op[0], reduce(lambda a, b: a * b, op[1])]
+    return [op[0], sum(op[1])]
+
+
+def multiply_input(input):
+    """Handler for process pools. Module level, so it can be pickled. """
+    op = input['operation']
+    return [op[0], reduce(lambda a, b: a * b, op[1])]
+
+
 class TestDomain(flowser.Domain):
     name = TEST_DOMAIN
     workflow_types = [ArithmeticWorkflow]
@@ -190,6 +237,1498 @@ class FlowserTestCase(unittest.TestCase):
         self.assertEqual(decider.result['mult_id'], 6)
         self.assertEqual(decider.result['sum_id'], 10)
 
+    @if_environment
+    def test_activity_worker_pool(self):
+        pool = self.domain.run_activity_workers(
+                [MultiplyActivity, SumActivity], handle_arithmetic,
+                pollers=2, max_in_flight=4, wait=False)
+        decider = ArithmeticWorkflowDecider(self.domain)
+        decider.start()
+
+        arithmetic_input = self.get_input({
+            'operations': [
+                ['mult_id', 'multiply', [2, 3, 4]],
+                ['sum_id', 'sum', [2, 3, 4]],
+                ]
+            })
+        self.domain.start(ArithmeticWorkflow, arithmetic_input)
+
+        decider.join()
+        pool.stop()
+        self.assertEqual(decider.result['mult_id'], 24)
+        self.assertEqual(decider.result['sum_id'], 9)
+
+
+def make_event(event_id, event_type, **attrs):
+    """Build a raw history event as returned by the API. """
+    return {
+            'eventId': event_id,
+            'eventTimestamp': 1350000000.0 + event_id,
+            'eventType': event_type,
+            _attr_key_lookup[event_type]: attrs,
+            }
+
+
+def make_pages(events, page_size):
+    """Split raw events (most recent first) into a first page and a
+    ``next_page`` callable serving the rest.
+    """
+    pages = [events[i:i + page_size] for i in range(0, len(events), page_size)]
+    remaining = pages[1:]
+    fetched = []
+
+    def next_page():
+        if not remaining:
+            raise LastPage
+        fetched.append(1)
+        return remaining.pop(0)
+    return pages[0], next_page, fetched
+
+
+class HistoryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        events = [
+            make_event(1, 'WorkflowExecutionStarted', input='{"id": "a"}'),
+            make_event(2, 'DecisionTaskScheduled'),
+            make_event(3, 'ActivityTaskScheduled', activityId='act-1'),
+            make_event(4, 'TimerStarted', timerId='timer-1'),
+            make_event(5, 'ActivityTaskStarted', scheduledEventId=3),
+            make_event(6, 'ActivityTaskCompleted', scheduledEventId=3,
+                       startedEventId=5, result='42'),
+            make_event(7, 'TimerFired', timerId='timer-1', startedEventId=4),
+            make_event(8, 'DecisionTaskScheduled'),
+            ]
+        events.reverse()
+        first_page, next_page, self.fetched = make_pages(events, 3)
+        self.history = History(first_page, next_page)
+
+    def test_most_recent_loads_pages_lazily(self):
+        most_recent = self.history.most_recent('DecisionTaskScheduled')
+        self.assertEqual(most_recent.id, 8)
+        self.assertEqual(len(self.fetched), 0)
+        self.assertEqual(self.history.most_recent('TimerStarted').id, 4)
+        self.assertEqual(len(self.fetched), 1)
+        self.assertEqual(self.history.most_recent('MarkerRecorded'), None)
+        self.assertTrue(self.history.complete)
+
+    def test_lookups(self):
+        self.assertEqual(
+                [ev.id for ev in self.history.filter('DecisionTaskScheduled')],
+                [8, 2])
+        self.assertEqual(self.history.get(6).attrs['result'], 42)
+        self.assertEqual(self.history.get(100), None)
+        self.assertEqual(
+                [ev.id for ev in self.history.for_activity('act-1')],
+                [6, 5, 3])
+        self.assertEqual(
+                [ev.id for ev in self.history.for_timer('timer-1')], [7, 4])
+        self.assertEqual([ev.id for ev in self.history], list(range(8, 0, -1)))
+
+    def test_payloads_are_decoded_lazily(self):
+        event = self.history.get(6)
+        self.assertEqual(event._attrs, None)
+        self.assertEqual(event.attrs['result'], 42)
+        self.assertEqual(event.raw_attrs['result'], '42')
+
+    def test_columns(self):
+        history = self.history
+        self.assertEqual(len(history), 3)
+        self.assertEqual((history.newest_id, history.oldest_id), (8, 6))
+        self.assertFalse(history.complete)
+        list(history)
+        self.assertEqual(len(history), 8)
+        self.assertEqual(list(history._ids), list(range(8, 0, -1)))
+        self.assertEqual(history._time_stamps[0], 1350000008.0)
+        self.assertEqual(history.oldest_id, 1)
+        self.assertTrue(history.complete)
+        event = history.get(5)
+        self.assertEqual((event.type, event.time_stamp),
+                         ('ActivityTaskStarted', 1350000005.0))
+        self.assertEqual(event.raw_attrs, {'scheduledEventId': 3})
+        # Events stay the same objects while they are referenced.
+        self.assertTrue(history.get(5) is event)
+        self.assertTrue(list(history)[3] is event)
+
+    def test_position(self):
+        list(self.history)
+        self.assertEqual(self.history._position(8), 0)
+        self.assertEqual(self.history._position(1), 7)
+        self.assertEqual(self.history._position(9), None)
+        self.assertEqual(self.history._position(0), None)
+
+    def test_position_with_gaps(self):
+        # Ids of the loaded events need not be consecutive.
+        events = [make_event(i, 'DecisionTaskScheduled')
+                  for i in [20, 19, 15, 12, 11, 3]]
+        history = History(events)
+        for pos, event_id in enumerate([20, 19, 15, 12, 11, 3]):
+            self.assertEqual(history._position(event_id), pos)
+        for event_id in [21, 18, 13, 10, 4, 2]:
+            self.assertEqual(history._position(event_id), None)
+        self.assertEqual(History([])._position(1), None)
+
+
+class HistoryCacheTestCase(unittest.TestCase):
+
+    def make_history(self, last_event_id, page_size, base=None):
+        events = [make_event(i, 'DecisionTaskScheduled')
+                  for i in range(last_event_id, 0, -1)]
+        first_page, next_page, fetched = make_pages(events, page_size)
+        return History(first_page, next_page, base=base), fetched
+
+    def test_warm_history_only_fetches_new_pages(self):
+        cache = HistoryCache()
+        cold, fetched = self.make_history(20, 5)
+        list(cold)
+        self.assertEqual(len(fetched), 3)
+        cache.put(('wf', 'run'), cold, {'seen': 20})
+
+        base, state, started_event_id = cache.pop(('wf', 'run'))
+        self.assertEqual(state, {'seen': 20})
+        warm, fetched = self.make_history(27, 5, base=base)
+        self.assertEqual([ev.id for ev in warm], list(range(27, 0, -1)))
+        self.assertEqual(len(fetched), 1)
+        self.assertEqual(cache.pop(('wf', 'run')), None)
+
+    def test_eviction(self):
+        cache = HistoryCache(max_events=25)
+        for run_id in ['a', 'b']:
+            history, fetched = self.make_history(10, 10)
+            list(history)
+            cache.put(('wf', run_id), history, {})
+        history, fetched = self.make_history(10, 5)
+        cache.put(('wf', 'incomplete'), history, {})
+        self.assertEqual(len(cache), 2)
+        history, fetched = self.make_history(10, 10)
+        list(history)
+        cache.put(('wf', 'c'), history, {})
+        self.assertEqual(cache.pop(('wf', 'a')), None)
+        self.assertNotEqual(cache.pop(('wf', 'c')), None)
+
+
+class DecisionStateTestCase(unittest.TestCase):
+
+    def setUp(self):
+        class CachedDomain(FakeDomain):
+            history_cache = HistoryCache()
+
+        self.domain = CachedDomain(FakeConnection(page_size=2))
+        self.domain.register()
+        run_id = self.domain.start(ArithmeticWorkflow, {'id': '1'})['runId']
+        self.key = ('ArithmeticWorkflow.1', run_id)
+        self.execution = flowser.tasks.WorkflowExecution(
+                {'workflowId': self.key[0], 'runId': run_id},
+                ArithmeticWorkflow(self.domain))
+
+    def decide(self, domain=None):
+        """Count signals in ``state``, replaying only new events. """
+        domain = domain or self.domain
+        task = next(domain.decisions(ArithmeticWorkflow))
+        for event in task.new_events:
+            if event.type == 'WorkflowExecutionSignaled':
+                task.state['signals'] = task.state.get('signals', 0) + 1
+        task.complete()
+        return task
+
+    def test_state_is_rebuilt_after_eviction(self):
+        self.execution.signal('a')
+        task = self.decide()
+        self.assertFalse(task.warm)
+        self.assertEqual(task.state, {'signals': 1})
+
+        self.execution.signal('b')
+        task = self.decide()
+        self.assertTrue(task.warm)
+        self.assertEqual(task.state, {'signals': 2})
+
+        self.domain.history_cache.pop(self.key)
+        self.execution.signal('c')
+        task = self.decide()
+        self.assertFalse(task.warm)
+        self.assertEqual(task.state, {'signals': 3})
+
+    def test_state_is_rebuilt_after_another_worker_decided(self):
+        class OtherDomain(FakeDomain):
+            history_cache = HistoryCache()
+        other = OtherDomain(self.domain.conn)
+
+        self.execution.signal('a')
+        self.decide()
+        self.execution.signal('b')
+        task = self.decide(other)
+        self.assertEqual(task.state, {'signals': 2})
+
+        self.execution.signal('c')
+        task = self.decide()
+        self.assertFalse(task.warm)
+        self.assertEqual(task.state, {'signals': 3})
+        history, state, started_event_id = \
+                self.domain.history_cache.pop(self.key)
+        self.assertEqual(started_event_id, task.started_event_id)
+
+    def test_cached_history_drops_pager(self):
+        for i in range(5):
+            self.execution.signal(str(i))
+        task = self.decide()
+        self.assertTrue(task._pages_fetched > 0)
+        history, state, started_event_id = \
+                self.domain.history_cache.pop(self.key)
+        self.assertTrue(history.complete)
+        self.assertEqual(history._next_page, None)
+
+    def test_prefetch_stops_at_cached_events(self):
+        for i in range(5):
+            self.execution.signal(str(i))
+        self.decide()
+        self.execution.signal('a')
+        ArithmeticWorkflow.history_prefetch_pages = 5
+        try:
+            task = self.decide()
+        finally:
+            del ArithmeticWorkflow.history_prefetch_pages
+        self.assertTrue(task.warm)
+        self.assertEqual(task._prefetcher._limit, 1)
+        task._prefetcher._thread.join(5)
+        self.assertEqual(task._pages_fetched, 1)
+        self.assertEqual(task.state, {'signals': 6})
+
+    def test_prefetcher_is_closed_when_respond_fails(self):
+        def respond(*args, **kwargs):
+            raise ValueError('respond failed')
+        self.domain.conn.respond_decision_task_completed = respond
+        for i in range(5):
+            self.execution.signal(str(i))
+        ArithmeticWorkflow.history_prefetch_pages = 1
+        try:
+            task = next(self.domain.decisions(ArithmeticWorkflow))
+        finally:
+            del ArithmeticWorkflow.history_prefetch_pages
+        self.assertRaises(ValueError, task.complete)
+        self.assertTrue(task._prefetcher._closed.is_set())
+
+
+class StreamingHistoryTestCase(unittest.TestCase):
+
+    def test_pages_are_dropped(self):
+        events = [make_event(i, 'DecisionTaskScheduled')
+                  for i in range(10, 1, -1)]
+        events.append(make_event(1, 'WorkflowExecutionStarted', input='{}'))
+        first_page, next_page, fetched = make_pages(events, 3)
+        history = StreamingHistory(first_page, next_page)
+
+        ids = []
+        for event in history:
+            ids.append(event.id)
+            self.assertTrue(len(history._page) <= 3)
+        self.assertEqual(ids, list(range(10, 0, -1)))
+        self.assertEqual(history.most_recent('DecisionTaskScheduled').id, 10)
+        self.assertEqual(history.most_recent('WorkflowExecutionStarted').id, 1)
+        self.assertRaises(flowser.exceptions.Error, history.filter,
+                          'DecisionTaskScheduled')
+
+
+class SerializingTestCase(unittest.TestCase):
+
+    def test_codecs_round_trip(self):
+        obj = {'id': 'a', 'operations': [['op', 'sum', [1, 2, 3]]]}
+        for codec in flowser.serializing.available_codecs():
+            serialized = flowser.serializing.dumps(obj, codec=codec)
+            self.assertEqual(flowser.serializing.loads(serialized), obj)
+
+    def test_json_has_no_header(self):
+        self.assertEqual(flowser.serializing.dumps([1, 2]), '[1, 2]')
+        self.assertEqual(flowser.serializing.loads('[1, 2]'), [1, 2])
+        self.assertRaises(TypeError, flowser.serializing.loads, None)
+
+    def test_compression(self):
+        serializing = flowser.serializing
+        obj = {'values': ['photos/summer.jpg'] * 1000}
+        plain = serializing.dumps(obj)
+        compress_threshold = serializing.compress_threshold
+        compression = serializing.compression
+        serializing.compress_threshold = 100
+        try:
+            for name in sorted(serializing._compressors):
+                serializing.compression = name
+                compressed = serializing.dumps(obj)
+                self.assertTrue(compressed.startswith('#fl1:' + name + ':'))
+                self.assertTrue(len(compressed) < len(plain))
+                self.assertEqual(serializing.loads(compressed), obj)
+            self.assertEqual(serializing.dumps([1, 2]), '[1, 2]')
+        finally:
+            serializing.compress_threshold = compress_threshold
+            serializing.compression = compression
+        self.assertEqual(serializing.loads(compressed), obj)
+
+    def test_blob_offloading(self):
+        serializing = flowser.serializing
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        store = flowser.blobs.FileBlobStore(directory)
+        obj = {'values': list(range(1000))}
+        blob_threshold = serializing.blob_threshold
+        serializing.blob_threshold = 1000
+        self.addCleanup(setattr, serializing, 'blob_threshold', blob_threshold)
+        serializing.blob_store = store
+        try:
+            ref = serializing.dumps(obj)
+            self.assertEqual(serializing.dumps(obj), ref)
+            self.assertTrue(ref.startswith('#fl1:blob:'))
+            self.assertEqual(serializing.dumps([1, 2]), '[1, 2]')
+        finally:
+            serializing.blob_store = None
+        serializing.blob_store = store
+        serializing.blob_cache = flowser.blobs.BlobCache()
+        try:
+            self.assertEqual(serializing.loads(ref), obj)
+        finally:
+            serializing.blob_store = None
+        self.assertEqual(serializing.loads(ref), obj)
+
+
+    def test_blob_keys_are_checked(self):
+        serializing = flowser.serializing
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        store = flowser.blobs.FileBlobStore(directory)
+        with open(os.path.join(directory, 'secret'), 'wb') as f:
+            f.write(b'"secret"')
+        serializing.blob_store = store
+        self.addCleanup(setattr, serializing, 'blob_store', None)
+        for key in [os.path.join(directory, 'secret'), '../secret',
+                    'A' * 64, 'a' * 63, 'a' * 64 + '\n']:
+            self.assertRaises(flowser.blobs.InvalidBlobKey,
+                              serializing.loads, '#fl1:blob:' + key)
+            self.assertRaises(flowser.blobs.InvalidBlobKey, store.get, key)
+
+
+class DecisionTemplateTestCase(unittest.TestCase):
+
+    def test_schedule(self):
+        first = MultiplyActivity.schedule({'id': '1'}, control=[1])
+        second = MultiplyActivity.schedule({'id': '2'})
+        attrs = first['scheduleActivityTaskDecisionAttributes']
+        self.assertEqual(attrs['activityId'], 'MultiplyActivity.1')
+        self.assertEqual(attrs['activityType'],
+                         {'name': 'MultiplyActivity', 'version': '1.0.0'})
+        self.assertEqual(attrs['taskList'],
+                         {'name': 'MultiplyActivity-1.0.0'})
+        self.assertEqual(attrs['control'], '[1]')
+        self.assertFalse(
+                'control' in second['scheduleActivityTaskDecisionAttributes'])
+
+    def test_decisions_do_not_share_nested_attributes(self):
+        first = MultiplyActivity.schedule({'id': '1'})
+        attrs = first['scheduleActivityTaskDecisionAttributes']
+        attrs['taskList']['name'] = 'priority'
+        attrs['activityType']['version'] = '2.0.0'
+        second = MultiplyActivity.schedule({'id': '2'})
+        attrs = second['scheduleActivityTaskDecisionAttributes']
+        self.assertEqual(attrs['taskList'],
+                         {'name': 'MultiplyActivity-1.0.0'})
+        self.assertEqual(attrs['activityType']['version'], '1.0.0')
+
+        child = ArithmeticWorkflow.start_child({'id': '1'})
+        attrs = child['startChildWorkflowExecutionDecisionAttributes']
+        attrs['taskList']['name'] = 'priority'
+        attrs = ArithmeticWorkflow.start_child({'id': '2'})[
+                'startChildWorkflowExecutionDecisionAttributes']
+        self.assertNotEqual(attrs['taskList']['name'], 'priority')
+
+    def test_start_child(self):
+        dec = ArithmeticWorkflow.start_child({'id': '1'})
+        attrs = dec['startChildWorkflowExecutionDecisionAttributes']
+        self.assertEqual(attrs['workflowId'], 'ArithmeticWorkflow.1')
+        self.assertEqual(attrs['childPolicy'], 'TERMINATE')
+        self.assertFalse('input' in
+                         ArithmeticWorkflow._get_child_start_template())
+
+
+class StubCaller(object):
+    """Stands in for a ``types.Workflow`` instance in decision tests. """
+
+    codec = None
+
+    def __init__(self):
+        self._domain = TestDomain(None)
+
+
+def make_decision(events):
+    result = {
+            'events': events,
+            'previousStartedEventId': 0,
+            'startedEventId': events[0]['eventId'] if events else 0,
+            'taskToken': 'token',
+            'workflowExecution': {'workflowId': 'wf', 'runId': 'run'},
+            'workflowType': {'name': 'ArithmeticWorkflow',
+                             'version': '1.0.0'},
+            }
+    return flowser.tasks.Decision(result, StubCaller())
+
+
+class FanOutTestCase(unittest.TestCase):
+
+    def test_schedule_many_over_several_decision_tasks(self):
+        inputs = [{'id': str(i)} for i in range(250)]
+        events = []
+        scheduled = []
+        while True:
+            task = make_decision(list(reversed(events)))
+            all_scheduled = task.schedule_many(SumActivity, inputs)
+            self.assertTrue(len(task._decisions) <= 100)
+            for dec in task._decisions:
+                attrs = dec[decision_attr_keys[dec['decisionType']]]
+                if dec['decisionType'] == 'ScheduleActivityTask':
+                    scheduled.append(attrs['activityId'])
+                elif dec['decisionType'] == 'RecordMarker':
+                    events.append(make_event(
+                            len(events) + 1, 'MarkerRecorded', **attrs))
+            if all_scheduled:
+                break
+            self.assertEqual(task._decisions[-1]['decisionType'],
+                             'StartTimer')
+        self.assertEqual(scheduled,
+                         ['SumActivity.%d' % i for i in range(250)])
+        task = make_decision(list(reversed(events)))
+        self.assertTrue(task.schedule_many(SumActivity, inputs))
+        self.assertEqual(task._decisions, [])
+
+
+class ThrottledConnectionTestCase(unittest.TestCase):
+
+    def test_throttled_calls_are_retried(self):
+        calls = []
+
+        class Connection(object):
+            def signal_workflow_execution(self, *args, **kwargs):
+                calls.append(args)
+                if len(calls) < 3:
+                    raise SWFResponseError(400, 'Bad Request', body={
+                        '__type': 'com.amazon.coral.availability#'
+                                  'ThrottlingException'})
+                return {}
+
+            def describe_domain(self, name):
+                raise SWFResponseError(400, 'Bad Request', body={
+                    '__type': 'com.amazonaws.swf.base.model#'
+                              'UnknownResourceFault'})
+
+        conn = ThrottledConnection(
+                Connection(), rates={'signal_workflow_execution': 1000},
+                base_delay=0.001)
+        self.assertEqual(conn.signal_workflow_execution('d', 's', 'w'), {})
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(conn.metrics['throttled'],
+                         {'signal_workflow_execution': 2})
+        self.assertRaises(SWFResponseError, conn.describe_domain, 'd')
+        self.assertEqual(conn.metrics['retried'],
+                         {'signal_workflow_execution': 2})
+
+
+class StartManyTestCase(unittest.TestCase):
+
+    def test_start_many(self):
+        lock = threading.Lock()
+        in_flight = [0, 0]
+
+        class Connection(object):
+            def start_workflow_execution(self, **kwargs):
+                with lock:
+                    in_flight[0] += 1
+                    in_flight[1] = max(in_flight)
+                with lock:
+                    in_flight[0] -= 1
+                if kwargs['workflow_id'] == 'ArithmeticWorkflow.3':
+                    raise SWFWorkflowExecutionAlreadyStartedError(
+                            400, 'Bad Request', body={})
+                return {'runId': 'run-' + kwargs['input']}
+
+        domain = TestDomain(Connection())
+        inputs = ({'id': str(i)} for i in range(50))
+        results = list(domain.start_many(
+                ArithmeticWorkflow, inputs, concurrency=4))
+        self.assertEqual(len(results), 50)
+        self.assertTrue(in_flight[1] <= 4)
+        self.assertFalse([r for r in results if r.error])
+        already_started = [r for r in results if r.already_started]
+        self.assertEqual([r.workflow_id for r in already_started],
+                         ['ArithmeticWorkflow.3'])
+
+    def test_bad_input_does_not_stop_the_run(self):
+        class Connection(object):
+            def start_workflow_execution(self, **kwargs):
+                return {'runId': 'run'}
+
+        domain = TestDomain(Connection())
+        inputs = [{'id': '1'}, {'no-id': True}, {'id': '2'}]
+        results = list(domain.start_many(ArithmeticWorkflow, inputs))
+        self.assertEqual(len(results), 3)
+        failed = [r for r in results if r.error]
+        self.assertEqual(len(failed), 1)
+        self.assertEqual(failed[0].workflow_id, None)
+        self.assertTrue(isinstance(failed[0].error, KeyError))
+        self.assertEqual(sorted(r.run_id for r in results if not r.error),
+                         ['run', 'run'])
+
+
+class WorkflowExecutionTestCase(unittest.TestCase):
+
+    def test_request_cancel(self):
+        calls = []
+
+        class Connection(object):
+            def request_cancel_workflow_execution(self, domain, workflow_id,
+                                                  run_id=None):
+                calls.append((domain, workflow_id, run_id))
+
+        caller = ArithmeticWorkflow(TestDomain(Connection()))
+        execution = flowser.tasks.WorkflowExecution(
+                {'workflowId': 'wf', 'runId': 'run'}, caller)
+        execution.request_cancel()
+        self.assertEqual(calls, [(TestDomain.name, 'wf', 'run')])
+
+
+class BulkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_bulk_signal_resumes_from_checkpoint(self):
+        signaled = []
+        lock = threading.Lock()
+
+        class Connection(object):
+            def list_open_workflow_executions(self, domain, **kwargs):
+                page = kwargs['next_page_token'] or 0
+                infos = [{'execution': {'workflowId': 'wf-%d' % i,
+                                        'runId': 'run-%d' % i},
+                          'tagList': ['odd' if i % 2 else 'even']}
+                         for i in range(page * 10, page * 10 + 10)]
+                result = {'executionInfos': infos}
+                if page < 2:
+                    result['nextPageToken'] = page + 1
+                return result
+
+            def signal_workflow_execution(self, domain, name, workflow_id,
+                                          input=None, run_id=None):
+                with lock:
+                    signaled.append(workflow_id)
+                if workflow_id == 'wf-5' and len(signaled) < 15:
+                    raise SWFResponseError(400, 'Bad Request')
+
+        workflow = ArithmeticWorkflow(TestDomain(Connection()))
+        checkpoint = os.path.join(self.tmp_dir, 'checkpoint')
+
+        def odd(info):
+            return info['tagList'] == ['odd']
+
+        results = list(workflow.bulk_signal(
+                'go', predicate=odd, concurrency=3, checkpoint=checkpoint))
+        self.assertEqual(len(results), 15)
+        failed = [r.workflow_id for r in results if r.error]
+        self.assertEqual(failed, ['wf-5'])
+
+        # Only the failed execution is signaled again.
+        results = list(workflow.bulk_signal(
+                'go', predicate=odd, concurrency=3, checkpoint=checkpoint))
+        self.assertEqual([(r.workflow_id, r.error) for r in results],
+                         [('wf-5', None)])
+        self.assertEqual(sorted(set(signaled)),
+                         sorted('wf-%d' % i for i in range(1, 30, 2)))
+
+
+class VisibilityTestCase(unittest.TestCase):
+
+    def test_iter_open_shards_and_pages(self):
+        calls = []
+        lock = threading.Lock()
+        # One execution every 100 seconds.
+        starts = [1000.0 + 100 * i for i in range(50)]
+
+        class Connection(object):
+            def list_open_workflow_executions(self, domain, oldest_date,
+                                              latest_date, **kwargs):
+                with lock:
+                    calls.append(kwargs['next_page_token'])
+                matching = [t for t in reversed(starts)
+                            if oldest_date <= t <= latest_date]
+                offset = kwargs['next_page_token'] or 0
+                result = {'executionInfos': [
+                        {'startTimestamp': t}
+                        for t in matching[offset:offset + 3]]}
+                if offset + 3 < len(matching):
+                    result['nextPageToken'] = offset + 3
+                return result
+
+        domain = TestDomain(Connection())
+        domain.visibility_cache = VisibilityCache(ttl=60)
+        workflow = ArithmeticWorkflow(domain)
+        infos = list(workflow.iter_open(latest_date=starts[-1],
+                                        oldest_date=starts[0], shards=7))
+        self.assertEqual([info['startTimestamp'] for info in infos],
+                         list(reversed(starts)))
+        self.assertEqual(calls.count(None), 7)
+
+        # Repeated queries are served from the cache.
+        del calls[:]
+        cached = list(workflow.iter_open(latest_date=starts[-1],
+                                         oldest_date=starts[0], shards=7))
+        self.assertEqual(cached, infos)
+        self.assertEqual(calls, [])
+
+
+    def test_default_dates_hit_the_cache(self):
+        calls = []
+
+        class Connection(object):
+            def list_open_workflow_executions(self, domain, oldest_date,
+                                              latest_date, **kwargs):
+                calls.append(latest_date)
+                return {'executionInfos': [{
+                        'execution': {'workflowId': 'wf', 'runId': 'run'},
+                        'startTimestamp': latest_date}]}
+
+        domain = TestDomain(Connection())
+        domain.visibility_cache = VisibilityCache(ttl=60)
+        workflow = ArithmeticWorkflow(domain)
+        infos = list(workflow.iter_open())
+        time.sleep(0.01)
+        self.assertEqual(list(workflow.iter_open()), infos)
+        self.assertEqual(len(calls), 1)
+        # Bulk operations still query the current range.
+        list(workflow._open_executions(None, None, None))
+        self.assertEqual(len(calls), 2)
+
+    def test_shard_windows_are_adjacent(self):
+        windows = flowser.visibility.shard_windows(
+                1699999999.123456, 1700000000.123456, 4)
+        self.assertEqual(windows, [
+                (1699999999.873, 1700000000.123456),
+                (1699999999.623, 1699999999.872),
+                (1699999999.373, 1699999999.622),
+                (1699999999.123456, 1699999999.372)])
+        # Executions on a boundary are in exactly one window, including
+        # those that fell between windows before boundaries were rounded.
+        for start in [1699999999.873, 1699999999.8734, 1699999999.623,
+                      1699999999.373]:
+            matching = [w for w in windows if w[0] <= start <= w[1]]
+            self.assertEqual(len(matching), 1)
+
+    def test_iter_open_finds_executions_on_shard_boundaries(self):
+        latest = 1700000000.123456
+        starts = [1699999700.123, 1699999800.123, 1699999900.123]
+
+        class Connection(object):
+            def list_open_workflow_executions(self, domain, oldest_date,
+                                              latest_date, **kwargs):
+                return {'executionInfos': [
+                        {'startTimestamp': t} for t in reversed(starts)
+                        if oldest_date <= t <= latest_date]}
+
+        workflow = ArithmeticWorkflow(TestDomain(Connection()))
+        infos = list(workflow.iter_open(latest_date=latest,
+                                        oldest_date=latest - 400, shards=4))
+        self.assertEqual([info['startTimestamp'] for info in infos],
+                         list(reversed(starts)))
+
+
+class RegisterMissingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_register_missing(self):
+        calls = []
+        lock = threading.Lock()
+
+        class Connection(object):
+            def __getattr__(self, name):
+                def call(*args, **kwargs):
+                    with lock:
+                        calls.append(name)
+                    if name == 'list_activity_types':
+                        if kwargs['next_page_token'] is None:
+                            return {'typeInfos': [], 'nextPageToken': 'p2'}
+                        return {'typeInfos': [{'activityType': {
+                                'name': 'SumActivity',
+                                'version': '1.0.0'}}]}
+                    return {}
+                return call
+
+        domain = TestDomain(Connection())
+        fingerprint = os.path.join(self.tmp_dir, 'types.json')
+        registered = domain.register_missing(fingerprint=fingerprint)
+        self.assertEqual(sorted(t.name for t in registered),
+                         ['ArithmeticWorkflow', 'MultiplyActivity'])
+        self.assertEqual(sorted(calls), sorted([
+                'register_domain', 'list_activity_types',
+                'list_activity_types', 'list_workflow_types',
+                'register_activity_type', 'register_workflow_type']))
+
+        # Unchanged types are not registered again.
+        del calls[:]
+        self.assertEqual(domain.register_missing(fingerprint=fingerprint), [])
+        self.assertEqual(calls, [])
+
+        # Changed types are.
+        class ChangedDomain(TestDomain):
+            retention_period = '7'
+        ChangedDomain(Connection()).register_missing(fingerprint=fingerprint)
+        self.assertTrue('register_domain' in calls)
+
+
+class FakeDomain(TestDomain):
+    name = 'flowser-fake'
+
+
+class FakeConnectionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = FakeConnection(poll_timeout=0.05, page_size=4)
+        self.domain = FakeDomain(self.conn)
+        self.domain.register()
+
+    def test_workflow_and_activities(self):
+        pool = self.domain.run_activity_workers(
+                [MultiplyActivity, SumActivity], handle_arithmetic,
+                pollers=2, max_in_flight=4, wait=False)
+        decider = ArithmeticWorkflowDecider(self.domain)
+        decider.start()
+        self.domain.start(ArithmeticWorkflow, {
+                'id': '1',
+                'operations': [
+                    ['mult_id', 'multiply', [2, 3, 4]],
+                    ['sum_id', 'sum', [2, 3, 4]],
+                    ],
+                })
+        decider.join(10)
+        pool.stop()
+        self.assertEqual(decider.result, {'mult_id': 24, 'sum_id': 9})
+        closed = list(ArithmeticWorkflow(self.domain).iter_closed())
+        self.assertEqual([info['closeStatus'] for info in closed],
+                         ['COMPLETED'])
+
+    def test_history_pages(self):
+        result = self.domain.start(ArithmeticWorkflow, {'id': '1'})
+        execution = flowser.tasks.WorkflowExecution(
+                {'workflowId': 'ArithmeticWorkflow.1',
+                 'runId': result['runId']},
+                ArithmeticWorkflow(self.domain))
+        for i in range(10):
+            execution.signal('signal-%d' % i)
+
+        task = next(self.domain.decisions(ArithmeticWorkflow))
+        # Started, scheduled, ten signals and started.
+        event_ids = [ev.id for ev in task.history]
+        self.assertEqual(event_ids, list(range(13, 0, -1)))
+        self.assertEqual(task.most_recent('WorkflowExecutionSignaled')
+                         .attrs['signalName'], 'signal-9')
+        task.complete()
+
+        first_page = self.conn.get_workflow_execution_history(
+                self.domain.name, result['runId'], 'ArithmeticWorkflow.1')
+        self.assertEqual([ev['eventId'] for ev in first_page['events']],
+                         [1, 2, 3, 4])
+        self.assertTrue('nextPageToken' in first_page)
+
+    def test_only_service_calls_are_implemented(self):
+        # boto has no respond_decision_task_failed, so neither has the fake.
+        self.assertFalse(hasattr(self.conn, 'respond_decision_task_failed'))
+
+    def test_terminate(self):
+        for i in range(3):
+            self.domain.start(ArithmeticWorkflow, {'id': str(i)})
+        workflow = ArithmeticWorkflow(self.domain)
+        self.assertRaises(SWFWorkflowExecutionAlreadyStartedError,
+                          self.domain.start, ArithmeticWorkflow, {'id': '0'})
+        results = list(workflow.bulk_terminate(reason='test'))
+        self.assertFalse([r for r in results if r.error])
+        self.assertEqual(list(workflow.iter_open()), [])
+        self.assertEqual(len(list(workflow.iter_closed())), 3)
+
+    def test_throttling(self):
+        conn = FakeConnection(rates={'start_workflow_execution': (1, 2)})
+        domain = FakeDomain(conn)
+        domain.register()
+        domain.start(ArithmeticWorkflow, {'id': '1'})
+        domain.start(ArithmeticWorkflow, {'id': '2'})
+        try:
+            domain.start(ArithmeticWorkflow, {'id': '3'})
+        except SWFResponseError as exc:
+            self.assertTrue(is_throttling_error(exc))
+        else:
+            self.fail('not throttled')
+
+        domain.conn = ThrottledConnection(conn, base_delay=0.5)
+        domain.start(ArithmeticWorkflow, {'id': '3'})
+        self.assertTrue(conn.throttled['start_workflow_execution'] >= 1)
+
+
+class ActivityWorkerPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.domain = FakeDomain(FakeConnection(poll_timeout=0.01))
+        self.domain.register()
+
+    def schedule(self, activity_type, inputs):
+        self.domain.start(ArithmeticWorkflow, {'id': '1'})
+        task = next(self.domain.decisions(ArithmeticWorkflow))
+        for input in inputs:
+            task.schedule(activity_type, input)
+        task.complete()
+
+    def test_workflow_and_activities(self):
+        pool = self.domain.run_activity_workers(
+                [MultiplyActivity, SumActivity], handle_arithmetic,
+                pollers=2, max_in_flight=4, wait=False)
+        decider = ArithmeticWorkflowDecider(self.domain)
+        decider.start()
+        self.domain.start(ArithmeticWorkflow, {
+                'id': '2',
+                'operations': [
+                    ['mult_id', 'multiply', [2, 3, 4]],
+                    ['sum_id', 'sum', [2, 3, 4]],
+                    ],
+                })
+        decider.join(10)
+        pool.stop()
+        self.assertEqual(decider.result, {'mult_id': 24, 'sum_id': 9})
+
+    def test_poller_survives_broken_poll_results(self):
+        self.schedule(MultiplyActivity, [
+                {'id': str(i), 'operation': [str(i), [i, 2]]}
+                for i in range(2)])
+        built = []
+
+        def task_class(result, caller):
+            built.append(result['activityId'])
+            if len(built) == 1:
+                raise ValueError('broken poll result')
+            return flowser.tasks.Activity(result, caller)
+        dispatched = []
+        got_task = threading.Event()
+        # A single slot: a leaked slot would stop all polling.
+        slots = FairSemaphore(1)
+
+        def dispatch(task):
+            dispatched.append(task)
+            got_task.set()
+            slots.release()
+        poller = Poller(self.domain, MultiplyActivity,
+                        '_poll_for_activity_task', task_class, dispatch,
+                        slots)
+        poller.start()
+        got_task.wait(5)
+        poller.stop()
+        poller.join(5)
+        self.assertEqual(len(built), 2)
+        self.assertEqual([task.activity_id for task in dispatched],
+                         [built[1]])
+
+
+class ProcessActivityWorkerPoolTestCase(unittest.TestCase):
+
+    def test_handlers_run_in_worker_processes(self):
+        conn = FakeConnection(poll_timeout=0.01)
+        domain = FakeDomain(conn)
+        domain.register()
+        run_id = domain.start(ArithmeticWorkflow, {'id': '1'})['runId']
+        task = next(domain.decisions(ArithmeticWorkflow))
+        for i in range(3):
+            task.schedule(MultiplyActivity,
+                          {'id': str(i), 'operation': [str(i), [i, 2]]})
+        task.complete()
+
+        pool = domain.run_activity_workers(
+                [MultiplyActivity], multiply_input, processes=2, wait=False)
+        self.assertEqual(pool._max_in_flight, 2)
+        results = []
+        deadline = time.time() + 10
+        while len(results) < 3 and time.time() < deadline:
+            time.sleep(0.05)
+            events = conn.get_workflow_execution_history(
+                    domain.name, run_id, 'ArithmeticWorkflow.1')['events']
+            results = [flowser.serializing.loads(
+                           ev['activityTaskCompletedEventAttributes']
+                           ['result'])
+                       for ev in events
+                       if ev['eventType'] == 'ActivityTaskCompleted']
+        # Stopping without waiting still shuts the worker processes down.
+        pool.stop()
+        deadline = time.time() + 10
+        while pool._process_pool is not None and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(sorted(results), [['0', 0], ['1', 2], ['2', 4]])
+        self.assertEqual(pool._process_pool, None)
+
+
+class PollSupervisorTestCase(unittest.TestCase):
+
+    class Poller(object):
+        stopped = False
+
+        def stop(self):
+            self.stopped = True
+
+    def setUp(self):
+        self.started = []
+
+        def start_poller(stats):
+            poller = self.Poller()
+            self.started.append(poller)
+            return poller
+        self.supervisor = PollSupervisor(
+                FakeDomain(FakeConnection()), MultiplyActivity,
+                '_count_pending_activity_tasks', start_poller,
+                min_pollers=2, max_pollers=5)
+
+    def record_polls(self, empty, full):
+        for i in range(empty):
+            self.supervisor.stats.record_poll(empty=True)
+        for i in range(full):
+            self.supervisor.stats.record_poll(empty=False)
+
+    def test_scale_up(self):
+        self.supervisor.check(0)
+        self.assertEqual(self.supervisor.pollers, 2)
+        self.supervisor.check(4)
+        self.assertEqual(self.supervisor.pollers, 4)
+        self.assertEqual(self.supervisor.report['backlog'], 4)
+        self.assertEqual(self.supervisor.report['pollers'], 4)
+
+    def test_scale_up_is_clamped(self):
+        self.supervisor.check(100)
+        self.assertEqual(self.supervisor.pollers, 5)
+        self.assertEqual(len(self.started), 5)
+
+    def test_scale_down_one_at_a_time_while_polls_are_empty(self):
+        self.supervisor.check(5)
+        # Mostly full polls: keep the pollers.
+        self.record_polls(empty=1, full=3)
+        self.supervisor.check(0)
+        self.assertEqual(self.supervisor.pollers, 5)
+        self.record_polls(empty=3, full=1)
+        self.supervisor.check(0)
+        self.assertEqual(self.supervisor.pollers, 4)
+        self.assertEqual([p.stopped for p in self.started],
+                         [False] * 4 + [True])
+
+    def test_scale_down_is_clamped(self):
+        self.supervisor.check(5)
+        for i in range(10):
+            self.record_polls(empty=4, full=0)
+            self.supervisor.check(0)
+        self.assertEqual(self.supervisor.pollers, 2)
+
+    def test_stopped_pollers_are_pruned(self):
+        domain = FakeDomain(FakeConnection(poll_timeout=0.01))
+        domain.register()
+        pool = ActivityWorkerPool(domain, [MultiplyActivity],
+                                  handle_arithmetic)
+        first = pool._start_poller(MultiplyActivity)
+        first.stop()
+        first.join(5)
+        second = pool._start_poller(MultiplyActivity)
+        self.assertEqual(pool._pollers, [second])
+        pool.stop()
+        second.join(5)
+
+
+class FairSemaphoreTestCase(unittest.TestCase):
+
+    def test_waiting_thread_goes_first(self):
+        slots = FairSemaphore(1)
+        slots.acquire()
+        order = []
+
+        def take():
+            slots.acquire()
+            order.append('waiting')
+            slots.release()
+        thread = threading.Thread(target=take)
+        thread.start()
+        while not slots._waiters:
+            time.sleep(0.001)
+        # Releasing and acquiring again must not jump the queue.
+        slots.release()
+        slots.acquire()
+        order.append('releasing')
+        thread.join()
+        self.assertEqual(order, ['waiting', 'releasing'])
+
+    def test_permits_are_granted_in_request_order(self):
+        slots = FairSemaphore(1)
+        slots.acquire()
+        order = []
+        threads = []
+        for i in range(5):
+            def take(i=i):
+                slots.acquire()
+                order.append(i)
+                slots.release()
+            thread = threading.Thread(target=take)
+            thread.start()
+            threads.append(thread)
+            while len(slots._waiters) < i + 1:
+                time.sleep(0.001)
+        slots.release()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, list(range(5)))
+
+    def test_idle_task_list_does_not_starve_busy_one(self):
+        # One slot shared by pollers of an idle and a busy task list.
+        domain = FakeDomain(FakeConnection(poll_timeout=0.01))
+        domain.register()
+        domain.start(ArithmeticWorkflow, {'id': '1'})
+        task = next(domain.decisions(ArithmeticWorkflow))
+        for i in range(5):
+            task.schedule(MultiplyActivity,
+                          {'id': str(i), 'operation': [str(i), [i, 2]]})
+        task.complete()
+
+        handled = []
+        done = threading.Event()
+
+        def handler(task):
+            handled.append(task.activity_id)
+            if len(handled) == 5:
+                done.set()
+            return handle_arithmetic(task)
+        pool = domain.run_activity_workers(
+                [SumActivity, MultiplyActivity], handler,
+                pollers=2, max_in_flight=1, wait=False)
+        done.wait(10)
+        pool.stop()
+        self.assertEqual(len(handled), 5)
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def test_registry(self):
+        conn = FakeConnection(poll_timeout=0.01, page_size=4)
+        domain = FakeDomain(conn)
+        domain.instrumentation = flowser.metrics.Registry()
+        domain.register()
+        self.assertRaises(flowser.exceptions.EmptyTaskPollResult,
+                          ArithmeticWorkflow(domain)._poll_for_decision_task)
+        domain.start(ArithmeticWorkflow, {'id': '1'})
+        for i in range(6):
+            conn.signal_workflow_execution(
+                    domain.name, 'signal', 'ArithmeticWorkflow.1')
+
+        task = next(domain.decisions(ArithmeticWorkflow))
+        self.assertEqual(len(list(task.history)), 9)
+        task.schedule(MultiplyActivity, {'id': '1',
+                                         'operation': ['op', [2, 3]]})
+        task.complete()
+        activity = next(domain.activities(MultiplyActivity))
+        activity.complete(handle_arithmetic(activity))
+
+        registry = domain.instrumentation
+        self.assertEqual(registry.counter_value(
+                'flowser_polls_total', task='decision',
+                type='ArithmeticWorkflow', result='task'), 1)
+        self.assertEqual(registry.counter_value(
+                'flowser_polls_total', task='decision',
+                type='ArithmeticWorkflow', result='empty'), 1)
+        self.assertEqual(registry.counter_value(
+                'flowser_history_pages_total', type='ArithmeticWorkflow'), 2)
+        self.assertEqual(registry.histogram_count(
+                'flowser_activity_seconds', type='MultiplyActivity',
+                outcome='completed'), 1)
+        self.assertEqual(registry.histogram_count(
+                'flowser_request_seconds', call='start_workflow_execution',
+                type='ArithmeticWorkflow'), 1)
+
+        server = registry.serve(0)
+        try:
+            url = 'http://127.0.0.1:%d/metrics' % server.server_port
+            text = urlopen(url).read().decode('utf-8')
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertTrue('# TYPE flowser_decision_history_pages histogram\n'
+                        in text)
+        self.assertTrue('flowser_decision_history_pages_bucket{'
+                        'type="ArithmeticWorkflow",le="2.0"} 1\n' in text)
+
+
+def busy_decider_work(seconds):
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        pass
+
+
+class DecisionProfilerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.domain = FakeDomain(FakeConnection(poll_timeout=0.01))
+        self.domain.register()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def handle_decision(self, seconds):
+        self.domain.start(ArithmeticWorkflow, {'id': str(seconds)})
+        decisions = self.domain.decisions(ArithmeticWorkflow)
+        task = next(decisions)
+        busy_decider_work(seconds)
+        task.complete()
+        # Closing the loop ends the task, like asking for the next one.
+        decisions.close()
+        return task
+
+    def test_slow_tasks_are_written(self):
+        self.domain.decision_profiler = DecisionProfiler(
+                self.tmp_dir, slow_threshold=0.1, interval=0.001)
+        self.handle_decision(0)
+        self.assertEqual(os.listdir(self.tmp_dir), [])
+
+        task = self.handle_decision(0.2)
+        names = sorted(os.listdir(self.tmp_dir))
+        self.assertEqual(len(names), 2)
+        collapsed, meta = [os.path.join(self.tmp_dir, name)
+                           for name in names]
+        self.assertTrue('-ArithmeticWorkflow-%s-3-' %
+                        task.workflow_execution.run_id in names[0])
+        with open(collapsed) as f:
+            self.assertTrue('busy_decider_work' in f.read())
+        with open(meta) as f:
+            meta = json.load(f)
+        self.assertEqual(meta['reason'], 'slow')
+        self.assertEqual(meta['history_length'], 3)
+
+    def test_sampled_tasks_are_written(self):
+        self.domain.decision_profiler = DecisionProfiler(
+                self.tmp_dir, sample_rate=1, interval=0.001)
+        self.handle_decision(0.01)
+        self.assertEqual(len(os.listdir(self.tmp_dir)), 2)
+
+
+class TracingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        class TracedDomain(FakeDomain):
+            tracer = Tracer(MemoryExporter())
+
+        self.spans = TracedDomain.tracer.exporter.spans
+        self.conn = FakeConnection(poll_timeout=0.05)
+        self.domain = TracedDomain(self.conn)
+        self.domain.register()
+
+    def named(self, name):
+        return [span for span in self.spans if span['name'] == name]
+
+    def test_spans_link_executions_and_tasks(self):
+        serializing = flowser.serializing
+        run_id = self.domain.start(ArithmeticWorkflow, {'id': '1'})['runId']
+        task = next(self.domain.decisions(ArithmeticWorkflow))
+        started = task.most_recent('WorkflowExecutionStarted')
+        self.assertEqual(started.raw_attrs['input'], '{"id": "1"}')
+        task.schedule(MultiplyActivity,
+                      {'id': '1.mult', 'operation': ['mult', [2, 3]]},
+                      control={'step': 1})
+        task.start_child(ArithmeticWorkflow, {'id': '2'})
+        task.complete(context={'step': 1})
+
+        activity = next(self.domain.activities(MultiplyActivity))
+        self.assertEqual(serializing.get_trace_context(activity.raw_input),
+                         None)
+        self.assertEqual(activity.input['operation'], ['mult', [2, 3]])
+        activity.complete(6)
+
+        # Handle decision tasks until the child has had one.
+        for _ in range(5):
+            task = next(self.domain.decisions(ArithmeticWorkflow))
+            if task.workflow_execution.workflow_id == 'ArithmeticWorkflow.2':
+                self.assertEqual(task.start_input, {'id': '2'})
+                child_run_id = task.workflow_execution.run_id
+                task.complete()
+                break
+            task.complete()
+        else:
+            self.fail('child workflow had no decision task')
+        history = History(
+                self.conn.get_workflow_execution_history(
+                        self.domain.name, run_id, 'ArithmeticWorkflow.1',
+                        reverse_order=True)['events'])
+        completed = history.filter('DecisionTaskCompleted')[-1]
+        self.assertEqual(completed.raw_attrs['executionContext'],
+                         '{"step": 1}')
+        scheduled = history.most_recent('ActivityTaskScheduled')
+        initiated = history.most_recent('StartChildWorkflowExecutionInitiated')
+
+        start = self.named('start_workflow_execution')[0]
+        self.assertEqual(start['parent_id'], None)
+        self.assertEqual(start['attributes']['workflow_id'],
+                         'ArithmeticWorkflow.1')
+        self.assertEqual(start['trace_id'] + '-' + start['span_id'],
+                         execution_context('ArithmeticWorkflow.1', run_id))
+
+        decisions = self.named('decision')
+        parent_spans = [span for span in decisions
+                        if span['attributes']['workflow_id'] ==
+                        'ArithmeticWorkflow.1']
+        first = parent_spans[0]
+        self.assertTrue(first['start'] <= first['end'])
+        self.assertEqual(set(span['parent_id'] for span in parent_spans),
+                         set([start['span_id']]))
+        by_id = dict((span['span_id'], span) for span in self.spans)
+        for span in self.named('decision.queue') + \
+                self.named('respond_decision_task_completed'):
+            self.assertEqual(by_id[span['parent_id']]['name'], 'decision')
+        activity_span = self.named('activity')[0]
+        self.assertEqual(activity_span['trace_id'], start['trace_id'])
+        self.assertEqual(activity_span['parent_id'], start['span_id'])
+        self.assertEqual(activity_span['attributes']['outcome'], 'completed')
+
+        # The control records the decision task that scheduled the
+        # activity. The child was started without control.
+        self.assertEqual(
+                serializing.get_trace_context(scheduled.raw_attrs['control']),
+                first['trace_id'] + '-' + first['span_id'])
+        self.assertEqual(serializing.loads(scheduled.raw_attrs['control']),
+                         {'step': 1})
+        self.assertFalse('control' in initiated.raw_attrs)
+
+        # The child has a trace of its own, see
+        # test_child_workflow_is_linked_to_parent.
+        child = [span for span in decisions
+                 if span['attributes']['workflow_id'] ==
+                 'ArithmeticWorkflow.2'][0]
+        self.assertEqual(child['trace_id'] + '-' + child['parent_id'],
+                         execution_context('ArithmeticWorkflow.2',
+                                           child_run_id))
+
+    def test_child_workflow_is_linked_to_parent(self):
+        run_id = self.domain.start(ArithmeticWorkflow, {'id': '1'})['runId']
+        task = next(self.domain.decisions(ArithmeticWorkflow))
+        task.start_child(ArithmeticWorkflow, {'id': '2'}, control={'n': 1})
+        task.complete()
+
+        # Handle the first task of the child and the next one of the parent.
+        seen = set()
+        for _ in range(5):
+            task = next(self.domain.decisions(ArithmeticWorkflow))
+            execution = task.workflow_execution
+            seen.add(execution.workflow_id)
+            if execution.workflow_id == 'ArithmeticWorkflow.2':
+                child_run_id = execution.run_id
+            task.complete()
+            if len(seen) == 2:
+                break
+        else:
+            self.fail('child workflow had no decision task')
+
+        first = self.named('decision')[0]
+        root = self.named('child_workflow_execution')[0]
+        child_context = execution_context('ArithmeticWorkflow.2',
+                                          child_run_id)
+        self.assertEqual(root['trace_id'] + '-' + root['span_id'],
+                         child_context)
+        self.assertEqual(root['parent_id'], None)
+        self.assertEqual(root['attributes']['link'],
+                         first['trace_id'] + '-' + first['span_id'])
+        self.assertEqual(root['attributes']['parent_workflow_id'],
+                         'ArithmeticWorkflow.1')
+        self.assertEqual(root['attributes']['parent_run_id'], run_id)
+
+        child = [span for span in self.named('decision')
+                 if span['attributes']['workflow_id'] ==
+                 'ArithmeticWorkflow.2'][0]
+        self.assertEqual(child['trace_id'], root['trace_id'])
+        self.assertEqual(child['parent_id'], root['span_id'])
+        self.assertEqual(child['attributes']['parent_workflow_id'],
+                         'ArithmeticWorkflow.1')
+        self.assertEqual(child['attributes']['link'],
+                         execution_context('ArithmeticWorkflow.1', run_id))
+
+    def test_trace_context_envelope(self):
+        data = flowser.serializing.dumps({'a': 1})
+        wrapped = flowser.serializing.add_trace_context(data, 'abc-123')
+        self.assertEqual(flowser.serializing.get_trace_context(wrapped), 'abc-123')
+        self.assertEqual(flowser.serializing.loads(wrapped), {'a': 1})
+        rewrapped = flowser.serializing.add_trace_context(wrapped, 'abc-456')
+        self.assertEqual(flowser.serializing.get_trace_context(rewrapped), 'abc-456')
+        self.assertEqual(flowser.serializing.loads(rewrapped), {'a': 1})
+        self.assertEqual(flowser.serializing.get_trace_context(data), None)
+
+    def test_trace_context_envelope_is_offloaded(self):
+        serializing = flowser.serializing
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        obj = {'values': list(range(200))}
+        blob_threshold = serializing.blob_threshold
+        serializing.blob_threshold = len(serializing.dumps(obj))
+        self.addCleanup(setattr, serializing, 'blob_threshold', blob_threshold)
+        serializing.blob_store = flowser.blobs.FileBlobStore(directory)
+        self.addCleanup(setattr, serializing, 'blob_store', None)
+
+        data = serializing.dumps(obj)
+        self.assertEqual(serializing.loads(data), obj)
+        self.assertFalse(data.startswith('#fl1:blob:'))
+        wrapped = serializing.add_trace_context(data, 'abc-123')
+        self.assertTrue(len(wrapped) <= serializing.blob_threshold)
+        self.assertEqual(serializing.get_trace_context(wrapped), 'abc-123')
+        self.assertEqual(serializing.loads(wrapped), obj)
+
+
+@unittest.skipIf(flowser.aio.asyncio is None, 'asyncio unavailable')
+class AsyncioTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = FakeConnection(poll_timeout=0.01)
+        self.domain = FakeDomain(self.conn)
+        self.domain.register()
+        self.loop = flowser.aio.asyncio.new_event_loop()
+        flowser.aio.asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        flowser.aio.asyncio.set_event_loop(None)
+        executor = getattr(self.domain, '_aio_executor', None)
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def run_loop(self, awaitable):
+        return self.loop.run_until_complete(awaitable)
+
+    def schedule_multiply(self):
+        self.domain.start(ArithmeticWorkflow, {'id': '1'})
+        task = next(self.domain.decisions(ArithmeticWorkflow))
+        task.schedule(MultiplyActivity,
+                      {'id': '1', 'operation': ['mult', [2, 3]]})
+        task.complete()
+
+    def test_iteration(self):
+        self.domain.start(ArithmeticWorkflow, {'id': '1'})
+        tasks = self.domain.adecisions(ArithmeticWorkflow)
+        task = self.run_loop(tasks.__anext__())
+        self.assertEqual(task.start_input, {'id': '1'})
+        task.schedule(MultiplyActivity,
+                      {'id': '1', 'operation': ['mult', [2, 3]]})
+        self.run_loop(task.acomplete())
+        activity = self.run_loop(
+                self.domain.aactivities(MultiplyActivity).__anext__())
+        self.assertEqual(activity.input['operation'], ['mult', [2, 3]])
+        self.run_loop(activity.acomplete(handle_arithmetic(activity)))
+
+    def test_empty_polls_are_retried(self):
+        activities = self.domain.aactivities(MultiplyActivity)
+        next_activity = activities.__anext__()
+        self.run_loop(flowser.aio.asyncio.sleep(0.1))
+        self.assertFalse(next_activity.done())
+        self.assertTrue(self.conn.calls['poll_for_activity_task'] > 1)
+        self.schedule_multiply()
+        activity = self.run_loop(next_activity)
+        self.assertEqual(activity.activity_type.name, 'MultiplyActivity')
+
+    def test_task_polled_after_cancellation_is_kept(self):
+        self.schedule_multiply()
+        activities = self.domain.aactivities(MultiplyActivity)
+        next_activity = activities.__anext__()
+        next_activity.cancel()
+        # Let the poll in progress return the task.
+        self.run_loop(flowser.aio.asyncio.sleep(0.1))
+        polls = self.conn.calls['poll_for_activity_task']
+        activity = self.run_loop(activities.__anext__())
+        self.assertEqual(activity.input['operation'], ['mult', [2, 3]])
+        self.assertEqual(self.conn.calls['poll_for_activity_task'], polls)
+
+    def test_task_errors_reach_the_consumer(self):
+        self.schedule_multiply()
+
+        def task_class(result, caller):
+            raise ValueError('broken poll result')
+        activities = flowser.aio.TaskIterator(
+                self.domain, MultiplyActivity, '_poll_for_activity_task',
+                task_class)
+        next_activity = flowser.aio.asyncio.wait_for(
+                activities.__anext__(), 5)
+        self.assertRaises(ValueError, self.run_loop, next_activity)
+
+
+class PagePrefetcherTestCase(unittest.TestCase):
+
+    def test_pages_are_fetched_ahead(self):
+        fetched = []
+        pages_fetched = threading.Event()
+
+        def fetch(token):
+            fetched.append(token)
+            if token == 3:
+                pages_fetched.set()
+                return ['page-3'], None
+            return ['page-%d' % token], token + 1
+
+        prefetcher = PagePrefetcher(fetch, 1, max_pages=5)
+        self.assertTrue(pages_fetched.wait(5))
+        self.assertEqual(fetched, [1, 2, 3])
+        self.assertEqual(prefetcher.next_page(), (['page-1'], 2))
+        self.assertEqual(prefetcher.next_page(), (['page-2'], 3))
+        self.assertEqual(prefetcher.next_page(), (['page-3'], None))
+        self.assertRaises(LastPage, prefetcher.next_page)
+
+    def make_fetch(self, last):
+        fetched = []
+
+        def fetch(token):
+            fetched.append(token)
+            return ['page-%d' % token], token + 1 if token < last else None
+        return fetch, fetched
+
+    def test_limit(self):
+        fetch, fetched = self.make_fetch(5)
+        prefetcher = PagePrefetcher(fetch, 1, max_pages=5, limit=2)
+        prefetcher._thread.join(5)
+        self.assertEqual(fetched, [1, 2])
+        self.assertEqual(prefetcher.next_page(), (['page-1'], 2))
+        self.assertEqual(prefetcher.next_page(), (['page-2'], 3))
+        self.assertEqual(prefetcher.next_page(), (['page-3'], 4))
+        self.assertEqual(fetched, [1, 2, 3])
+
+    def test_idle_thread_stops(self):
+        fetch, fetched = self.make_fetch(5)
+
+        class IdlePrefetcher(PagePrefetcher):
+            _close_check_interval = 0.01
+            max_idle = 0.05
+
+        prefetcher = IdlePrefetcher(fetch, 1, max_pages=1)
+        prefetcher._thread.join(5)
+        self.assertFalse(prefetcher._thread.is_alive())
+        self.assertEqual(fetched, [1, 2])
+        pages = [prefetcher.next_page() for i in range(5)]
+        self.assertEqual(pages[-1], (['page-5'], None))
+        self.assertEqual(fetched, [1, 2, 2, 3, 4, 5])
+        self.assertRaises(LastPage, prefetcher.next_page)
+
+    def test_thread_exits_when_owner_is_collected(self):
+        class Owner(object):
+            def fetch(self, token):
+                return ['page'], token + 1
+
+        class QuickPrefetcher(PagePrefetcher):
+            _close_check_interval = 0.01
+
+        owner = Owner()
+        prefetcher = QuickPrefetcher(Owner.fetch, 1, max_pages=1, owner=owner)
+        self.assertEqual(prefetcher.next_page(), (['page'], 2))
+        del owner
+        gc.collect()
+        prefetcher._thread.join(5)
+        self.assertFalse(prefetcher._thread.is_alive())
+        self.assertRaises(LastPage, prefetcher._fetch_resumed)
+
 
 if __name__ == '__main__':
     logging.basicConfig(stream=sys.stderr)